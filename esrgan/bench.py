@@ -0,0 +1,425 @@
+"""
+Offline benchmarks for the inference stack.
+
+Networks are built from config/params.json with randomly initialized (seeded) weights, so nothing is downloaded.
+
+    python bench.py engine --models realesr-general-x4v3 --tiles 0 128
+    python bench.py precision --pretrained
+    python bench.py --output sweep.json sweep --targets enhance infer --inputs rgb rgba gray 16bit
+    python bench.py video --models realesr-general-x4v3 --thresholds 0 2
+"""
+import argparse
+import ctypes
+import glob
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import tempfile
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+from loguru import logger
+from basicsr.metrics import calculate_psnr, calculate_ssim
+import cv2
+import numpy as np
+import torch
+
+import basicsr
+from realesrgan import RealESRGANer
+from realesrgan.quantization import IMG_EXTENSIONS
+from realesrgan.video import TemporalTileCache
+from server import util
+from server.infer import infer
+from server.memory import read_peak_rss, reset_peak_rss
+from server.util import model_params, make_model, make_upsampler
+
+INPUT_MODES = ["rgb", "rgba", "gray", "16bit"]
+
+
+def list_model_names() -> List[str]:
+    return [name for name, model in model_params.items() if model.root.type != "face-enhance"]
+
+
+def list_engines() -> List[str]:
+    engines = ["eager", "torchscript"]
+    if importlib.util.find_spec("onnxruntime") is not None:
+        engines.append("onnxruntime")
+    return engines
+
+
+def make_synthetic_upsampler(model_name: str,
+                             tile: int = 0,
+                             tile_pad: int = 10,
+                             seed: int = 0,
+                             **kwargs) -> RealESRGANer:
+    torch.manual_seed(seed)
+    params = model_params[model_name].root
+    return RealESRGANer(
+        scale=params.params.get_scale(),
+        model_path=None,
+        model=make_model(model_name),
+        tile=tile,
+        tile_pad=tile_pad,
+        pre_pad=0,
+        model_id=f"bench|{model_name}|seed={seed}",
+        **kwargs)
+
+
+def write_synthetic_weights(folder: str, seed: int = 0) -> None:
+    """Seeded random checkpoints for every upscaling model, named like the released ones"""
+    os.makedirs(folder, exist_ok=True)
+    for model_name in list_model_names():
+        for idx, url in enumerate(model_params[model_name].root.urls):
+            torch.manual_seed(seed + idx)
+            torch.save({"params_ema": make_model(model_name).state_dict()}, os.path.join(folder, url.split("/")[-1]))
+
+
+def make_image(size: int, channels: int = 3, dtype: Any = np.uint8, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    shape = (size, size) if channels == 1 else (size, size, channels)
+    return rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype)
+
+
+def make_input(size: int, mode: str, seed: int = 0) -> np.ndarray:
+    if mode == "rgba":
+        return make_image(size, channels=4, seed=seed)
+    if mode == "gray":
+        return make_image(size, channels=1, seed=seed)
+    if mode == "16bit":
+        return make_image(size, dtype=np.uint16, seed=seed)
+    return make_image(size, seed=seed)
+
+
+def time_calls(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    timings: List[float] = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    return {
+        "mean_s": float(np.mean(timings)),
+        "min_s": float(np.min(timings)),
+        "p50_s": float(np.percentile(timings, 50)),
+        "p90_s": float(np.percentile(timings, 90)),
+        "p99_s": float(np.percentile(timings, 99)),
+        "images_per_s": float(1 / np.mean(timings)),
+    }
+
+
+def trim_heap() -> None:
+    """Returns freed heap memory to the OS (glibc only), so that earlier runs do not hide the peak of the next one"""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> Dict[str, Any]:
+    """Latencies and peak memory of fn, peak_mem_mb is the growth of the peak RSS over the RSS before the first call"""
+    trim_heap()
+    rss_before: Optional[int] = reset_peak_rss()
+    timings = time_calls(fn, repeat, warmup)
+    peak_rss: Optional[int] = read_peak_rss()
+    if rss_before is None or peak_rss is None:
+        return {**summarize(timings), "peak_rss_mb": None, "peak_mem_mb": None}
+    return {**summarize(timings), "peak_rss_mb": peak_rss / 2**20, "peak_mem_mb": (peak_rss - rss_before) / 2**20}
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "basicsr": basicsr.__version__,
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "threads": torch.get_num_threads(),
+    }
+
+
+def bench_engine(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    image = make_image(args.size)
+    cache_dir: str = args.cache_dir or tempfile.mkdtemp(prefix="esrgan-bench-")
+    for model_name in args.models:
+        for tile in args.tiles:
+            for engine in args.engines:
+                upsampler = make_synthetic_upsampler(model_name, tile=tile, engine=engine, cache_dir=cache_dir)
+                # the warmup call is where tracing happens, report it separately
+                start = perf_counter()
+                upsampler.enhance(image)
+                first_call = perf_counter() - start
+                timings = time_calls(lambda: upsampler.enhance(image), args.repeat, warmup=0)
+                result = {
+                    "model": model_name,
+                    "tile": tile,
+                    "engine": engine,
+                    "size": args.size,
+                    "first_call_s": first_call,
+                    **summarize(timings)
+                }
+                logger.info(f"[Bench] {json.dumps(result)}")
+                results.append(result)
+    return results
+
+
+def load_sample_images(folder: str, size: int) -> List[np.ndarray]:
+    """Center crops of the bundled sample images"""
+    images: List[np.ndarray] = []
+    for path in sorted(glob.glob(os.path.join(folder, "*"))):
+        if not path.lower().endswith(IMG_EXTENSIONS):
+            continue
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        h, w = image.shape[0:2]
+        top, left = max(0, (h - size) // 2), max(0, (w - size) // 2)
+        images.append(np.ascontiguousarray(image[top:top + size, left:left + size]))
+    return images
+
+
+def bench_precision(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Quality (vs fp32) and speed of each precision"""
+    results: List[Dict[str, Any]] = []
+    images = load_sample_images(args.images, args.size)
+    cache_dir: str = args.cache_dir or tempfile.mkdtemp(prefix="esrgan-bench-")
+    for model_name in args.models:
+        references: List[np.ndarray] = []
+        for precision in ["fp32"] + [p for p in args.precisions if p != "fp32"]:
+            if args.pretrained:
+                upsampler = make_upsampler(model_name, tile=args.tile, precision=precision)
+            else:
+                upsampler = make_synthetic_upsampler(
+                    model_name, tile=args.tile, precision=precision, cache_dir=cache_dir)
+
+            outputs: List[np.ndarray] = []
+            timings: List[float] = []
+            for image in images:
+                start = perf_counter()
+                outputs.append(upsampler.enhance(image)[0])
+                timings.append(perf_counter() - start)
+            if precision == "fp32":
+                references = outputs
+            if precision not in args.precisions:
+                continue
+
+            result = {
+                "model": model_name,
+                "precision": precision,
+                "resolved": upsampler.precision,
+                "psnr": float(np.mean([calculate_psnr(o, r, crop_border=0) for o, r in zip(outputs, references)])),
+                "ssim": float(np.mean([calculate_ssim(o, r, crop_border=0) for o, r in zip(outputs, references)])),
+                # the first image includes one-off costs such as quantization
+                **summarize(timings[1:] or timings)
+            }
+            logger.info(f"[Bench] {json.dumps(result)}")
+            results.append(result)
+    return results
+
+
+def bench_sweep(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Every combination of the sweep parameters, through RealESRGANer.enhance and/or server.infer.infer"""
+    results: List[Dict[str, Any]] = []
+    cache_dir: str = args.cache_dir or tempfile.mkdtemp(prefix="esrgan-bench-")
+    if "infer" in args.targets:
+        # infer loads checkpoints by name, point it to random ones instead of downloading the released ones
+        util.WEIGHTS_DIR = os.path.join(cache_dir, "weights")
+        write_synthetic_weights(util.WEIGHTS_DIR)
+
+    combinations = itertools.product(args.models, args.sizes, args.tiles, args.tile_pads, args.precisions, args.inputs,
+                                     args.outscales or [None])
+    for model_name, size, tile, tile_pad, precision, mode, outscale in combinations:
+        image = make_input(size, mode)
+        native_scale: int = model_params[model_name].root.params.get_scale()
+        params = {
+            "model": model_name,
+            "size": size,
+            "tile": tile,
+            "tile_pad": tile_pad,
+            "precision": precision,
+            "input": mode,
+            "outscale": outscale or native_scale
+        }
+
+        if "enhance" in args.targets:
+            upsampler = make_synthetic_upsampler(
+                model_name, tile=tile, tile_pad=tile_pad, precision=precision, engine=args.engine, cache_dir=cache_dir)
+            result = {
+                "target": "enhance",
+                **params,
+                **measure(lambda: upsampler.enhance(image, outscale=outscale), args.repeat)
+            }
+            logger.info(f"[Bench] {json.dumps(result)}")
+            results.append(result)
+
+        if "infer" in args.targets:
+            image_bytes: bytes = cv2.imencode(".png", image)[1].tobytes()
+
+            def run() -> None:
+                infer(
+                    ".png",
+                    image_bytes,
+                    model_name,
+                    outscale=outscale or native_scale,
+                    tile=tile,
+                    tile_pad=tile_pad,
+                    precision=precision,
+                    engine=args.engine)
+
+            result = {"target": "infer", **params, **measure(run, args.repeat)}
+            logger.info(f"[Bench] {json.dumps(result)}")
+            results.append(result)
+    return results
+
+
+def make_moving_clip(num_frames: int,
+                     width: int,
+                     height: int,
+                     square: int,
+                     noise: float = 0,
+                     seed: int = 0) -> List[np.ndarray]:
+    """Square moving left to right over a static textured background, with optional gaussian noise (sigma, 0-255)"""
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 255, (max(1, height // 8), max(1, width // 8), 3), dtype=np.uint8)
+    background = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC)
+    top = (height - square) // 2
+    clip: List[np.ndarray] = []
+    for i in range(num_frames):
+        frame = background.copy()
+        left = round(i * (width - square) / max(1, num_frames - 1))
+        frame[top:top + square, left:left + square] = (0, 0, 255)
+        if noise > 0:
+            frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+        clip.append(frame)
+    return clip
+
+
+def bench_video(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Temporal tile reuse on a synthetic clip, against the tiled upsampling of every frame"""
+    results: List[Dict[str, Any]] = []
+    clip = make_moving_clip(args.frames, args.width, args.height, args.square, noise=args.noise)
+    for model_name in args.models:
+        for tile in args.tiles:
+            references: List[np.ndarray] = []
+            for threshold in [None] + args.thresholds:
+                upsampler = make_synthetic_upsampler(model_name, tile=tile, tile_pad=args.tile_pad)
+                upsampler.enhance_batch(clip[:1])  # warmup
+                if threshold is not None:
+                    upsampler.tile_cache = TemporalTileCache(threshold)
+
+                start = perf_counter()
+                outputs = [output for frame in clip for output in upsampler.enhance_batch([frame])]
+                duration = perf_counter() - start
+                if threshold is None:
+                    references = outputs
+
+                result = {
+                    "model": model_name,
+                    "tile": tile,
+                    "reuse_threshold": threshold,
+                    "frames_per_s": len(clip) / duration,
+                    "reused_tiles": upsampler.tile_cache.reuse_ratio if upsampler.tile_cache is not None else 0.,
+                    # over the whole clip, frames without reused tiles are identical to the references
+                    "psnr": float(calculate_psnr(np.concatenate(outputs), np.concatenate(references), crop_border=0)),
+                }
+                logger.info(f"[Bench] {json.dumps(result)}")
+                results.append(result)
+    return results
+
+
+def print_table(results: List[Dict[str, Any]], columns: List[str]) -> None:
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(f"{result[column]:.3f}" if isinstance(result[column], float) else str(result[column])
+                         for column in columns))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads, defaults to torch's choice")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON to this file")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    engine_parser = subparsers.add_parser("engine", help="Eager vs compiled engine throughput per model and tile size")
+    engine_parser.add_argument("--models", nargs="+", default=list_model_names(), choices=list_model_names())
+    engine_parser.add_argument(
+        "--engines", nargs="+", default=list_engines(), choices=["eager", "torchscript", "onnxruntime"])
+    engine_parser.add_argument("--tiles", nargs="+", type=int, default=[0, 64, 128])
+    engine_parser.add_argument("--size", type=int, default=128, help="Width and height of the input image")
+    engine_parser.add_argument("--repeat", type=int, default=3)
+    engine_parser.add_argument("--cache_dir", type=str, default=None, help="Defaults to a fresh temporary folder")
+
+    precision_parser = subparsers.add_parser("precision", help="Quality (PSNR/SSIM vs fp32) and speed per precision")
+    precision_parser.add_argument("--models", nargs="+", default=list_model_names(), choices=list_model_names())
+    precision_parser.add_argument(
+        "--precisions", nargs="+", default=["fp32", "bf16", "int8"], choices=["fp32", "fp16", "bf16", "int8", "auto"])
+    precision_parser.add_argument(
+        "--pretrained", action="store_true", help="Use the released weights (downloads them) instead of random ones")
+    precision_parser.add_argument("--images", type=str, default="inputs", help="Folder of sample images")
+    precision_parser.add_argument("--size", type=int, default=128, help="Images are center cropped to this size")
+    precision_parser.add_argument("--tile", type=int, default=0)
+    precision_parser.add_argument("--cache_dir", type=str, default=None, help="Defaults to a fresh temporary folder")
+
+    sweep_parser = subparsers.add_parser(
+        "sweep", help="Latency percentiles and peak memory over every combination of the options")
+    sweep_parser.add_argument("--targets", nargs="+", default=["enhance", "infer"], choices=["enhance", "infer"])
+    sweep_parser.add_argument("--models", nargs="+", default=list_model_names(), choices=list_model_names())
+    sweep_parser.add_argument(
+        "--sizes", nargs="+", type=int, default=[64, 128], help="Width and height of the input images")
+    sweep_parser.add_argument("--tiles", nargs="+", type=int, default=[0, 64])
+    sweep_parser.add_argument("--tile_pads", nargs="+", type=int, default=[10])
+    sweep_parser.add_argument(
+        "--precisions", nargs="+", default=["fp32"], choices=["fp32", "fp16", "bf16", "int8", "auto"])
+    sweep_parser.add_argument("--inputs", nargs="+", default=["rgb"], choices=INPUT_MODES)
+    sweep_parser.add_argument(
+        "--outscales", nargs="+", type=float, default=None, help="Defaults to the native scale of each model")
+    sweep_parser.add_argument("--engine", type=str, default="eager", choices=list_engines())
+    sweep_parser.add_argument("--repeat", type=int, default=5)
+    sweep_parser.add_argument("--cache_dir", type=str, default=None, help="Defaults to a fresh temporary folder")
+
+    video_parser = subparsers.add_parser(
+        "video", help="Temporal tile reuse on a clip with a moving object over a static background")
+    video_parser.add_argument("--models", nargs="+", default=["realesr-general-x4v3"], choices=list_model_names())
+    video_parser.add_argument("--tiles", nargs="+", type=int, default=[64])
+    video_parser.add_argument("--tile_pad", type=int, default=10)
+    video_parser.add_argument(
+        "--thresholds", nargs="+", type=float, default=[0], help="Reuse thresholds (0-255) to compare with no reuse")
+    video_parser.add_argument("--frames", type=int, default=12)
+    video_parser.add_argument("--width", type=int, default=320)
+    video_parser.add_argument("--height", type=int, default=180)
+    video_parser.add_argument("--square", type=int, default=32, help="Side of the moving square")
+    video_parser.add_argument(
+        "--noise", type=float, default=0, help="Gaussian noise (sigma, 0-255) added to every frame")
+
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.suite == "engine":
+        results = bench_engine(args)
+        print_table(results, ["model", "tile", "engine", "first_call_s", "mean_s", "images_per_s"])
+    elif args.suite == "precision":
+        results = bench_precision(args)
+        print_table(results, ["model", "precision", "resolved", "psnr", "ssim", "mean_s", "images_per_s"])
+    elif args.suite == "sweep":
+        results = bench_sweep(args)
+        print_table(results, [
+            "target", "model", "size", "tile", "tile_pad", "precision", "input", "outscale", "p50_s", "p90_s", "p99_s",
+            "images_per_s", "peak_mem_mb"
+        ])
+    elif args.suite == "video":
+        results = bench_video(args)
+        print_table(results, ["model", "tile", "reuse_threshold", "frames_per_s", "reused_tiles", "psnr"])
+
+    if args.output is not None:
+        with open(args.output, "w") as hFile:
+            json.dump({"suite": args.suite, "environment": environment(), "results": results}, hFile, indent=4)
+
+
+if __name__ == "__main__":
+    main()
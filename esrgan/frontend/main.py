@@ -1,15 +1,22 @@
-from typing import Optional, List, Callable
-from fastapi import FastAPI
-from nicegui import ui, events, app
+from typing import AsyncIterator, Dict, Optional, List, Callable, Tuple
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from nicegui import Client, ui, events, app, run
 from nicegui.binding import bindable_dataclass
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from loguru import logger
-from time import perf_counter
+from time import monotonic, perf_counter
+import asyncio
+import os
+import uuid
 
-from frontend.services import post_image
+from frontend import services
+from frontend.services import TLocalUpscaler, close_client, upscale_image
 from frontend.schemas import SingleImageUpscaleRequest
-from frontend.util import get_pil_image
+from frontend.util import read_aspect_ratio, thumbnails
+from frontend.store import QuotaExceededError, download_response, get_store
 from frontend.favicon import favicon
+from server.zipstream import stream_zip
 
 model_list: List[str] = [
     "RealESRGAN_x4plus",
@@ -19,19 +26,40 @@ model_list: List[str] = [
     "realesr-general-x4v3"
 ]
 
+# images of a tab that are upscaled at the same time, the others wait in the tab's queue
+UI_CONCURRENCY: int = int(os.environ.get("ESRGAN_UI_CONCURRENCY", 2))
+
 @dataclass
 class Image:
-    data: bytes
+    # id in the result store, the bytes are not kept in the tab state
+    id: str
     name: str
     type: str
+    # width / height, reserves the space of images that are not loaded yet
+    ratio: Optional[float] = None
+
+    def data(self) -> bytes:
+        return get_store().read(self.id)
+
+    def thumbnail_url(self) -> Optional[str]:
+        """None once the image was evicted from the store"""
+        try:
+            get_store().get(self.id)
+        except FileNotFoundError:
+            return None
+        return f"/thumbnails/{self.id}"
 
 @bindable_dataclass
 class UpscaleRequest:
+    # source of a queued upscale
     image: Optional[Image] = None
+    # selection of the control pane, one upscale is queued per image
+    images: List[Image] = field(default_factory=list)
     outscale: str = "4x"
     model: str = "RealESRGAN_x4plus"
     face_enhance: bool = False
     denoise_strength: float = 0.5
+    plan_policy: str = "exact"
 
     def outscale_to_int(self) -> int:
         mapping = {
@@ -41,12 +69,15 @@ class UpscaleRequest:
         }
         return mapping[self.outscale]
 
-@dataclass
+@dataclass(eq=False)
 class UpscaledImage:
     params: UpscaleRequest
     time_taken: Optional[float] = None
     result: Optional[Image] = None
     error: Optional[str] = None
+    status: str = "queued" # running, done, failed
+    # set once done or failed
+    finished: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
 
 class State:
     @staticmethod
@@ -67,6 +98,38 @@ class State:
 
         return State.__storage_backend()["upscale_results"]
 
+    @staticmethod
+    def queue() -> asyncio.Semaphore:
+        if not "upscale_queue" in State.__storage_backend():
+            State.__storage_backend()["upscale_queue"] = asyncio.Semaphore(UI_CONCURRENCY)
+
+        return State.__storage_backend()["upscale_queue"]
+
+    @staticmethod
+    def result_list() -> "ResultList":
+        # elements belong to the connected client, not to the tab
+        return app.storage.client["result_list"]
+
+    @staticmethod
+    def session() -> str:
+        # generated by the server, the tab id is sent by the browser and names a directory of the store
+        if not "session" in State.__storage_backend():
+            State.__storage_backend()["session"] = uuid.uuid4().hex
+
+        return State.__storage_backend()["session"]
+
+    @staticmethod
+    def is_referenced(image: Image) -> bool:
+        return any(selected.id == image.id for selected in State.upscale_request().images) or any(
+            upscaled.params.image.id == image.id for upscaled in State.results()
+        )
+
+def release_image(image: Image) -> None:
+    """Removes an image from the store once nothing in the tab refers to it anymore"""
+    if not State.is_referenced(image):
+        get_store().delete(image.id)
+        thumbnails.discard(image.id)
+
 async def handle_upscale_image(e: events.ClickEventArguments) -> None:
     logger.debug("Starting event handler")
     settings = State.upscale_request()
@@ -74,47 +137,88 @@ async def handle_upscale_image(e: events.ClickEventArguments) -> None:
         model_name=settings.model,
         denoise_strength=settings.denoise_strength,
         outscale=settings.outscale_to_int(),
-        face_enhance=settings.face_enhance
+        face_enhance=settings.face_enhance,
+        plan_policy=settings.plan_policy
     )
-    upscaled_image = UpscaledImage(
-        UpscaleRequest(
-            Image(
-                settings.image.data,
-                settings.image.name,
-                settings.image.type
-            ),
-            settings.outscale,
-            settings.model,
-            settings.face_enhance,
-            settings.denoise_strength
+    queued: List[UpscaledImage] = []
+    for image in settings.images:
+        upscaled_image = UpscaledImage(
+            UpscaleRequest(
+                image,
+                [],
+                settings.outscale,
+                settings.model,
+                settings.face_enhance,
+                settings.denoise_strength,
+                settings.plan_policy
+            )
         )
-    )
-    State.results().append(upscaled_image)
-    done_list.refresh()
-
-    ui.notify(f"'{settings.image.name}' started")
-    start = perf_counter()
-    logger.debug("Start of upload")
-    try:
-        upscaled_image_bytes = await post_image(settings.image.data, settings.image.name, settings.image.type, params)
-        logger.debug("End of upload")
-        upscaled_image.result = Image(upscaled_image_bytes, settings.image.name, settings.image.type)
-        end = perf_counter()
-        ui.notify(f"'{settings.image.name}' upscaled")
-        upscaled_image.time_taken = end - start
-    except Exception as e:
-        upscaled_image.error = str(e)
-        ui.notify(f"{settings.image.name} failed, details = {e}")
-    finally:
-        done_list.refresh()
+        State.results().append(upscaled_image)
+        State.result_list().add(upscaled_image)
+        # the source must not be evicted while the job waits for its turn, run_upscale unpins it
+        get_store().pin(image.id)
+        queued.append(upscaled_image)
+
+    ui.notify(f"{len(queued)} image(s) queued")
+    client = ui.context.client
+    await asyncio.gather(*(run_upscale(upscaled_image, params, client) for upscaled_image in queued))
+
+async def run_upscale(upscaled_image: UpscaledImage, params: SingleImageUpscaleRequest, client: Client) -> None:
+    """Waits for a free slot of the tab's queue, then upscales"""
+    # runs in its own task, without the slot of the click handler
+    with client:
+        result_list = State.result_list()
+        session = State.session()
+        source = upscaled_image.params.image
+        try:
+            async with State.queue():
+                if upscaled_image not in State.results():
+                    # deleted while queued
+                    return
+                upscaled_image.status = "running"
+                result_list.update(upscaled_image)
+
+                start = perf_counter()
+                logger.debug("Start of upload")
+                try:
+                    source_bytes = await run.io_bound(source.data)
+                    upscaled_image_bytes = await upscale_image(source_bytes, source.name, source.type, params)
+                    logger.debug("End of upload")
+                    result_id = await run.io_bound(
+                        get_store().put, session, upscaled_image_bytes, source.name, source.type
+                    )
+                    upscaled_image.result = Image(result_id, source.name, source.type, source.ratio)
+                    end = perf_counter()
+                    ui.notify(f"'{source.name}' upscaled")
+                    upscaled_image.time_taken = end - start
+                    upscaled_image.status = "done"
+                except Exception as e:
+                    upscaled_image.error = str(e)
+                    upscaled_image.status = "failed"
+                    ui.notify(f"{source.name} failed, details = {e}")
+        finally:
+            get_store().unpin(source.id)
+            upscaled_image.finished.set()
+            result_list.update(upscaled_image)
+            if upscaled_image not in State.results() and upscaled_image.result is not None:
+                # deleted while running
+                release_image(upscaled_image.result)
 
 def delete_upscaled_image(to_delete: UpscaledImage) -> None:
     State.results().remove(to_delete)
-    done_list.refresh()
+    State.result_list().remove(to_delete)
+    if to_delete.result is not None:
+        release_image(to_delete.result)
+    release_image(to_delete.params.image)
 
 def delete_all_upscaled_images() -> None:
+    deleted = list(State.results())
     State.results().clear()
-    done_list.refresh()
+    State.result_list().clear()
+    for upscaled in deleted:
+        if upscaled.result is not None:
+            release_image(upscaled.result)
+        release_image(upscaled.params.image)
 
 def settings_tooltip(settings: UpscaleRequest, time_taken: Optional[float]) -> None:
     with ui.icon("settings", size="sm"):
@@ -132,6 +236,9 @@ def settings_tooltip(settings: UpscaleRequest, time_taken: Optional[float]) -> N
                 ui.label("Denoise Strength:")
                 ui.label(settings.denoise_strength)
 
+                ui.label("Policy:")
+                ui.label(settings.plan_policy)
+
                 if time_taken:
                     ui.label("Processing Time:")
                     ui.label(f"{time_taken:.1f}s")
@@ -139,13 +246,18 @@ def settings_tooltip(settings: UpscaleRequest, time_taken: Optional[float]) -> N
 def output_image(upscaled: UpscaledImage) -> None:
     with ui.card().tight().classes("w-full"):
         if(upscaled.result):
-            pil_image = get_pil_image(upscaled.result.data)
-            ui.image(pil_image)
+            # the full resolution image is only sent on download, streamed from the store
+            thumbnail = upscaled.result.thumbnail_url()
+            if thumbnail is not None:
+                lazy_image(thumbnail, upscaled.result.ratio)
             with ui.card_section():
                 with ui.row(align_items="center").classes("flex content-between"):
                     ui.label(f"Filename: {upscaled.result.name}").classes("text-md")
                     settings_tooltip(upscaled.params, upscaled.time_taken)
-                    ui.button(f"Download", icon="download", on_click=lambda : ui.download.content(upscaled.result.data, upscaled.result.name, upscaled.result.type))
+                    if thumbnail is not None:
+                        ui.button("Download", icon="download", on_click=lambda : ui.download(f"/results/{upscaled.result.id}", upscaled.result.name))
+                    else:
+                        ui.label("Expired").classes("text-md")
                     ui.button("Delete", icon="delete", on_click=lambda x: delete_upscaled_image(upscaled))
 
         elif(upscaled.error):
@@ -157,38 +269,119 @@ def output_image(upscaled: UpscaledImage) -> None:
                 with ui.row():
                     ui.label(f"Error: {upscaled.error}")
         else:
-            ui.skeleton().classes("w-full h-[30em]")
+            ui.skeleton(animation="wave" if upscaled.status == "running" else "none").classes("w-full h-[30em]")
             with ui.card_section():
-                with ui.row():
+                with ui.row(align_items="center"):
                     ui.label(f"{upscaled.params.image.name}")
                     settings_tooltip(upscaled.params, upscaled.time_taken)
+                    if upscaled.status == "running":
+                        ui.spinner()
+                    ui.label(upscaled.status.capitalize()).classes("text-md")
+
+def lazy_image(url: str, ratio: Optional[float]) -> ui.image:
+    """Only fetched by the browser once it scrolls into view"""
+    image = ui.image(url).props("loading=lazy")
+    if ratio is not None:
+        image.props(f"ratio={ratio}")
+    return image
+
+class ResultList:
+    """Result cards of a tab, newest first. Changes only render the card of the affected result"""
+
+    def __init__(self) -> None:
+        self.cards: Dict[UpscaledImage, ui.column] = {}
+        with ui.column().classes("w-full h-[40em] p-2") as self.placeholder:
+            with ui.card().classes("w-full h-full flex items-center justify-center"):
+                ui.label('No Images Upscaled yet').classes("text-lg")
+        self.container = ui.column().classes("w-full")
+        for upscaled in State.results():
+            self.add(upscaled)
+
+    def add(self, upscaled: UpscaledImage) -> None:
+        with self.container:
+            card = ui.column().classes("w-full")
+        card.move(target_index=0)
+        self.cards[upscaled] = card
+        self.placeholder.set_visibility(False)
+        self.update(upscaled)
+
+    def update(self, upscaled: UpscaledImage) -> None:
+        card = self.cards.get(upscaled)
+        # the page may have been closed or reloaded while the result was processed
+        if card is None or card.is_deleted:
+            return
+        card.clear()
+        with card:
+            output_image(upscaled)
+
+    def remove(self, upscaled: UpscaledImage) -> None:
+        card = self.cards.pop(upscaled, None)
+        if card is not None:
+            card.delete()
+        self.placeholder.set_visibility(not self.cards)
+
+    def clear(self) -> None:
+        self.container.clear()
+        self.cards.clear()
+        self.placeholder.set_visibility(True)
 
 def handle_upload(e: events.UploadEventArguments) -> None:
-    image_bytes = e.content.read()
-    State.upscale_request().image = Image(image_bytes, e.name, e.type)
-    image_upload.refresh(State.upscale_request().image)
+    # called once per file
+    settings = State.upscale_request()
+    ratio = read_aspect_ratio(e.content)
+    try:
+        image_id = get_store().put(State.session(), e.content, e.name, e.type)
+    except QuotaExceededError as error:
+        ui.notify(str(error))
+        return
+    settings.images = [*settings.images, Image(image_id, e.name, e.type, ratio)]
+    selected_images.refresh(settings.images)
+
+def clear_selected_images(upload: ui.upload) -> None:
+    settings = State.upscale_request()
+    cleared = settings.images
+    settings.images = []
+    for image in cleared:
+        release_image(image)
+    upload.reset()
+    selected_images.refresh(settings.images)
 
 @ui.refreshable
-def image_upload(current_image: Optional[Image]) -> None:
+def selected_images(images: List[Image]) -> None:
+    previews = [(image, image.thumbnail_url()) for image in images]
+    previews = [(image, url) for image, url in previews if url is not None]
+    if len(previews) == 1:
+        image, url = previews[0]
+        lazy_image(url, image.ratio).classes("w-full")
+    elif len(previews) > 1:
+        with ui.column().classes("w-full h-[30em] overflow-y-auto gap-1"):
+            ui.label(f"{len(previews)} images selected")
+            with ui.grid(columns=3).classes("w-full gap-1"):
+                for image, url in previews:
+                    lazy_image(url, image.ratio).classes("w-full").tooltip(image.name)
+    else:
+        with ui.card().classes("w-full flex items-center justify-center h-[30em]"):
+            ui.label('No Image Selected')
+
+def image_upload(images: List[Image]) -> None:
     with ui.column().classes('w-full gap-2 h-full'):
-        if current_image is not None:
-            ui.image(get_pil_image(current_image.data)).classes("w-full")
-        else:
-            with ui.card().classes("w-full flex items-center justify-center h-[30em]"):
-                ui.label('No Image Selected')
+        selected_images(images)
+        # outside of the refreshable, refreshing would delete the uploader while it is uploading the other files
         with ui.row().classes('w-full h-[3.5em] overflow-hidden rounded-xl'):
-            ui.upload(on_upload=handle_upload, label="Source Image", auto_upload=True, max_files=1).props('accept=.jpg,.jpeg,.png').classes("w-full")
+            upload = ui.upload(on_upload=handle_upload, label="Source Images", auto_upload=True, multiple=True).props('accept=.jpg,.jpeg,.png').classes("w-full")
+        ui.button("Clear selection", icon="clear", on_click=lambda: clear_selected_images(upload)).bind_enabled_from(State.upscale_request(), "images", lambda images: len(images) > 0).classes("w-full")
 
 def control_pane() -> None:
     settings = State.upscale_request()
     with ui.card().classes("min-w-[20em] max-w-[30em] w-[20vw] h-[90vh]"):
         with ui.column().classes("w-full h-full items-stretch"):
             with ui.column().classes():
-                image_upload(settings.image)
+                image_upload(settings.images)
 
             with ui.column().classes():
                 ui.select(model_list, label="Upscaling Model").bind_value(settings, "model").classes("w-full")
                 ui.select(["4x", "2x", "1x"], label="Outscale", value="4x").bind_value(settings, "outscale").classes("w-full")
+                ui.select({"exact": "Exact (requested model)", "fast": "Fast (cheaper route for 2x/1x)"}, label="Policy", value="exact").bind_value(settings, "plan_policy").classes("w-full")
                 with ui.row(align_items="center").classes("w-full"):
                     ui.label().bind_text_from(State.upscale_request(), "denoise_strength", lambda val: f"Denoise Strength [{val:.2f}]:")
                     with ui.row().classes("grow"):
@@ -196,19 +389,11 @@ def control_pane() -> None:
 
                 ui.checkbox(text="Face Enhancement", value=False).bind_value(settings, "face_enhance").classes("w-full mx-0")
 
-                ui.button("Upscale", on_click=handle_upscale_image).bind_enabled_from(settings, "image",  lambda img : img is not None).classes("w-full")
+                ui.button("Upscale", on_click=handle_upscale_image).bind_enabled_from(settings, "images",  lambda images : len(images) > 0).classes("w-full")
 
-                ui.button("Delete all", icon="delete", on_click=lambda x: delete_all_upscaled_images()).classes("w-full")
+                ui.button("Download all (ZIP)", icon="folder_zip", on_click=lambda x: download_all_upscaled_images()).classes("w-full")
 
-@ui.refreshable
-def done_list() -> None:
-    if len(State.results()) == 0:
-        with ui.column().classes("w-full h-[40em] p-2"):
-            with ui.card().classes("w-full h-full flex items-center justify-center"):
-                ui.label('No Images Upscaled yet').classes("text-lg")
-    # Show newest images first
-    for item in reversed(State.results()):
-        output_image(item)
+                ui.button("Delete all", icon="delete", on_click=lambda x: delete_all_upscaled_images()).classes("w-full")
 
 def header() -> None:
     with ui.header().classes("flex flex-row items-center py-[0.75em] px-[4em]"):
@@ -216,6 +401,76 @@ def header() -> None:
             ui.label("Real-ESRGAN Web UI").classes("text-xl")
             ui.icon("zoom_out_map", size="2em")
 
+app.on_shutdown(close_client)
+
+@app.get("/results/{file_id}")
+def download_result(file_id: str):
+    return download_response(get_store(), file_id)
+
+# one time tokens of the ZIP downloads, to their creation time and the results they contain. Tokens of downloads that
+# never started are dropped after ZIP_DOWNLOAD_TTL_S, so that they do not keep the results alive
+ZIP_DOWNLOAD_TTL_S: float = 600
+zip_downloads: Dict[str, Tuple[float, List[UpscaledImage]]] = {}
+
+def expire_zip_downloads(now: Optional[float] = None) -> None:
+    deadline = (monotonic() if now is None else now) - ZIP_DOWNLOAD_TTL_S
+    for token in [token for token, (created, _) in zip_downloads.items() if created < deadline]:
+        del zip_downloads[token]
+
+def download_all_upscaled_images() -> None:
+    """Queued and running results are added to the archive as they complete"""
+    upscaled_images = [upscaled for upscaled in State.results() if upscaled.status != "failed"]
+    if not upscaled_images:
+        ui.notify("No images to download")
+        return
+    expire_zip_downloads()
+    token = uuid.uuid4().hex
+    zip_downloads[token] = (monotonic(), upscaled_images)
+    ui.download(f"/results/zip/{token}", "upscaled.zip")
+
+async def completed_results(upscaled_images: List[UpscaledImage]) -> AsyncIterator[Tuple[str, str]]:
+    """(name, path) of the stored results, in the order they complete"""
+    waiting = {asyncio.ensure_future(upscaled.finished.wait()): upscaled for upscaled in upscaled_images}
+    try:
+        while waiting:
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for wait in done:
+                upscaled = waiting.pop(wait)
+                if upscaled.result is None:
+                    continue
+                try:
+                    yield upscaled.result.name, get_store().get(upscaled.result.id).path
+                except FileNotFoundError:
+                    logger.warning(f"'{upscaled.result.name}' is not stored anymore, skipped from the archive")
+    finally:
+        for wait in waiting:
+            wait.cancel()
+
+@app.get("/results/zip/{token}")
+def download_results_zip(token: str) -> StreamingResponse:
+    expire_zip_downloads()
+    download = zip_downloads.pop(token, None)
+    if download is None:
+        raise HTTPException(status_code=404, detail="Unknown download")
+    _, upscaled_images = download
+    return StreamingResponse(
+        stream_zip(completed_results(upscaled_images)),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=\"upscaled.zip\""}
+    )
+
+@app.get("/thumbnails/{file_id}")
+async def download_thumbnail(file_id: str) -> Response:
+    try:
+        get_store().get(file_id)
+        thumbnail = await run.io_bound(thumbnails.get, file_id, lambda: get_store().read(file_id))
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    # ids are never reused, the content of a thumbnail does not change
+    return Response(
+        thumbnail.data, media_type=thumbnail.type, headers={"Cache-Control": "private, max-age=86400, immutable"}
+    )
+
 @ui.page("/")
 async def main_page() -> None:
     await ui.context.client.connected()
@@ -225,10 +480,12 @@ async def main_page() -> None:
         control_pane()
 
         with ui.column().classes("grow overflow-y-auto"):
-            done_list()
+            app.storage.client["result_list"] = ResultList()
 
-def init_frontend(app: FastAPI) -> None:
+def init_frontend(app: FastAPI, upscaler: Optional[TLocalUpscaler] = None) -> None:
+    """upscaler submits in-process, unless ESRGAN_BACKEND_URL points the UI to another server"""
     logger.info("Attaching UI")
+    services.local_upscaler = upscaler
     ui.run_with(
         app=app,
         title="Real-ESRGAN Web UI",
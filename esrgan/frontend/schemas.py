@@ -4,4 +4,5 @@ class SingleImageUpscaleRequest(BaseModel):
     model_name: str
     denoise_strength: float
     outscale: int
-    face_enhance: bool
\ No newline at end of file
+    face_enhance: bool
+    plan_policy: str
\ No newline at end of file
@@ -1,10 +1,37 @@
+from typing import Awaitable, Callable, Optional
+import os
 import httpx
 from httpx import Response
 from loguru import logger
 from frontend.schemas import SingleImageUpscaleRequest
 
+# Upscales in the same process, set by init_frontend when the UI is attached to the inference server
+TLocalUpscaler = Callable[[bytes, str, SingleImageUpscaleRequest], Awaitable[bytes]]
+local_upscaler: Optional[TLocalUpscaler] = None
+
+# When set, requests always go to this inference server over HTTP
+BACKEND_URL: Optional[str] = os.environ.get("ESRGAN_BACKEND_URL") or None
+
+# one client for all requests, keeps connections to the backend alive
+__client: Optional[httpx.AsyncClient] = None
+
 def get_upscaler_url(path: str) -> str:
-    return f"http://localhost:8000{path}"
+    return f"{(BACKEND_URL or 'http://localhost:8000').rstrip('/')}{path}"
+
+def get_client() -> httpx.AsyncClient:
+    global __client
+    if __client is None:
+        __client = httpx.AsyncClient(
+            timeout=None,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=16)
+        )
+    return __client
+
+async def close_client() -> None:
+    global __client
+    if __client is not None:
+        await __client.aclose()
+        __client = None
 
 async def post_image(
     file_contents: bytes,
@@ -15,12 +42,23 @@ async def post_image(
     assert filename is not None
     logger.info(f"Submitting upscale request, params=<{params.model_dump_json()}>")
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        resp: Response = await client.post(
-            get_upscaler_url("/upscale"),
-            data=params.model_dump(),
-            files=[('file', (filename, file_contents, filetype))]
-        )
-        logger.info(f"After response, code={resp.status_code}")
-        resp.raise_for_status()
-        return resp.content
+    resp: Response = await get_client().post(
+        get_upscaler_url("/upscale"),
+        data=params.model_dump(),
+        files=[('file', (filename, file_contents, filetype))]
+    )
+    logger.info(f"After response, code={resp.status_code}")
+    resp.raise_for_status()
+    return resp.content
+
+async def upscale_image(
+    file_contents: bytes,
+    filename: str,
+    filetype: str,
+    params: SingleImageUpscaleRequest
+) -> bytes:
+    """Submits to the inference queue of this process when possible, to the backend over HTTP otherwise"""
+    if local_upscaler is not None and BACKEND_URL is None:
+        logger.info(f"Submitting upscale request in-process, params=<{params.model_dump_json()}>")
+        return await local_upscaler(file_contents, filename, params)
+    return await post_image(file_contents, filename, filetype, params)
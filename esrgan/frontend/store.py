@@ -0,0 +1,168 @@
+"""
+Disk store for the web UI images (uploads and upscaled results).
+
+The tab state only references images by id, their bytes live in ESRGAN_RESULTS_DIR/esrgan-store/<session>/<id> and are
+downloaded through a streaming route (with Range support). A session (browser tab) may store up to
+ESRGAN_RESULTS_QUOTA_MB, its oldest images are evicted first to make room, and images not accessed for
+ESRGAN_RESULTS_TTL_S are removed. Images pinned by a queued or running upscale are neither evicted nor expired.
+The esrgan-store subdirectory is owned by the store: it is emptied on start, as tab state does not survive a restart.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from time import monotonic
+from typing import BinaryIO, Dict, List, Optional, Union
+import os
+import re
+import shutil
+import threading
+import uuid
+from fastapi import HTTPException
+from fastapi.responses import FileResponse
+from loguru import logger
+
+# the only part of ESRGAN_RESULTS_DIR the store writes to and empties
+STORE_DIR = "esrgan-store"
+SESSION_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+@dataclass
+class StoredFile:
+    id: str
+    session: str
+    path: str
+    name: str
+    type: str
+    size: int
+    created: float
+    accessed: float
+
+class QuotaExceededError(ValueError):
+    """The file does not fit in the session quota, even after evicting every image that is not pinned"""
+
+class ResultStore:
+    def __init__(self, root: str, quota: int, ttl: float) -> None:
+        self.root = os.path.join(root, STORE_DIR)
+        self.quota = quota # bytes per session
+        self.ttl = ttl # seconds
+        self.files: Dict[str, StoredFile] = {}
+        self.pins: Dict[str, int] = {} # file id -> number of jobs using it
+        self.lock = threading.Lock()
+
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def session_usage(self, session: str) -> int:
+        with self.lock:
+            return sum(file.size for file in self.files.values() if file.session == session)
+
+    def put(self, session: str, content: Union[bytes, BinaryIO], name: str, type: str) -> str:
+        """Stores content (bytes or a file object, copied in chunks) and returns its id"""
+        # the session names a directory, it must not be able to point outside of the store
+        if not SESSION_PATTERN.fullmatch(session):
+            raise ValueError(f"Invalid session id '{session}'")
+        file_id = uuid.uuid4().hex
+        session_dir = os.path.join(self.root, session)
+        os.makedirs(session_dir, exist_ok=True)
+        path = os.path.join(session_dir, file_id)
+
+        with open(f"{path}.part", "wb") as f:
+            if isinstance(content, bytes):
+                f.write(content)
+            else:
+                shutil.copyfileobj(content, f)
+        size = os.path.getsize(f"{path}.part")
+        if size > self.quota:
+            os.remove(f"{path}.part")
+            raise QuotaExceededError(f"'{name}' ({size} bytes) is larger than the session quota ({self.quota} bytes)")
+
+        with self.lock:
+            self.__expire()
+            session_files: List[StoredFile] = sorted(
+                (file for file in self.files.values() if file.session == session),
+                key=lambda file: file.created
+            )
+            usage = sum(file.size for file in session_files)
+            pinned = sum(file.size for file in session_files if file.id in self.pins)
+            if pinned + size > self.quota:
+                os.remove(f"{path}.part")
+                raise QuotaExceededError(
+                    f"'{name}' ({size} bytes) does not fit in the session quota ({self.quota} bytes), "
+                    f"{pinned} bytes are used by queued or running upscales"
+                )
+            for file in session_files:
+                if usage + size <= self.quota:
+                    break
+                if file.id in self.pins:
+                    continue
+                logger.info(f"Evicting '{file.id}' from session '{session}', over quota")
+                self.__remove(file)
+                usage -= file.size
+
+            os.replace(f"{path}.part", path)
+            now = monotonic()
+            self.files[file_id] = StoredFile(file_id, session, path, name, type, size, now, now)
+        return file_id
+
+    def get(self, file_id: str) -> StoredFile:
+        """Raises FileNotFoundError when the file was deleted, evicted or expired"""
+        with self.lock:
+            self.__expire()
+            file = self.files.get(file_id)
+            if file is None:
+                raise FileNotFoundError(f"'{file_id}' is not stored anymore")
+            file.accessed = monotonic()
+            return file
+
+    def pin(self, file_id: str) -> None:
+        """Keeps the file from being evicted or expired until it is unpinned, pins are counted"""
+        with self.lock:
+            self.pins[file_id] = self.pins.get(file_id, 0) + 1
+
+    def unpin(self, file_id: str) -> None:
+        with self.lock:
+            count = self.pins.pop(file_id, 0) - 1
+            if count > 0:
+                self.pins[file_id] = count
+
+    def read(self, file_id: str) -> bytes:
+        with open(self.get(file_id).path, "rb") as f:
+            return f.read()
+
+    def delete(self, file_id: str) -> None:
+        with self.lock:
+            file = self.files.get(file_id)
+            if file is not None:
+                self.__remove(file)
+
+    def expire(self, now: Optional[float] = None) -> None:
+        with self.lock:
+            self.__expire(now)
+
+    def __expire(self, now: Optional[float] = None) -> None:
+        deadline = (monotonic() if now is None else now) - self.ttl
+        for file in [file for file in self.files.values() if file.accessed < deadline and file.id not in self.pins]:
+            logger.info(f"Expiring '{file.id}' from session '{file.session}'")
+            self.__remove(file)
+
+    def __remove(self, file: StoredFile) -> None:
+        del self.files[file.id]
+        try:
+            os.remove(file.path)
+        except FileNotFoundError:
+            pass
+
+def download_response(store: ResultStore, file_id: str) -> FileResponse:
+    """Streams a stored file, with support for Range requests"""
+    try:
+        file = store.get(file_id)
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    return FileResponse(file.path, media_type=file.type, filename=file.name)
+
+@lru_cache(maxsize=None)
+def get_store() -> ResultStore:
+    return ResultStore(
+        root=os.environ.get("ESRGAN_RESULTS_DIR", f"{Path(__file__).parent.parent}/results"),
+        quota=int(os.environ.get("ESRGAN_RESULTS_QUOTA_MB", 1024)) * 2**20,
+        ttl=float(os.environ.get("ESRGAN_RESULTS_TTL_S", 24 * 3600))
+    )
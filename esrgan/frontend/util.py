@@ -1,8 +1,77 @@
-from functools import lru_cache
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Dict, NamedTuple, Optional
 from PIL import Image
 from io import BytesIO
+import os
+import threading
 
-@lru_cache(maxsize=64)
-def get_pil_image(image_bytes: bytes) -> Image:
-    pil_image = Image.open(BytesIO(image_bytes))
-    return pil_image
\ No newline at end of file
+class Thumbnail(NamedTuple):
+    data: bytes
+    type: str
+
+def make_thumbnail(data: bytes, max_side: int) -> Thumbnail:
+    """Downscaled copy of an image, JPEG unless it has transparency"""
+    pil_image = Image.open(BytesIO(data))
+    # lets JPEG decoding skip most of the full resolution work
+    pil_image.draft("RGB", (max_side, max_side))
+    pil_image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = BytesIO()
+    if pil_image.mode in ("RGBA", "LA", "P"):
+        mime = "image/png"
+        pil_image.save(buffer, format="PNG", optimize=True)
+    else:
+        mime = "image/jpeg"
+        pil_image.convert("RGB").save(buffer, format="JPEG", quality=85)
+    return Thumbnail(buffer.getvalue(), mime)
+
+def read_aspect_ratio(content: BinaryIO) -> Optional[float]:
+    """Width / height from the image header, the stream is rewound"""
+    try:
+        width, height = Image.open(content).size
+        return width / height
+    except Exception:
+        return None
+    finally:
+        content.seek(0)
+
+class ThumbnailCache:
+    """Least recently used display thumbnails, bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes: int, max_side: int = 768) -> None:
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.size = 0
+        self.entries: Dict[str, Thumbnail] = OrderedDict()
+        # thumbnails are served from a thread pool, they are created outside of the lock
+        self.lock = threading.Lock()
+
+    def get(self, image_id: str, load: Callable[[], bytes]) -> Thumbnail:
+        """load only runs on a miss, to read the full image"""
+        with self.lock:
+            if image_id in self.entries:
+                self.entries.move_to_end(image_id)
+                return self.entries[image_id]
+
+        thumbnail = make_thumbnail(load(), self.max_side)
+        with self.lock:
+            self.discard_locked(image_id)
+            self.entries[image_id] = thumbnail
+            self.size += len(thumbnail.data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.data)
+        return thumbnail
+
+    def discard(self, image_id: str) -> None:
+        with self.lock:
+            self.discard_locked(image_id)
+
+    def discard_locked(self, image_id: str) -> None:
+        if image_id in self.entries:
+            self.size -= len(self.entries.pop(image_id).data)
+
+thumbnails = ThumbnailCache(
+    max_bytes=int(os.environ.get("ESRGAN_THUMBNAIL_CACHE_MB", 64)) * 2**20,
+    max_side=int(os.environ.get("ESRGAN_THUMBNAIL_SIZE", 768))
+)
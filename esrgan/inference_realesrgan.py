@@ -1,61 +1,24 @@
 import argparse
-import cv2
 import glob
 import os
+import queue
+import threading
+import time
+import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
 
 from realesrgan import RealESRGANer
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.archs.srvgg_arch import SRVGGNetCompactInference
+from realesrgan.utils import IOConsumer, PrefetchReader, StageStats
 
 
-def main():
-    """Inference demo for Real-ESRGAN.
-    """
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', type=str, default='inputs', help='Input image or folder')
-    parser.add_argument(
-        '-n',
-        '--model_name',
-        type=str,
-        default='RealESRGAN_x4plus',
-        help=('Model names: RealESRGAN_x4plus | RealESRNet_x4plus | RealESRGAN_x4plus_anime_6B | RealESRGAN_x2plus | '
-              'realesr-animevideov3 | realesr-general-x4v3'))
-    parser.add_argument('-o', '--output', type=str, default='results', help='Output folder')
-    parser.add_argument(
-        '-dn',
-        '--denoise_strength',
-        type=float,
-        default=0.5,
-        help=('Denoise strength. 0 for weak denoise (keep noise), 1 for strong denoise ability. '
-              'Only used for the realesr-general-x4v3 model'))
-    parser.add_argument('-s', '--outscale', type=float, default=4, help='The final upsampling scale of the image')
-    parser.add_argument(
-        '--model_path', type=str, default=None, help='[Option] Model path. Usually, you do not need to specify it')
-    parser.add_argument('--suffix', type=str, default='out', help='Suffix of the restored image')
-    parser.add_argument('-t', '--tile', type=int, default=0, help='Tile size, 0 for no tile during testing')
-    parser.add_argument('--tile_pad', type=int, default=10, help='Tile padding')
-    parser.add_argument('--pre_pad', type=int, default=0, help='Pre padding size at each border')
-    parser.add_argument('--face_enhance', action='store_true', help='Use GFPGAN to enhance face')
-    parser.add_argument(
-        '--fp32', action='store_true', help='Use fp32 precision during inference. Default: fp16 (half precision).')
-    parser.add_argument(
-        '--alpha_upsampler',
-        type=str,
-        default='realesrgan',
-        help='The upsampler for the alpha channels. Options: realesrgan | bicubic')
-    parser.add_argument(
-        '--ext',
-        type=str,
-        default='auto',
-        help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs')
-    parser.add_argument(
-        '-g', '--gpu-id', type=int, default=None, help='gpu device to use (default=None) can be 0,1,2 for multi-gpu')
-
-    args = parser.parse_args()
+def build_upsampler(args):
+    """Builds the upsampler, and the face enhancer with --face_enhance (None otherwise).
 
+    Both keep the state of the image they process, so each inference worker has its own.
+    """
     # determine models according to model names
-    args.model_name = args.model_name.split('.')[0]
     if args.model_name == 'RealESRGAN_x4plus':  # x4 RRDBNet model
         model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
         netscale = 4
@@ -73,11 +36,13 @@ def main():
         netscale = 2
         file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth']
     elif args.model_name == 'realesr-animevideov3':  # x4 VGG-style model (XS size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
+        model = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
         netscale = 4
         file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth']
     elif args.model_name == 'realesr-general-x4v3':  # x4 VGG-style model (S size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
+        model = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
         netscale = 4
         file_url = [
             'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-wdn-x4v3.pth',
@@ -112,9 +77,10 @@ def main():
         tile=args.tile,
         tile_pad=args.tile_pad,
         pre_pad=args.pre_pad,
-        half=not args.fp32,
+        precision=args.precision or ('fp32' if args.fp32 else 'auto'),
         gpu_id=args.gpu_id)
 
+    face_enhancer = None
     if args.face_enhance:  # Use GFPGAN for face enhancement
         from gfpgan import GFPGANer
         face_enhancer = GFPGANer(
@@ -123,6 +89,87 @@ def main():
             arch='clean',
             channel_multiplier=2,
             bg_upsampler=upsampler)
+    return upsampler, face_enhancer
+
+
+def main():
+    """Inference demo for Real-ESRGAN.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='inputs', help='Input image or folder')
+    parser.add_argument(
+        '-n',
+        '--model_name',
+        type=str,
+        default='RealESRGAN_x4plus',
+        help=('Model names: RealESRGAN_x4plus | RealESRNet_x4plus | RealESRGAN_x4plus_anime_6B | RealESRGAN_x2plus | '
+              'realesr-animevideov3 | realesr-general-x4v3'))
+    parser.add_argument('-o', '--output', type=str, default='results', help='Output folder')
+    parser.add_argument(
+        '-dn',
+        '--denoise_strength',
+        type=float,
+        default=0.5,
+        help=('Denoise strength. 0 for weak denoise (keep noise), 1 for strong denoise ability. '
+              'Only used for the realesr-general-x4v3 model'))
+    parser.add_argument('-s', '--outscale', type=float, default=4, help='The final upsampling scale of the image')
+    parser.add_argument(
+        '--model_path', type=str, default=None, help='[Option] Model path. Usually, you do not need to specify it')
+    parser.add_argument('--suffix', type=str, default='out', help='Suffix of the restored image')
+    parser.add_argument('-t', '--tile', type=int, default=0, help='Tile size, 0 for no tile during testing')
+    parser.add_argument('--tile_pad', type=int, default=10, help='Tile padding')
+    parser.add_argument('--pre_pad', type=int, default=0, help='Pre padding size at each border')
+    parser.add_argument('--face_enhance', action='store_true', help='Use GFPGAN to enhance face')
+    parser.add_argument(
+        '--fp32', action='store_true', help='Use fp32 precision during inference. Shorthand for --precision fp32')
+    parser.add_argument(
+        '--precision',
+        type=str,
+        default=None,
+        choices=['fp32', 'fp16', 'bf16', 'int8', 'auto'],
+        help=('Inference precision. auto: fp16 on CUDA, bf16 on CPUs with native bf16 support, fp32 otherwise. '
+              'Default: auto, fp32 if --fp32 is set'))
+    parser.add_argument(
+        '--alpha_upsampler',
+        type=str,
+        default='realesrgan',
+        help='The upsampler for the alpha channels. Options: realesrgan | bicubic')
+    parser.add_argument(
+        '--ext',
+        type=str,
+        default='auto',
+        help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs')
+    parser.add_argument(
+        '-g', '--gpu-id', type=int, default=None, help='gpu device to use (default=None) can be 0,1,2 for multi-gpu')
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=1,
+        help='Number of inference workers, each with its own copy of the model. Useful on CPU hosts. Default: 1')
+    parser.add_argument(
+        '--threads_per_worker',
+        type=int,
+        default=0,
+        help=('Torch threads of each inference worker when there are several. 0 splits the CPUs evenly between the '
+              'workers. Default: 0'))
+    parser.add_argument(
+        '--read_queue_size', type=int, default=4, help='Number of images read ahead of inference. Default: 4')
+    parser.add_argument('--num_writers', type=int, default=2, help='Number of image writer threads. Default: 2')
+    parser.add_argument(
+        '--write_queue_size',
+        type=int,
+        default=4,
+        help='Number of upsampled images waiting for a writer, inference waits when it is full. Default: 4')
+
+    args = parser.parse_args()
+    args.model_name = args.model_name.split('.')[0]
+
+    if args.num_workers > 1:
+        # the workers share the CPU threads
+        num_threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.num_workers)
+        torch.set_num_threads(num_threads)
+        print(f'{args.num_workers} inference workers with {num_threads} threads each')
+    workers = [build_upsampler(args) for _ in range(args.num_workers)]
     os.makedirs(args.output, exist_ok=True)
 
     if os.path.isfile(args.input):
@@ -130,36 +177,89 @@ def main():
     else:
         paths = sorted(glob.glob(os.path.join(args.input, '*')))
 
-    for idx, path in enumerate(paths):
-        imgname, extension = os.path.splitext(os.path.basename(path))
-        print('Testing', idx, imgname)
-
-        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-        if len(img.shape) == 3 and img.shape[2] == 4:
-            img_mode = 'RGBA'
-        else:
-            img_mode = None
+    # read -> inference workers -> writers, connected by bounded queues
+    reader = PrefetchReader(paths, args.read_queue_size)
+    reader.daemon = True  # does not block the exit when the workers fail
+    images = enumerate(reader)
+    images_lock = threading.Lock()
+    save_que = queue.Queue(args.write_queue_size)
+    writers = [IOConsumer(args, save_que, i) for i in range(args.num_writers)]
+    worker_stats = [StageStats(f'inference {i}') for i in range(args.num_workers)]
+    errors = []
 
+    def infer(worker):
+        upsampler, face_enhancer = workers[worker]
+        stats = worker_stats[worker]
         try:
-            if args.face_enhance:
-                _, _, output = face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
-            else:
-                output, _ = upsampler.enhance(img, outscale=args.outscale)
-        except RuntimeError as error:
-            print('Error', error)
-            print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
-        else:
-            if args.ext == 'auto':
-                extension = extension[1:]
-            else:
-                extension = args.ext
-            if img_mode == 'RGBA':  # RGBA images should be saved in png format
-                extension = 'png'
-            if args.suffix == '':
-                save_path = os.path.join(args.output, f'{imgname}.{extension}')
-            else:
-                save_path = os.path.join(args.output, f'{imgname}_{args.suffix}.{extension}')
-            cv2.imwrite(save_path, output)
+            while True:
+                start = time.perf_counter()
+                with images_lock:
+                    idx, img = next(images, (None, None))
+                stats.wait += time.perf_counter() - start
+                if idx is None:
+                    break
+
+                imgname, extension = os.path.splitext(os.path.basename(paths[idx]))
+                print('Testing', idx, imgname)
+                if img is None:
+                    print('Error', f'cannot read {paths[idx]}')
+                    continue
+                if len(img.shape) == 3 and img.shape[2] == 4:
+                    img_mode = 'RGBA'
+                else:
+                    img_mode = None
+
+                start = time.perf_counter()
+                try:
+                    if args.face_enhance:
+                        _, _, output = face_enhancer.enhance(
+                            img, has_aligned=False, only_center_face=False, paste_back=True)
+                    else:
+                        output, _ = upsampler.enhance(img, outscale=args.outscale)
+                except RuntimeError as error:
+                    output = None
+                    print('Error', error)
+                    print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
+                stats.busy += time.perf_counter() - start
+                if output is None:
+                    continue
+
+                if args.ext == 'auto':
+                    extension = extension[1:]
+                else:
+                    extension = args.ext
+                if img_mode == 'RGBA':  # RGBA images should be saved in png format
+                    extension = 'png'
+                if args.suffix == '':
+                    save_path = os.path.join(args.output, f'{imgname}.{extension}')
+                else:
+                    save_path = os.path.join(args.output, f'{imgname}_{args.suffix}.{extension}')
+                stats.items += 1
+                start = time.perf_counter()
+                save_que.put({'output': output, 'save_path': save_path})
+                stats.wait += time.perf_counter() - start
+        except BaseException as error:
+            errors.append(error)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=infer, args=(i, )) for i in range(args.num_workers)]
+    for thread in [reader] + writers + threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for _ in writers:
+        save_que.put('quit')
+    for writer in writers:
+        writer.join()
+    duration = time.perf_counter() - start
+
+    num_images = sum(stats.items for stats in worker_stats)
+    print(f'{num_images} images in {duration:.2f}s ({num_images / duration:.2f} images/s), time per stage:')
+    for stats in [reader.stats] + worker_stats + [writer.stats for writer in writers]:
+        print(f'  {stats}')
+    errors += [error for writer in writers for error in writer.errors]
+    if errors:
+        raise errors[0]
 
 
 if __name__ == '__main__':
@@ -4,8 +4,10 @@ import glob
 import mimetypes
 import numpy as np
 import os
+import queue
 import shutil
 import subprocess
+import time
 import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
@@ -13,7 +15,9 @@ from os import path as osp
 from tqdm import tqdm
 
 from realesrgan import RealESRGANer
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.archs.srvgg_arch import SRVGGNetCompactInference
+from realesrgan.utils import Pipeline
+from realesrgan.video import DuplicateFrameDetector, FrameBatcher, SegmentManifest, TemporalTileCache, shard_ranges
 
 try:
     import ffmpeg
@@ -32,31 +36,27 @@ def get_video_meta_info(video_path):
     ret['height'] = video_streams[0]['height']
     ret['fps'] = eval(video_streams[0]['avg_frame_rate'])
     ret['audio'] = ffmpeg.input(video_path).audio if has_audio else None
-    ret['nb_frames'] = int(video_streams[0]['nb_frames'])
+    if 'nb_frames' in video_streams[0]:
+        ret['nb_frames'] = int(video_streams[0]['nb_frames'])
+    else:
+        # some containers (e.g. mkv, webm) do not store it, count the frames by decoding
+        probe = ffmpeg.probe(video_path, count_frames=None, select_streams='v:0')
+        ret['nb_frames'] = int(probe['streams'][0]['nb_read_frames'])
     return ret
 
 
-def get_sub_video(args, num_process, process_idx):
-    if num_process == 1:
-        return args.input
-    meta = get_video_meta_info(args.input)
-    duration = int(meta['nb_frames'] / meta['fps'])
-    part_time = duration // num_process
-    print(f'duration: {duration}, part_time: {part_time}')
-    os.makedirs(osp.join(args.output, f'{args.video_name}_inp_tmp_videos'), exist_ok=True)
-    out_path = osp.join(args.output, f'{args.video_name}_inp_tmp_videos', f'{process_idx:03d}.mp4')
-    cmd = [
-        args.ffmpeg_bin, f'-i {args.input}', '-ss', f'{part_time * process_idx}',
-        f'-to {part_time * (process_idx + 1)}' if process_idx != num_process - 1 else '', '-async 1', out_path, '-y'
-    ]
-    print(' '.join(cmd))
-    subprocess.call(' '.join(cmd), shell=True)
-    return out_path
+def count_frames(args):
+    input_type = mimetypes.guess_type(args.input)[0]
+    if input_type is not None and input_type.startswith('video'):
+        return get_video_meta_info(args.input)['nb_frames']
+    if input_type is not None and input_type.startswith('image'):
+        return 1
+    return len(glob.glob(os.path.join(args.input, '*')))
 
 
 class Reader:
 
-    def __init__(self, args, total_workers=1, worker_idx=0):
+    def __init__(self, args, total_workers=1, worker_idx=0, frame_range=None):
         self.args = args
         input_type = mimetypes.guess_type(args.input)[0]
         self.input_type = 'folder' if input_type is None else input_type
@@ -64,26 +64,37 @@ class Reader:
         self.audio = None
         self.input_fps = None
         if self.input_type.startswith('video'):
-            video_path = get_sub_video(args, total_workers, worker_idx)
-            self.stream_reader = (
-                ffmpeg.input(video_path).output('pipe:', format='rawvideo', pix_fmt='bgr24',
-                                                loglevel='error').run_async(
-                                                    pipe_stdin=True, pipe_stdout=True, cmd=args.ffmpeg_bin))
-            meta = get_video_meta_info(video_path)
+            meta = get_video_meta_info(args.input)
             self.width = meta['width']
             self.height = meta['height']
             self.input_fps = meta['fps']
             self.audio = meta['audio']
             self.nb_frames = meta['nb_frames']
 
+            stream = ffmpeg.input(args.input)
+            if frame_range is None and total_workers > 1:
+                frame_range = shard_ranges(self.nb_frames, total_workers)[worker_idx]
+            if frame_range is not None:
+                # frame-accurate split: the input is seeked to the first frame of the range (half a frame early, so
+                # that rounding cannot skip it) instead of decoding the video from its start, then exactly the frames
+                # of the range are kept. The audio is added back when the shards are concatenated.
+                start, end = frame_range
+                if start > 0:
+                    stream = ffmpeg.input(args.input, ss=(start - 0.5) / self.input_fps)
+                stream = stream.trim(start_frame=0, end_frame=end - start).setpts('PTS-STARTPTS')
+                self.audio = None
+                self.nb_frames = end - start
+            self.stream_reader = (
+                stream.output('pipe:', format='rawvideo', pix_fmt='bgr24', loglevel='error').run_async(
+                    pipe_stdin=True, pipe_stdout=True, cmd=args.ffmpeg_bin))
+
         else:
             if self.input_type.startswith('image'):
                 self.paths = [args.input]
             else:
                 paths = sorted(glob.glob(os.path.join(args.input, '*')))
-                tot_frames = len(paths)
-                num_frame_per_worker = tot_frames // total_workers + (1 if tot_frames % total_workers else 0)
-                self.paths = paths[num_frame_per_worker * worker_idx:num_frame_per_worker * (worker_idx + 1)]
+                start, end = frame_range or shard_ranges(len(paths), total_workers)[worker_idx]
+                self.paths = paths[start:end]
 
             self.nb_frames = len(self.paths)
             assert self.nb_frames > 0, 'empty folder'
@@ -170,7 +181,14 @@ class Writer:
         self.stream_writer.wait()
 
 
-def inference_video(args, video_save_path, device=None, total_workers=1, worker_idx=0):
+def set_num_threads(num_threads):
+    if num_threads is not None:
+        # workers sharing the CPU each get their part of the threads
+        torch.set_num_threads(num_threads)
+        cv2.setNumThreads(num_threads)
+
+
+def build_upsampler(args, device=None):
     # ---------------------- determine models according to model names ---------------------- #
     args.model_name = args.model_name.split('.pth')[0]
     if args.model_name == 'RealESRGAN_x4plus':  # x4 RRDBNet model
@@ -190,11 +208,13 @@ def inference_video(args, video_save_path, device=None, total_workers=1, worker_
         netscale = 2
         file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth']
     elif args.model_name == 'realesr-animevideov3':  # x4 VGG-style model (XS size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
+        model = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
         netscale = 4
         file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth']
     elif args.model_name == 'realesr-general-x4v3':  # x4 VGG-style model (S size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
+        model = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
         netscale = 4
         file_url = [
             'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-wdn-x4v3.pth',
@@ -217,6 +237,10 @@ def inference_video(args, video_save_path, device=None, total_workers=1, worker_
         model_path = [model_path, wdn_model_path]
         dni_weight = [args.denoise_strength, 1 - args.denoise_strength]
 
+    if args.reuse_tiles and args.tile == 0:
+        print('--reuse_tiles works on tiles, we set --tile 256 for you.')
+        args.tile = 256
+
     # restorer
     upsampler = RealESRGANer(
         scale=netscale,
@@ -226,9 +250,12 @@ def inference_video(args, video_save_path, device=None, total_workers=1, worker_
         tile=args.tile,
         tile_pad=args.tile_pad,
         pre_pad=args.pre_pad,
-        half=not args.fp32,
+        precision=args.precision or ('fp32' if args.fp32 else 'auto'),
         device=device,
     )
+    if args.reuse_tiles:
+        # tiles whose padded input did not change since the previous frame reuse its output
+        upsampler.tile_cache = TemporalTileCache(args.reuse_threshold)
 
     if 'anime' in args.model_name and args.face_enhance:
         print('face_enhance is not supported in anime models, we turned this option off for you. '
@@ -245,35 +272,214 @@ def inference_video(args, video_save_path, device=None, total_workers=1, worker_
             bg_upsampler=upsampler)  # TODO support custom device
     else:
         face_enhancer = None
+    return upsampler, face_enhancer
+
+
+def upsample_video(args, upsampler, face_enhancer, reader, writer, progress=None):
+    """Upsamples the frames of reader to writer, progress is called with the number of frames done, if set."""
+    height, width = reader.get_resolution()
+
+    # consecutive frames of the same size are upsampled together
+    batch_size = args.batch_size
+    if args.face_enhance:
+        batch_size = 1
+    elif batch_size == 0:
+        batch_size = upsampler.estimate_batch_size(height, width, args.batch_memory * 2**20)
+        print(f'Batch size: {batch_size} frames (--batch_memory {args.batch_memory} MB)')
+
+    # frames repeating the previous upsampled frame reuse its output, repeats[i] is how often outputs[i] is written
+    detector = None if args.no_dedup else DuplicateFrameDetector(args.dedup_threshold)
+    read_batch = FrameBatcher(reader.get_frame, batch_size, detector)
+
+    inference = {'time': 0., 'frames': 0}
+
+    def enhance(batch):
+        frames, repeats = batch
+        start = time.perf_counter()
+        try:
+            if args.face_enhance:
+                outputs = [
+                    face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)[2]
+                    for img in frames
+                ]
+            else:
+                outputs = upsampler.enhance_batch(frames, outscale=args.outscale)
+        except RuntimeError as error:
+            print('Error', error)
+            print('If you encounter CUDA out of memory, try to set --tile or --batch_size with a smaller number.')
+            outputs = None
+        inference['time'] += time.perf_counter() - start
+        inference['frames'] += len(frames)
+        pbar.update(sum(repeats))
+        if progress is not None:
+            progress(sum(repeats))
+        postfix = {'batch': batch_size, 'inference_fps': f'{inference["frames"] / inference["time"]:.2f}'}
+        if detector is not None:
+            postfix['skipped'] = f'{detector.skip_ratio:.0%}'
+        pbar.set_postfix(postfix)
+        return None if outputs is None else (outputs, repeats)
+
+    def write(batch):
+        for output, repeat in zip(*batch):
+            for _ in range(repeat):
+                writer.write_frame(output)
+        return batch
+
+    # decode, inference and encode run in their own threads, the queues bound the number of batches in flight
+    pbar = tqdm(total=len(reader), unit='frame', desc='inference', disable=progress is not None)
+    pipeline = Pipeline([('decode', read_batch), ('inference', enhance), ('encode', write)],
+                        queue_sizes=[args.decode_queue_size, args.encode_queue_size])
+    pipeline.run()
+    pbar.close()
+    print(pipeline.report())
+    if detector is not None:
+        print(f'Skipped {detector.duplicates}/{detector.frames} duplicate frames ({detector.skip_ratio:.1%})')
+    if upsampler.tile_cache is not None:
+        tile_cache = upsampler.tile_cache
+        print(f'Reused {tile_cache.reused}/{tile_cache.reused + tile_cache.computed} tiles '
+              f'({tile_cache.reuse_ratio:.1%})')
+
+
+def inference_video(args, video_save_path, device=None, total_workers=1, worker_idx=0, num_threads=None, progress=None):
+    set_num_threads(num_threads)
+    upsampler, face_enhancer = build_upsampler(args, device)
 
     reader = Reader(args, total_workers, worker_idx)
     audio = reader.get_audio()
     height, width = reader.get_resolution()
     fps = reader.get_fps()
     writer = Writer(args, audio, height, width, video_save_path, fps)
+    upsample_video(args, upsampler, face_enhancer, reader, writer, progress)
+    reader.close()
+    writer.close()
 
-    pbar = tqdm(total=len(reader), unit='frame', desc='inference')
+
+def inference_segments(args, segments_dir, device=None, num_threads=None, progress=None):
+    """Upsamples the segments of the manifest in segments_dir that are neither done nor held by another worker."""
+    set_num_threads(num_threads)
+    upsampler, face_enhancer = build_upsampler(args, device)
+    manifest = SegmentManifest(segments_dir, args.segment_lock_timeout)
     while True:
-        img = reader.get_frame()
-        if img is None:
+        segment = manifest.claim()
+        if segment is None:
             break
 
+        index = segment['index']
+        start = time.perf_counter()
         try:
-            if args.face_enhance:
-                _, _, output = face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
-            else:
-                output, _ = upsampler.enhance(img, outscale=args.outscale)
-        except RuntimeError as error:
-            print('Error', error)
-            print('If you encounter CUDA out of memory, try to set --tile with a smaller number.')
-        else:
-            writer.write_frame(output)
+            reader = Reader(args, frame_range=(segment['start'], segment['end']))
+            height, width = reader.get_resolution()
+            # segments have no audio, it is added when they are concatenated
+            part_path = manifest.part_path(index)
+            writer = Writer(args, None, height, width, part_path, reader.get_fps())
+            if upsampler.tile_cache is not None:
+                upsampler.tile_cache.reset()
+
+            def on_frames(num_frames):
+                manifest.heartbeat(index)
+                if progress is not None:
+                    progress(num_frames)
+
+            upsample_video(args, upsampler, face_enhancer, reader, writer, on_frames)
+            reader.close()
+            writer.close()
+            os.replace(part_path, manifest.segment_path(index))
+            manifest.complete(index, frames=segment['end'] - segment['start'], duration_s=time.perf_counter() - start)
+            print(f'Segment {index} done in {time.perf_counter() - start:.1f}s')
+        finally:
+            manifest.release(index)
+
+
+def run_workers(fn, worker_args, total_frames):
+    """Runs fn(*args, progress) for each args of worker_args in its own process, with one progress bar for all."""
+    ctx = torch.multiprocessing.get_context('spawn')
+    manager = ctx.Manager()
+    progress = manager.Queue()  # frames done by the workers
+    pool = ctx.Pool(len(worker_args))
+    results = [pool.apply_async(fn, args=(*args, progress.put)) for args in worker_args]
+    pool.close()
 
-        torch.cuda.synchronize(device)
-        pbar.update(1)
+    pbar = tqdm(total=total_frames, unit='frame', desc='inference')
+    while not all(result.ready() for result in results) or not progress.empty():
+        try:
+            pbar.update(progress.get(timeout=0.5))
+        except queue.Empty:
+            pass
+    pbar.close()
+    for result in results:
+        result.get()  # raises the error of a failed worker
+    pool.join()
+    manager.shutdown()
+
+
+def concat_videos(args, video_paths, video_save_path):
+    """Concatenates videos without re-encoding them, with the audio of the input."""
+    list_path = f'{osp.splitext(video_save_path)[0]}_vidlist.txt'
+    with open(list_path, 'w') as f:
+        for path in video_paths:
+            path = osp.abspath(path).replace("'", "'\\''")
+            f.write(f'file \'{path}\'\n')
+
+    cmd = [args.ffmpeg_bin, '-f', 'concat', '-safe', '0', '-i', list_path]
+    input_type = mimetypes.guess_type(args.input)[0]
+    if input_type is not None and input_type.startswith('video'):
+        cmd += ['-i', args.input, '-map', '0:v', '-map', '1:a?']
+    cmd += ['-c', 'copy', video_save_path, '-y']
+    print(' '.join(cmd))
+    returncode = subprocess.call(cmd)
+    os.remove(list_path)
+    if returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to concatenate the videos into {video_save_path}')
 
-    reader.close()
-    writer.close()
+
+def get_segment_job(args):
+    """Settings the output depends on, segments of other settings are never mixed."""
+    keys = ('model_name', 'denoise_strength', 'outscale', 'tile', 'tile_pad', 'pre_pad', 'face_enhance', 'fp32',
+            'precision', 'fps', 'no_dedup', 'dedup_threshold', 'reuse_tiles', 'reuse_threshold')
+    job = {key: getattr(args, key) for key in keys}
+    job['input_size'] = osp.getsize(args.input) if osp.isfile(args.input) else None
+    return job
+
+
+def run_segments(args, video_save_path, num_process, num_gpus, num_threads):
+    """Upsamples the remaining segments of the job, then concatenates them once all of them are done.
+
+    Other machines may work on the same job through a shared output folder, the last one to finish concatenates.
+    """
+    segments_dir = osp.join(args.output, f'{args.video_name}_segments')
+    manifest = SegmentManifest(segments_dir, args.segment_lock_timeout)
+    segments = manifest.create(get_segment_job(args), count_frames(args), args.segment_frames)
+    remaining = manifest.remaining()
+    print(f'{len(segments) - len(remaining)}/{len(segments)} segments of {args.segment_frames} frames already done')
+
+    total_frames = sum(segment['end'] - segment['start'] for segment in remaining)
+    num_process = min(num_process, len(remaining))
+    if num_process == 1:
+        pbar = tqdm(total=total_frames, unit='frame', desc='inference')
+        inference_segments(args, segments_dir, progress=pbar.update)
+        pbar.close()
+    elif num_process > 1:
+        worker_args = [(args, segments_dir, torch.device(i % num_gpus) if num_gpus > 0 else None, num_threads)
+                       for i in range(num_process)]
+        run_workers(inference_segments, worker_args, total_frames)
+
+    # the worker that concatenates deletes segments_dir, possibly between any two of the steps below
+    try:
+        remaining = manifest.remaining()
+        if not remaining:
+            locked = manifest.try_lock(osp.join(segments_dir, 'concat.lock'))
+    except FileNotFoundError:
+        print(f'Another worker concatenated the segments into {video_save_path}')
+        return
+    if remaining:
+        print(f'{len(remaining)} segments are still being upsampled by other workers, the last one to finish '
+              f'concatenates them into {video_save_path}')
+        return
+    if not locked:
+        print(f'Another worker is concatenating the segments into {video_save_path}')
+        return
+    concat_videos(args, [manifest.segment_path(segment['index']) for segment in segments], video_save_path)
+    shutil.rmtree(segments_dir)
 
 
 def run(args):
@@ -287,40 +493,32 @@ def run(args):
         args.input = tmp_frames_folder
 
     num_gpus = torch.cuda.device_count()
-    num_process = num_gpus * args.num_process_per_gpu
+    num_process = num_gpus * args.num_process_per_gpu if num_gpus > 0 else args.num_shards
+    total_frames = count_frames(args)
+    num_process = max(1, min(num_process, total_frames))
+
+    # without GPU, the workers share the CPU threads
+    num_threads = None
+    if num_gpus == 0 and num_process > 1:
+        num_threads = args.threads_per_shard or max(1, (os.cpu_count() or 1) // num_process)
+        print(f'{num_process} workers with {num_threads} threads each')
+
+    if args.segment_frames > 0:
+        run_segments(args, video_save_path, num_process, num_gpus, num_threads)
+        return
+
     if num_process == 1:
         inference_video(args, video_save_path)
         return
 
-    ctx = torch.multiprocessing.get_context('spawn')
-    pool = ctx.Pool(num_process)
-    os.makedirs(osp.join(args.output, f'{args.video_name}_out_tmp_videos'), exist_ok=True)
-    pbar = tqdm(total=num_process, unit='sub_video', desc='inference')
-    for i in range(num_process):
-        sub_video_save_path = osp.join(args.output, f'{args.video_name}_out_tmp_videos', f'{i:03d}.mp4')
-        pool.apply_async(
-            inference_video,
-            args=(args, sub_video_save_path, torch.device(i % num_gpus), num_process, i),
-            callback=lambda arg: pbar.update(1))
-    pool.close()
-    pool.join()
-
-    # combine sub videos
-    # prepare vidlist.txt
-    with open(f'{args.output}/{args.video_name}_vidlist.txt', 'w') as f:
-        for i in range(num_process):
-            f.write(f'file \'{args.video_name}_out_tmp_videos/{i:03d}.mp4\'\n')
-
-    cmd = [
-        args.ffmpeg_bin, '-f', 'concat', '-safe', '0', '-i', f'{args.output}/{args.video_name}_vidlist.txt', '-c',
-        'copy', f'{video_save_path}'
-    ]
-    print(' '.join(cmd))
-    subprocess.call(cmd)
-    shutil.rmtree(osp.join(args.output, f'{args.video_name}_out_tmp_videos'))
-    if osp.exists(osp.join(args.output, f'{args.video_name}_inp_tmp_videos')):
-        shutil.rmtree(osp.join(args.output, f'{args.video_name}_inp_tmp_videos'))
-    os.remove(f'{args.output}/{args.video_name}_vidlist.txt')
+    sub_videos_dir = osp.join(args.output, f'{args.video_name}_out_tmp_videos')
+    os.makedirs(sub_videos_dir, exist_ok=True)
+    sub_video_paths = [osp.join(sub_videos_dir, f'{i:03d}.mp4') for i in range(num_process)]
+    worker_args = [(args, sub_video_paths[i], torch.device(i % num_gpus) if num_gpus > 0 else None, num_process, i,
+                    num_threads) for i in range(num_process)]
+    run_workers(inference_video, worker_args, total_frames)
+    concat_videos(args, sub_video_paths, video_save_path)
+    shutil.rmtree(sub_videos_dir)
 
 
 def main():
@@ -353,11 +551,82 @@ def main():
     parser.add_argument('--pre_pad', type=int, default=0, help='Pre padding size at each border')
     parser.add_argument('--face_enhance', action='store_true', help='Use GFPGAN to enhance face')
     parser.add_argument(
-        '--fp32', action='store_true', help='Use fp32 precision during inference. Default: fp16 (half precision).')
+        '--fp32', action='store_true', help='Use fp32 precision during inference. Shorthand for --precision fp32')
+    parser.add_argument(
+        '--precision',
+        type=str,
+        default=None,
+        choices=['fp32', 'fp16', 'bf16', 'int8', 'auto'],
+        help=('Inference precision. auto: fp16 on CUDA, bf16 on CPUs with native bf16 support, fp32 otherwise. '
+              'Default: auto, fp32 if --fp32 is set'))
     parser.add_argument('--fps', type=float, default=None, help='FPS of the output video')
     parser.add_argument('--ffmpeg_bin', type=str, default='ffmpeg', help='The path to ffmpeg')
     parser.add_argument('--extract_frame_first', action='store_true')
     parser.add_argument('--num_process_per_gpu', type=int, default=1)
+    parser.add_argument(
+        '--num_shards',
+        type=int,
+        default=1,
+        help=('Number of worker processes on hosts without GPU. The input is split into as many frame-accurate '
+              'segments, which are concatenated without re-encoding. Default: 1'))
+    parser.add_argument(
+        '--threads_per_shard',
+        type=int,
+        default=0,
+        help='Torch and OpenCV threads of each shard. 0 splits the CPUs evenly between the shards. Default: 0')
+    parser.add_argument(
+        '--segment_frames',
+        type=int,
+        default=0,
+        help=('Encode the output in segments of this many frames, recorded in <output>/<video name>_segments. A job '
+              'that is run again only upsamples the remaining segments, and other machines sharing the output folder '
+              'can work on the same job. 0 encodes the output in one go. Default: 0'))
+    parser.add_argument(
+        '--segment_lock_timeout',
+        type=float,
+        default=600,
+        help=('Seconds after which a segment whose worker stopped reporting progress is taken over by another '
+              'worker. Workers that died on this machine are detected at once. Default: 600'))
+    parser.add_argument(
+        '--decode_queue_size',
+        type=int,
+        default=4,
+        help='Number of decoded frame batches waiting for inference. Default: 4')
+    parser.add_argument(
+        '--encode_queue_size',
+        type=int,
+        default=4,
+        help='Number of upscaled frame batches waiting to be encoded. Default: 4')
+    parser.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=1,
+        help='Number of frames upsampled together. 0 picks the largest batch that fits in --batch_memory. Default: 1')
+    parser.add_argument(
+        '--batch_memory',
+        type=int,
+        default=2048,
+        help='Memory budget of a batch in MB, used when --batch_size is 0. Default: 2048')
+    parser.add_argument(
+        '--no_dedup', action='store_true', help='Upsample every frame, even those repeating the previous one')
+    parser.add_argument(
+        '--dedup_threshold',
+        type=float,
+        default=0,
+        help=('Largest difference (0-255) of an 8x8 block mean between frames that are treated as duplicates. '
+              '0 only skips identical frames, 1-3 also skips frames that only differ by compression noise. Default: 0'))
+    parser.add_argument(
+        '--reuse_tiles',
+        action='store_true',
+        help=('Only upsample the tiles whose input (with --tile_pad) changed since the previous frame, for static '
+              'backgrounds. Needs --tile, 256 if it is not set'))
+    parser.add_argument(
+        '--reuse_threshold',
+        type=float,
+        default=0,
+        help=('Largest difference (0-255) of an 8x8 block mean between tiles whose output is reused. 0 only reuses '
+              'identical tiles, 1-3 also reuses tiles that only differ by compression noise. Default: 0'))
 
     parser.add_argument(
         '--alpha_upsampler',
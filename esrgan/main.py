@@ -1,26 +1,87 @@
 from fastapi import FastAPI
 from typing_extensions import Annotated
-from typing import Optional
-from fastapi import FastAPI, File, Form, UploadFile, Response
+from typing import List, Optional
+from fastapi import FastAPI, File, Form, Header, HTTPException, UploadFile, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from pathlib import Path
 from urllib.parse import quote
-from concurrent.futures import ProcessPoolExecutor
-import asyncio
+import numpy as np
+import os
 
 from server import schemas
-from server.infer import infer
+from server.batch import open_inputs, spool_uploads, stream_batch
+from server.profiling import DEFAULT_PROFILER, is_admin, profiled_infer
+from server.memory import memory_report
+from server.pool import JobResult, WorkerCrashedError, WorkerPool
+from server.video import VideoJob, get_video_jobs, infer_frame
 from frontend.main import init_frontend
+from frontend.schemas import SingleImageUpscaleRequest
 
 # allow server to accept more requests even if one is running
-# but only allow processing of a single request at any time
-pool = ProcessPoolExecutor(max_workers=1)
+# but only allow processing of ESRGAN_WORKERS requests at any time (default 1),
+# the workers share the model weights (see server/weights.py)
+# and are replaced after ESRGAN_MAX_JOBS_PER_WORKER jobs or when their RSS exceeds ESRGAN_MAX_WORKER_RSS_MB
+max_jobs_per_worker: Optional[str] = os.environ.get("ESRGAN_MAX_JOBS_PER_WORKER")
+max_worker_rss_mb: Optional[str] = os.environ.get("ESRGAN_MAX_WORKER_RSS_MB")
+pool = WorkerPool(
+    max_workers=int(os.environ.get("ESRGAN_WORKERS", 1)),
+    max_jobs_per_worker=int(max_jobs_per_worker) if max_jobs_per_worker else None,
+    max_worker_rss=int(max_worker_rss_mb) * 2**20 if max_worker_rss_mb else None
+)
 
 app = FastAPI()
 
+async def submit(
+    file_ext: str,
+    file_bytes: bytes,
+    model_name: schemas.TModelNames,
+    denoise_strength: float,
+    outscale: int,
+    tile: int = 0,
+    tile_pad: int = 10,
+    pre_pad: int = 0,
+    face_enhance: bool = False,
+    fp_32: bool = True,
+    gpu_id: Optional[int] = None,
+    plan_policy: schemas.TPlanPolicy = "exact",
+    engine: schemas.TEngine = "eager",
+    precision: Optional[schemas.TPrecision] = None,
+    profile: Optional[schemas.TProfiler] = None
+) -> JobResult:
+    """Queues an inference job on the worker pool"""
+    return await pool.run(
+        profiled_infer,
+        profile or DEFAULT_PROFILER,
+        file_ext,
+        file_bytes,
+        model_name,
+        denoise_strength,
+        outscale,
+        tile,
+        tile_pad,
+        pre_pad,
+        face_enhance,
+        fp_32,
+        gpu_id,
+        plan_policy,
+        engine,
+        precision
+    )
+
+async def upscale_in_process(file_bytes: bytes, filename: str, params: SingleImageUpscaleRequest) -> bytes:
+    """Used by the web UI, avoids encoding the image to a multipart request to this same server"""
+    job = await submit(Path(filename).suffix.lower(), file_bytes, **params.model_dump())
+    return job.value.image
+
 @app.get("/health")
 async def heatlh_check():
     return {"status": "healthy"}
 
+@app.get("/memory")
+async def memory() -> List[schemas.ProcessMemory]:
+    """Private vs shared memory of the server and of each inference worker"""
+    return memory_report()
+
 @app.post("/upscale")
 async def upscale(
     file: Annotated[UploadFile, File()],
@@ -32,33 +93,186 @@ async def upscale(
     pre_pad: Annotated[int, Form()] = 0,
     face_enhance: Annotated[bool, Form()] = False,
     fp_32: Annotated[bool, Form()] = True,
-    gpu_id: Annotated[Optional[int], Form()] = None
+    gpu_id: Annotated[Optional[int], Form()] = None,
+    plan_policy: Annotated[schemas.TPlanPolicy, Form()] = "exact",
+    engine: Annotated[schemas.TEngine, Form()] = "eager",
+    precision: Annotated[Optional[schemas.TPrecision], Form()] = None,
+    profile: Annotated[Optional[schemas.TProfiler], Form()] = None,
+    x_admin_token: Annotated[Optional[str], Header()] = None
 ):
+    if profile is not None and not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Profiling requires a valid X-Admin-Token header")
+
     file_ext: str = Path(file.filename).suffix.lower()
     file_bytes: bytes = await file.read()
 
-    loop = asyncio.get_running_loop()
-    result_bytes = await loop.run_in_executor(pool,
-        infer,
-        file_ext,
-        file_bytes,
-        model_name,
-        denoise_strength,
-        outscale,
-        tile,
-        tile_pad,
-        pre_pad,
-        face_enhance,
-        fp_32,
-        gpu_id
-    )
+    try:
+        job = await submit(
+            file_ext,
+            file_bytes,
+            model_name,
+            denoise_strength,
+            outscale,
+            tile,
+            tile_pad,
+            pre_pad,
+            face_enhance,
+            fp_32,
+            gpu_id,
+            plan_policy,
+            engine,
+            precision,
+            profile
+        )
+    except WorkerCrashedError as error:
+        raise HTTPException(status_code=503, detail=str(error))
+    result: schemas.InferenceResult = job.value
+
+    headers = {
+        "Content-Disposition": f"attachment; filename=\"{'upscaled' + file_ext}\";filename*=UTF-8''{quote(file.filename)}",
+        "X-Inference-Plan": result.plan.model_dump_json(),
+        "X-Job-Stats": job.stats.model_dump_json()
+    }
+    if result.profile_id is not None:
+        headers["X-Profile-Id"] = result.profile_id
 
     return Response(
-        result_bytes,
+        result.image,
         media_type="application/octet",
-        headers={
-            "Content-Disposition": f"attachment; filename=\"{'upscaled' + file_ext}\";filename*=UTF-8''{quote(file.filename)}"
-        }
+        headers=headers
     )
 
-init_frontend(app)
\ No newline at end of file
+@app.post("/upscale/batch")
+async def upscale_batch(
+    files: Annotated[List[UploadFile], File()],
+    model_name: Annotated[schemas.TModelNames, Form()] = "RealESRGAN_x4plus",
+    denoise_strength: Annotated[float, Form()] = 0.5,
+    outscale: Annotated[int, Form()] = 4,
+    tile: Annotated[int, Form()] = 0,
+    tile_pad: Annotated[int, Form()] = 10,
+    pre_pad: Annotated[int, Form()] = 0,
+    face_enhance: Annotated[bool, Form()] = False,
+    fp_32: Annotated[bool, Form()] = True,
+    gpu_id: Annotated[Optional[int], Form()] = None,
+    plan_policy: Annotated[schemas.TPlanPolicy, Form()] = "exact",
+    engine: Annotated[schemas.TEngine, Form()] = "eager",
+    precision: Annotated[Optional[schemas.TPrecision], Form()] = None
+):
+    """
+    Upscales images, and the images in .zip/.tar archives, with shared parameters.
+    Returns a ZIP streamed as the images complete, with a manifest.json of per-image timings and errors
+    """
+    spooled = await spool_uploads(files)
+    try:
+        inputs = open_inputs(spooled)
+    except ValueError as error:
+        for _, file in spooled:
+            file.close()
+        raise HTTPException(status_code=400, detail=str(error))
+
+    async def upscale_one(name: str, file_bytes: bytes) -> JobResult:
+        return await submit(
+            Path(name).suffix.lower(),
+            file_bytes,
+            model_name,
+            denoise_strength,
+            outscale,
+            tile,
+            tile_pad,
+            pre_pad,
+            face_enhance,
+            fp_32,
+            gpu_id,
+            plan_policy,
+            engine,
+            precision
+        )
+
+    # one image waiting per worker, so that workers never wait for the next input to be read
+    return StreamingResponse(
+        stream_batch(spooled, inputs, upscale_one, concurrency=2 * pool.max_workers),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=\"upscaled.zip\""}
+    )
+
+@app.post("/upscale/video", status_code=202)
+async def upscale_video(
+    file: Annotated[UploadFile, File()],
+    model_name: Annotated[schemas.TModelNames, Form()] = "realesr-general-x4v3",
+    denoise_strength: Annotated[float, Form()] = 0.5,
+    outscale: Annotated[int, Form()] = 4,
+    tile: Annotated[int, Form()] = 0,
+    tile_pad: Annotated[int, Form()] = 10,
+    pre_pad: Annotated[int, Form()] = 0,
+    face_enhance: Annotated[bool, Form()] = False,
+    fp_32: Annotated[bool, Form()] = True,
+    gpu_id: Annotated[Optional[int], Form()] = None,
+    plan_policy: Annotated[schemas.TPlanPolicy, Form()] = "exact",
+    engine: Annotated[schemas.TEngine, Form()] = "eager",
+    precision: Annotated[Optional[schemas.TPrecision], Form()] = None
+) -> schemas.VideoJobStatus:
+    """
+    Starts upscaling a video with the parameters of /upscale, every frame is a job of the worker pool.
+    Poll GET /upscale/video/{id} for the progress, finished segments can be downloaded while the next ones are
+    encoded, and the whole video with its audio once the job is done
+    """
+    async def upscale_frame(frame: np.ndarray) -> JobResult:
+        return await pool.run(
+            infer_frame,
+            frame,
+            model_name,
+            denoise_strength,
+            outscale,
+            tile,
+            tile_pad,
+            pre_pad,
+            face_enhance,
+            fp_32,
+            gpu_id,
+            plan_policy,
+            engine,
+            precision
+        )
+
+    try:
+        # one frame waiting per worker, like /upscale/batch
+        job = await get_video_jobs().start(file.filename or "video", file.file, upscale_frame, 2 * pool.max_workers)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return job.status()
+
+def get_video_job(job_id: str) -> VideoJob:
+    try:
+        return get_video_jobs().get(job_id)
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+
+@app.get("/upscale/video/{job_id}")
+async def video_status(job_id: str) -> schemas.VideoJobStatus:
+    return get_video_job(job_id).status()
+
+@app.get("/upscale/video/{job_id}/segments/{index}")
+async def video_segment(job_id: str, index: int):
+    """A finished segment (MP4, without audio), with support for Range requests"""
+    job = get_video_job(job_id)
+    if not 0 <= index < len(job.segments):
+        raise HTTPException(status_code=404, detail=f"Segment {index} is not encoded yet")
+    return FileResponse(job.segment_path(index), media_type="video/mp4", filename=f"{index:05d}.mp4")
+
+@app.get("/upscale/video/{job_id}/output")
+async def video_output(job_id: str):
+    """The upscaled video (MP4, with the audio of the input), with support for Range requests"""
+    job = get_video_job(job_id)
+    if job.state != "done":
+        raise HTTPException(
+            status_code=409, detail=f"The job is {job.state}, finished segments are listed in its status"
+        )
+    return FileResponse(job.output_path, media_type="video/mp4", filename=f"{Path(job.name).stem}_upscaled.mp4")
+
+@app.delete("/upscale/video/{job_id}")
+async def delete_video(job_id: str):
+    """Stops the job if it is running and deletes its files"""
+    await get_video_jobs().delete(job_id)
+    return {"status": "deleted"}
+
+init_frontend(app, upscaler=upscale_in_process)
\ No newline at end of file
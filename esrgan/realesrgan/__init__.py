@@ -1,6 +1,7 @@
 # flake8: noqa
 from .archs import *
 from .data import *
+from .engine import *
 from .models import *
 from .utils import *
 from .version import *
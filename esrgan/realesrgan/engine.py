@@ -0,0 +1,193 @@
+import hashlib
+import inspect
+import os
+import torch
+
+
+def state_dict_digest(model):
+    """Digest of the network weights, used to identify models that were not loaded from a file."""
+    sha = hashlib.sha1()
+    for k, v in model.state_dict().items():
+        sha.update(k.encode())
+        sha.update(v.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def artifact_path(cache_dir, model, model_id, suffix):
+    """Path of a cached artifact (traced module, ONNX graph, ...) derived from the network and its weights."""
+    digest = hashlib.sha1(model_id.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{type(model).__name__}_{digest}{suffix}')
+
+
+def autocast_dtype(device_type):
+    """The dtype of the active autocast region for ``device_type``, None outside of autocast."""
+    if hasattr(torch, 'get_autocast_dtype'):  # torch >= 2.4
+        enabled, dtype = torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    elif device_type == 'cpu':
+        enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    else:
+        enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return dtype if enabled else None
+
+
+def export_onnx(model, path, num_in_ch=3, opset_version=17):
+    """Export the network to ONNX with dynamic batch and spatial axes.
+
+    Args:
+        model (nn.Module): The network, in eval mode.
+        path (str): Output path of the ONNX graph.
+        num_in_ch (int): Channel number of inputs. Default: 3.
+        opset_version (int): ONNX opset. Default: 17.
+    """
+    param = next(model.parameters())
+    x = torch.rand(1, num_in_ch, 64, 64, dtype=param.dtype, device=param.device)
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ('input', 'output')}
+    kwargs = {}
+    # newer torch defaults to the dynamo exporter which needs extra packages
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            x,
+            tmp_path,
+            opset_version=opset_version,
+            export_params=True,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes=dynamic_axes,
+            **kwargs)
+    os.replace(tmp_path, path)
+
+
+class EagerEngine():
+    """Runs the network as is.
+
+    Engines wrap the network used by RealESRGANer. They are called with a NCHW tensor and return the
+    upsampled NCHW tensor, so they can be swapped without touching the tiling code.
+
+    Args:
+        model (nn.Module): The network, already in eval mode and on its device.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def register_shape(self, shape):
+        """Hint that inputs of this shape will be seen often (e.g. the padded tile shape)."""
+        pass
+
+    def __call__(self, x):
+        return self.model(x)
+
+
+class TorchScriptEngine(EagerEngine):
+    """Runs the network in channels-last format, through TorchScript modules traced once per input shape.
+
+    Only registered shapes are traced (separately inside and outside of autocast), any other shape (e.g. tiles on the
+    image border) runs eagerly. Traced modules are frozen and saved to ``cache_dir`` so that later processes skip
+    tracing. The channels-last conversion copies the weights, so weights memory-mapped and shared between processes
+    end up in private memory in each process with this engine.
+
+    Args:
+        model (nn.Module): The network, already in eval mode and on its device.
+        model_id (str): Identifies the weights of the network, part of the cache key.
+        cache_dir (str): Folder for the traced modules. None disables the disk cache. Default: None.
+        shapes (list[tuple]): Input shapes to trace. Default: None.
+    """
+
+    def __init__(self, model, model_id, cache_dir=None, shapes=None):
+        super().__init__(model.to(memory_format=torch.channels_last))
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.shapes = set(tuple(shape) for shape in shapes or [])
+        self.traced = {}
+
+    def register_shape(self, shape):
+        self.shapes.add(tuple(shape))
+
+    def cache_path(self, x):
+        key = '|'.join([
+            self.model_id,
+            str(tuple(x.shape)),
+            str(x.dtype),
+            x.device.type,
+            str(autocast_dtype(x.device.type)), torch.__version__
+        ])
+        return artifact_path(self.cache_dir, self.model, key, '.pt')
+
+    @torch.no_grad()
+    def trace(self, x):
+        path = self.cache_path(x) if self.cache_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            return torch.jit.load(path, map_location=x.device)
+
+        traced = torch.jit.freeze(torch.jit.trace(self.model, x, check_trace=False))
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temporary file first, other workers may be loading the same artifact
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            torch.jit.save(traced, tmp_path)
+            os.replace(tmp_path, path)
+        return traced
+
+    def get_traced(self, x):
+        # the autocast casts are baked into the traced graph
+        key = (tuple(x.shape), x.dtype, autocast_dtype(x.device.type))
+        if key not in self.traced:
+            traced = None
+            if key[0] in self.shapes:
+                try:
+                    traced = self.trace(x)
+                except RuntimeError as error:
+                    print(f'\tTracing failed for shape {key[0]}, falling back to eager: {error}')
+            self.traced[key] = traced
+        return self.traced[key]
+
+    def __call__(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        traced = self.get_traced(x)
+        if traced is None:
+            return self.model(x)
+        return traced(x)
+
+
+class OnnxRuntimeEngine(EagerEngine):
+    """Runs the network with ONNX Runtime.
+
+    The network is exported once (with dynamic spatial axes, so every tile shape works) to ``cache_dir``, later
+    processes load the exported graph directly. Requires the ``onnxruntime`` package.
+
+    Args:
+        model (nn.Module): The network, already in eval mode and on its device.
+        model_id (str): Identifies the weights of the network, part of the cache key.
+        cache_dir (str): Folder for the exported graphs.
+        num_threads (int): Intra-op threads of the session. Default: None, uses torch's thread count.
+    """
+
+    def __init__(self, model, model_id, cache_dir, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnxruntime engine requires onnxruntime, install it with: pip install onnxruntime')
+        super().__init__(model)
+        # the graph is exported with the dtype of the weights, and takes inputs of that dtype only
+        param = next(model.parameters())
+        key = '|'.join([model_id, str(param.dtype), param.device.type, torch.__version__])
+        self.path = artifact_path(cache_dir, model, key, '.onnx')
+        if not os.path.isfile(self.path):
+            export_onnx(model, self.path)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        providers = ['CPUExecutionProvider']
+        if param.device.type == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(self.path, options, providers=providers)
+
+    def __call__(self, x):
+        output = self.session.run(None, {'input': x.detach().cpu().contiguous().numpy()})[0]
+        return torch.from_numpy(output).to(x.device)
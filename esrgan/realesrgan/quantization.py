@@ -0,0 +1,115 @@
+import copy
+import cv2
+import glob
+import numpy as np
+import os
+import torch
+from basicsr.archs import rrdbnet_arch
+from torch.nn import functional as F
+from unittest import mock
+
+from realesrgan.engine import EagerEngine, artifact_path
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def get_quantized_backend():
+    """The best quantized backend available, x86 (fbgemm + onednn) on newer torch."""
+    supported = torch.backends.quantized.supported_engines
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in supported:
+            return backend
+    raise RuntimeError(f'No quantized backend available, supported engines: {supported}')
+
+
+def load_calibration_tiles(folder, tile_size=64, num_tiles=16, seed=0):
+    """Random RGB crops from the images of a folder, normalized to [0, 1] like RealESRGANer.pre_process.
+
+    Args:
+        folder (str): Folder with calibration images, e.g. ``inputs``.
+        tile_size (int): Width and height of the crops. Default: 64.
+        num_tiles (int): Number of crops, spread evenly over the images. Default: 16.
+        seed (int): Seed of the crop positions. Default: 0.
+
+    Returns:
+        list[Tensor]: Tensors of shape (1, 3, tile_size, tile_size).
+    """
+    paths = sorted(p for p in glob.glob(os.path.join(folder, '*')) if p.lower().endswith(IMG_EXTENSIONS))
+    assert len(paths) > 0, f'No calibration images found in {folder}'
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for idx in range(num_tiles):
+        img = cv2.imread(paths[idx % len(paths)], cv2.IMREAD_UNCHANGED)
+        max_range = 65535 if img.dtype == np.uint16 else 255
+        img = img.astype(np.float32) / max_range
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        else:
+            img = cv2.cvtColor(img[:, :, 0:3], cv2.COLOR_BGR2RGB)
+        h, w = img.shape[0:2]
+        size = min(tile_size, h, w)
+        top, left = rng.integers(0, h - size + 1), rng.integers(0, w - size + 1)
+        crop = img[top:top + size, left:left + size]
+        tiles.append(torch.from_numpy(np.ascontiguousarray(np.transpose(crop, (2, 0, 1)))).unsqueeze(0))
+    return tiles
+
+
+@torch.no_grad()
+def quantize_model(model, calibration_tiles, backend=None):
+    """Post-training static int8 quantization (FX graph mode) of a network, calibrated on sample tiles.
+
+    Args:
+        model (nn.Module): The fp32 network, in eval mode and on the CPU. It is not modified.
+        calibration_tiles (list[Tensor]): Inputs used to calibrate the activation ranges.
+        backend (str): Quantized backend. Default: None, picks the best available one.
+
+    Returns:
+        torch.jit.ScriptModule: The quantized network, traced so that it can be saved and loaded.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    backend = backend or get_quantized_backend()
+    torch.backends.quantized.engine = backend
+    example = calibration_tiles[0]
+    # basicsr's pixel_unshuffle (x2 and x1 RRDBNet) asserts on the input size, which FX cannot trace
+    with mock.patch.object(rrdbnet_arch, 'pixel_unshuffle', lambda x, scale: F.pixel_unshuffle(x, scale)):
+        prepared = prepare_fx(
+            copy.deepcopy(model),
+            get_default_qconfig_mapping(backend),
+            example_inputs=(example, ))
+    for tile in calibration_tiles:
+        prepared(tile)
+    quantized = convert_fx(prepared)
+    return torch.jit.trace(quantized, example, check_trace=False)
+
+
+class QuantizedEngine(EagerEngine):
+    """Runs an int8 quantized version of the network on the CPU.
+
+    The network is quantized once, calibrated on tiles from ``calibration_dir``, and saved to ``cache_dir``;
+    later processes load the quantized network directly.
+
+    Args:
+        model (nn.Module): The fp32 network, in eval mode and on the CPU.
+        model_id (str): Identifies the weights of the network, part of the cache key.
+        cache_dir (str): Folder for the quantized networks.
+        calibration_dir (str): Folder with calibration images.
+    """
+
+    def __init__(self, model, model_id, cache_dir, calibration_dir):
+        super().__init__(model)
+        backend = get_quantized_backend()
+        self.path = artifact_path(cache_dir, model, f'{model_id}|int8|{backend}|{torch.__version__}', '.int8.pt')
+        if os.path.isfile(self.path):
+            torch.backends.quantized.engine = backend
+            self.quantized = torch.jit.load(self.path, map_location='cpu')
+        else:
+            self.quantized = quantize_model(model, load_calibration_tiles(calibration_dir), backend)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            torch.jit.save(self.quantized, tmp_path)
+            os.replace(tmp_path, self.path)
+
+    def __call__(self, x):
+        return self.quantized(x.float())
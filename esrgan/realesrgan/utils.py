@@ -1,14 +1,51 @@
+import contextlib
 import cv2
 import math
 import numpy as np
 import os
 import queue
 import threading
+import time
 import torch
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
+from torch.profiler import record_function
+
+from realesrgan.engine import EagerEngine, OnnxRuntimeEngine, TorchScriptEngine, state_dict_digest
+from realesrgan.quantization import QuantizedEngine
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRECISIONS = ('fp32', 'fp16', 'bf16', 'int8', 'auto')
+
+
+def is_bf16_supported():
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX), where bf16 autocast pays off."""
+    for name in ('_is_avx512_bf16_supported', '_is_amx_tile_supported'):
+        check = getattr(torch.cpu, name, None)
+        if check is not None and check():
+            return True
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def resolve_precision(precision, device):
+    """Resolve ``auto`` to the fastest precision of the device: fp16 on CUDA, bf16 on CPUs with native bf16
+    support, fp32 otherwise. fp16 is only kept on CUDA, elsewhere it falls back like ``auto``. Other precisions are
+    returned as is."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unsupported precision: {precision}, options: {PRECISIONS}')
+    if precision not in ('auto', 'fp16'):
+        return precision
+    if device.type == 'cuda':
+        return 'fp16'
+    fallback = 'bf16' if device.type == 'cpu' and is_bf16_supported() else 'fp32'
+    if precision == 'fp16':
+        print(f'\tfp16 is slow or unsupported on {device.type} devices, falling back to {fallback}')
+    return fallback
 
 
 class RealESRGANer():
@@ -17,6 +54,7 @@ class RealESRGANer():
     Args:
         scale (int): Upsampling scale factor used in the networks. It is usually 2 or 4.
         model_path (str): The path to the pretrained model. It can be urls (will first download it automatically).
+            None keeps the weights the network already has.
         model (nn.Module): The defined network. Default: None.
         tile (int): As too large images result in the out of GPU memory issue, so this tile option will first crop
             input images into tiles, and then process each of them. Finally, they will be merged into one image.
@@ -24,6 +62,19 @@ class RealESRGANer():
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+            Prefer ``precision``, fp16 is slow or unsupported on most CPUs.
+        engine (str): How the network is run. Options: eager | torchscript | onnxruntime. torchscript converts the
+            network to channels-last and traces it once per tile shape, onnxruntime exports it to ONNX once and runs
+            it with ONNX Runtime. Default: eager.
+        model_id (str): Identifies the weights in on-disk caches (e.g. traced modules, ONNX graphs). Default: None,
+            derived from model_path and dni_weight.
+        cache_dir (str): Folder for compiled artifacts. Default: None, uses ``weights/compiled``.
+        precision (str): Inference precision. Options: fp32 | fp16 | bf16 | int8 | auto. bf16 runs the network
+            under bfloat16 autocast, int8 runs a statically quantized copy of the network on the CPU, calibrated on
+            the images of ``calibration_dir``. auto picks fp16 on CUDA, bf16 on CPUs with native bf16 support and
+            fp32 otherwise, fp16 falls back the same way on other devices. Default: None, fp16 if half is set,
+            otherwise fp32.
+        calibration_dir (str): Images used to calibrate int8 quantization. Default: None, uses ``inputs``.
     """
 
     def __init__(self,
@@ -36,13 +87,19 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 engine='eager',
+                 model_id=None,
+                 cache_dir=None,
+                 precision=None,
+                 calibration_dir=None):
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
         self.pre_pad = pre_pad
         self.mod_scale = None
-        self.half = half
+        self.activation_bytes = None  # per input pixel, see estimate_batch_size
+        self.tile_cache = None  # realesrgan.video.TemporalTileCache, reuses unchanged tiles of consecutive frames
 
         # initialize model
         if gpu_id:
@@ -51,7 +108,17 @@ class RealESRGANer():
         else:
             self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
 
-        if isinstance(model_path, list):
+        if precision is None:
+            # the legacy flag is applied as is, on any device
+            precision = 'fp16' if half else 'fp32'
+        else:
+            precision = resolve_precision(precision, self.device)
+        self.precision = precision
+        self.half = precision == 'fp16'
+
+        if model_path is None:
+            loadnet = None
+        elif isinstance(model_path, list):
             # dni
             assert len(model_path) == len(dni_weight), 'model_path and dni_weight should have the save length.'
             loadnet = self.dni(model_path[0], model_path[1], dni_weight)
@@ -62,18 +129,39 @@ class RealESRGANer():
                     url=model_path, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
             loadnet = torch.load(model_path, map_location=torch.device('cpu'))
 
-        # prefer to use params_ema
-        if 'params_ema' in loadnet:
-            keyname = 'params_ema'
-        else:
-            keyname = 'params'
-        model.load_state_dict(loadnet[keyname], strict=True)
+        if loadnet is not None:
+            # prefer to use params_ema
+            if 'params_ema' in loadnet:
+                keyname = 'params_ema'
+            else:
+                keyname = 'params'
+            model.load_state_dict(loadnet[keyname], strict=True)
 
-        model.eval()
+        # no gradients, so that autocast weight copies can be traced as constants
+        model.eval().requires_grad_(False)
         self.model = model.to(self.device)
         if self.half:
             self.model = self.model.half()
 
+        if model_id is None and (engine != 'eager' or precision == 'int8'):
+            model_id = f'{model_path}|{dni_weight}' if model_path is not None else state_dict_digest(self.model)
+        cache_dir = cache_dir or os.path.join(ROOT_DIR, 'weights', 'compiled')
+        if precision == 'bf16' and engine == 'onnxruntime':
+            raise ValueError('bf16 precision runs with the eager or torchscript engine')
+        if precision == 'int8':
+            if self.device.type != 'cpu' or engine == 'onnxruntime':
+                raise ValueError('int8 precision only runs on the CPU with the eager or torchscript engine')
+            self.engine = QuantizedEngine(
+                self.model, model_id, cache_dir, calibration_dir=calibration_dir or os.path.join(ROOT_DIR, 'inputs'))
+        elif engine == 'eager':
+            self.engine = EagerEngine(self.model)
+        elif engine == 'torchscript':
+            self.engine = TorchScriptEngine(self.model, model_id, cache_dir=cache_dir)
+        elif engine == 'onnxruntime':
+            self.engine = OnnxRuntimeEngine(self.model, model_id, cache_dir=cache_dir)
+        else:
+            raise ValueError(f'Unsupported engine: {engine}')
+
     def dni(self, net_a, net_b, dni_weight, key='params', loc='cpu'):
         """Deep network interpolation.
 
@@ -85,11 +173,16 @@ class RealESRGANer():
             net_a[key][k] = dni_weight[0] * v_a + dni_weight[1] * net_b[key][k]
         return net_a
 
+    @record_function('realesrgan.pre_process')
     def pre_process(self, img):
         """Pre-process, such as pre-pad and mod pad, so that the images can be divisible
+        img is a (h, w, c) image or a (n, h, w, c) batch of images.
         """
-        img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
-        self.img = img.unsqueeze(0).to(self.device)
+        if img.ndim == 4:
+            self.img = torch.from_numpy(np.transpose(img, (0, 3, 1, 2))).float().to(self.device)
+        else:
+            img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
+            self.img = img.unsqueeze(0).to(self.device)
         if self.half:
             self.img = self.img.half()
 
@@ -110,10 +203,19 @@ class RealESRGANer():
                 self.mod_pad_w = (self.mod_scale - w % self.mod_scale)
             self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
 
+    def autocast(self):
+        """Context for the network calls, bfloat16 autocast for bf16 precision."""
+        if self.precision == 'bf16':
+            return torch.autocast(self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    @record_function('realesrgan.process')
     def process(self):
         # model inference
-        self.output = self.model(self.img)
+        with self.autocast():
+            self.output = self.engine(self.img)
 
+    @record_function('realesrgan.tile_process')
     def tile_process(self):
         """It will first crop input images to tiles, and then process each tile.
         Finally, all the processed tiles are merged into one images.
@@ -129,6 +231,9 @@ class RealESRGANer():
         self.output = self.img.new_zeros(output_shape)
         tiles_x = math.ceil(width / self.tile_size)
         tiles_y = math.ceil(height / self.tile_size)
+        # padded shape of the tiles away from the image border, all of them share it
+        padded_tile = self.tile_size + 2 * self.tile_pad
+        self.engine.register_shape((batch, channel, padded_tile, padded_tile))
 
         # loop over all tiles
         for y in range(tiles_y):
@@ -156,8 +261,11 @@ class RealESRGANer():
 
                 # upscale tile
                 try:
-                    with torch.no_grad():
-                        output_tile = self.model(input_tile)
+                    with torch.no_grad(), self.autocast(), record_function('realesrgan.tile'):
+                        if self.tile_cache is None:
+                            output_tile = self.engine(input_tile)
+                        else:
+                            output_tile = self.tile_cache.process((y, x), input_tile, self.engine)
                 except RuntimeError as error:
                     print('Error', error)
                 print(f'\tTile {tile_idx}/{tiles_x * tiles_y}')
@@ -179,6 +287,7 @@ class RealESRGANer():
                             output_start_x:output_end_x] = output_tile[:, :, output_start_y_tile:output_end_y_tile,
                                                                        output_start_x_tile:output_end_x_tile]
 
+    @record_function('realesrgan.post_process')
     def post_process(self):
         # remove extra pad
         if self.mod_scale is not None:
@@ -191,29 +300,31 @@ class RealESRGANer():
         return self.output
 
     @torch.no_grad()
+    @record_function('realesrgan.enhance')
     def enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
         h_input, w_input = img.shape[0:2]
         # img: numpy
-        img = img.astype(np.float32)
-        if np.max(img) > 256:  # 16-bit image
-            max_range = 65535
-            print('\tInput is a 16-bit image')
-        else:
-            max_range = 255
-        img = img / max_range
-        if len(img.shape) == 2:  # gray image
-            img_mode = 'L'
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        elif img.shape[2] == 4:  # RGBA image with alpha channel
-            img_mode = 'RGBA'
-            alpha = img[:, :, 3]
-            img = img[:, :, 0:3]
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            if alpha_upsampler == 'realesrgan':
-                alpha = cv2.cvtColor(alpha, cv2.COLOR_GRAY2RGB)
-        else:
-            img_mode = 'RGB'
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        with record_function('realesrgan.from_numpy'):
+            img = img.astype(np.float32)
+            if np.max(img) > 256:  # 16-bit image
+                max_range = 65535
+                print('\tInput is a 16-bit image')
+            else:
+                max_range = 255
+            img = img / max_range
+            if len(img.shape) == 2:  # gray image
+                img_mode = 'L'
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+            elif img.shape[2] == 4:  # RGBA image with alpha channel
+                img_mode = 'RGBA'
+                alpha = img[:, :, 3]
+                img = img[:, :, 0:3]
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                if alpha_upsampler == 'realesrgan':
+                    alpha = cv2.cvtColor(alpha, cv2.COLOR_GRAY2RGB)
+            else:
+                img_mode = 'RGB'
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         # ------------------- process image (without the alpha channel) ------------------- #
         self.pre_process(img)
@@ -222,10 +333,11 @@ class RealESRGANer():
         else:
             self.process()
         output_img = self.post_process()
-        output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
-        if img_mode == 'L':
-            output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
+        with record_function('realesrgan.to_numpy'):
+            output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+            output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
+            if img_mode == 'L':
+                output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
 
         # ------------------- process the alpha channel if necessary ------------------- #
         if img_mode == 'RGBA':
@@ -236,9 +348,10 @@ class RealESRGANer():
                 else:
                     self.process()
                 output_alpha = self.post_process()
-                output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-                output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
-                output_alpha = cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
+                with record_function('realesrgan.to_numpy'):
+                    output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+                    output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
+                    output_alpha = cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
             else:  # use the cv2 resize for alpha channel
                 h, w = alpha.shape[0:2]
                 output_alpha = cv2.resize(alpha, (w * self.scale, h * self.scale), interpolation=cv2.INTER_LINEAR)
@@ -248,44 +361,149 @@ class RealESRGANer():
             output_img[:, :, 3] = output_alpha
 
         # ------------------------------ return ------------------------------ #
-        if max_range == 65535:  # 16-bit image
-            output = (output_img * 65535.0).round().astype(np.uint16)
-        else:
-            output = (output_img * 255.0).round().astype(np.uint8)
+        with record_function('realesrgan.to_numpy'):
+            if max_range == 65535:  # 16-bit image
+                output = (output_img * 65535.0).round().astype(np.uint16)
+            else:
+                output = (output_img * 255.0).round().astype(np.uint8)
 
         if outscale is not None and outscale != float(self.scale):
-            output = cv2.resize(
-                output, (
-                    int(w_input * outscale),
-                    int(h_input * outscale),
-                ), interpolation=cv2.INTER_LANCZOS4)
+            with record_function('realesrgan.resize'):
+                output = cv2.resize(
+                    output, (
+                        int(w_input * outscale),
+                        int(h_input * outscale),
+                    ), interpolation=cv2.INTER_LANCZOS4)
 
         return output, img_mode
 
+    @torch.no_grad()
+    @record_function('realesrgan.enhance_batch')
+    def enhance_batch(self, imgs, outscale=None):
+        """Upsample frames of the same size (e.g. decoded video frames) with one network call per batch.
+
+        With tile, each tile is upsampled for all the frames at once.
+
+        Args:
+            imgs (list[ndarray]): 8-bit BGR frames of shape (h, w, 3).
+            outscale (float): The final upsampling scale. Default: None, the scale of the network.
+
+        Returns:
+            list[ndarray]: The upsampled frames, in the same order.
+        """
+        h_input, w_input = imgs[0].shape[0:2]
+        assert all(img.shape == (h_input, w_input, 3) and img.dtype == np.uint8 for img in imgs), \
+            'frames of a batch should be 8-bit BGR images of the same size'
+        with record_function('realesrgan.from_numpy'):
+            batch = np.stack([cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in imgs]).astype(np.float32) / 255
+
+        self.pre_process(batch)
+        if self.tile_size > 0:
+            self.tile_process()
+        else:
+            self.process()
+        output_batch = self.post_process()
+        with record_function('realesrgan.to_numpy'):
+            output_batch = output_batch.data.float().cpu().clamp_(0, 1).numpy()
+            output_batch = (np.transpose(output_batch[:, [2, 1, 0], :, :], (0, 2, 3, 1)) * 255.0).round()
+            output_batch = output_batch.astype(np.uint8)
+
+        outputs = list(output_batch)
+        if outscale is not None and outscale != float(self.scale):
+            with record_function('realesrgan.resize'):
+                outputs = [
+                    cv2.resize(
+                        output, (int(w_input * outscale), int(h_input * outscale)),
+                        interpolation=cv2.INTER_LANCZOS4) for output in outputs
+                ]
+        return outputs
+
+    def estimate_batch_size(self, height, width, memory_budget, max_batch_size=64):
+        """Number of (height, width) frames that enhance_batch can process together within memory_budget.
+
+        The memory of a frame is estimated from its input and output tensors, plus the largest layer input and output
+        of the network for the area of one network call (the tile when tile is set). The activation size per pixel
+        is measured once on a small probe, and doubled to account for the tensors a network keeps for later layers
+        (e.g. dense connections).
+
+        Args:
+            height (int): Frame height.
+            width (int): Frame width.
+            memory_budget (int): Bytes available for a batch.
+            max_batch_size (int): Upper bound of the result. Default: 64.
+
+        Returns:
+            int: The batch size, at least 1.
+        """
+        if self.activation_bytes is None:
+            probe = 32
+            largest = [0]
+
+            def measure(module, inputs, output):
+                tensors = [t for t in (*inputs, output) if torch.is_tensor(t)]
+                largest[0] = max(largest[0], sum(t.numel() * t.element_size() for t in tensors))
+
+            leaves = [module for module in self.model.modules() if not list(module.children())]
+            handles = [module.register_forward_hook(measure) for module in leaves]
+            try:
+                x = torch.zeros(1, 3, probe, probe, device=self.device, dtype=next(self.model.parameters()).dtype)
+                with torch.no_grad(), self.autocast():
+                    self.model(x)
+            finally:
+                for handle in handles:
+                    handle.remove()
+            self.activation_bytes = 2 * largest[0] / probe**2
+
+        padded_height, padded_width = height + self.pre_pad + 3, width + self.pre_pad + 3  # with the mod pad
+        if self.tile_size > 0:
+            call_pixels = min(self.tile_size + 2 * self.tile_pad, padded_height) * min(
+                self.tile_size + 2 * self.tile_pad, padded_width)
+        else:
+            call_pixels = padded_height * padded_width
+        element_size = 2 if self.half else 4
+        io_bytes = padded_height * padded_width * 3 * element_size * (1 + self.scale**2)
+        frame_bytes = io_bytes + self.activation_bytes * call_pixels
+        return int(max(1, min(max_batch_size, memory_budget // frame_bytes)))
+
 
 class PrefetchReader(threading.Thread):
     """Prefetch images.
 
+    Images are yielded in the order of img_list, None for an image that cannot be read. Several threads may consume
+    the reader: once it is exhausted, every call to next raises StopIteration.
+
     Args:
         img_list (list[str]): A image list of image paths to be read.
         num_prefetch_queue (int): Number of prefetch queue.
     """
 
+    END = object()
+
     def __init__(self, img_list, num_prefetch_queue):
         super().__init__()
         self.que = queue.Queue(num_prefetch_queue)
         self.img_list = img_list
+        self.stats = StageStats('read')
+
+    def put(self, item):
+        start = time.perf_counter()
+        self.que.put(item)
+        self.stats.wait += time.perf_counter() - start
 
     def run(self):
         for img_path in self.img_list:
+            start = time.perf_counter()
             img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-            self.que.put(img)
+            self.stats.busy += time.perf_counter() - start
+            self.stats.items += 1
+            self.put(img)
 
-        self.que.put(None)
+        self.put(self.END)
 
     def __next__(self):
         next_item = self.que.get()
-        if next_item is None:
+        if next_item is self.END:
+            self.que.put(next_item)  # for the other consumers
             raise StopIteration
         return next_item
 
@@ -300,14 +518,164 @@ class IOConsumer(threading.Thread):
         self._queue = que
         self.qid = qid
         self.opt = opt
+        self.stats = StageStats(f'write {qid}')
+        # a failed write is recorded and the queue keeps being drained, so that the producers never block on it
+        self.errors = []
 
     def run(self):
         while True:
+            start = time.perf_counter()
             msg = self._queue.get()
+            self.stats.wait += time.perf_counter() - start
             if isinstance(msg, str) and msg == 'quit':
                 break
 
             output = msg['output']
             save_path = msg['save_path']
-            cv2.imwrite(save_path, output)
+            start = time.perf_counter()
+            try:
+                if not cv2.imwrite(save_path, output):
+                    raise IOError(f'cannot write {save_path}')
+                self.stats.items += 1
+            except Exception as error:  # cv2.error for unsupported extensions
+                print('Error', error)
+                self.errors.append(error)
+            self.stats.busy += time.perf_counter() - start
         print(f'IO worker {self.qid} is done.')
+
+
+class StageStats():
+    """Time a pipeline stage spent working and waiting on its queues.
+
+    Args:
+        name (str): Name of the stage in the report.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.
+        self.wait = 0.
+        self.items = 0
+
+    @property
+    def utilization(self):
+        total = self.busy + self.wait
+        return self.busy / total if total > 0 else 0.
+
+    def __str__(self):
+        return (f'{self.name}: {self.utilization:.0%} busy ({self.busy:.2f}s working, {self.wait:.2f}s waiting, '
+                f'{self.items} items)')
+
+
+class PipelineStage(threading.Thread):
+    """A pipeline stage, calls fn on each item of in_que and puts the results on out_que.
+
+    A stage without in_que is the source: fn is called without arguments until it returns None. Other stages may
+    return None to drop an item. The end of the stream is passed down as Pipeline.END. When a stage fails, it sets
+    stop so that the source stops producing, and keeps draining its input so that no stage blocks on a full queue.
+
+    Args:
+        name (str): Name of the stage in the report.
+        fn (callable): Function of the stage.
+        in_que (queue.Queue | None): Input queue, None for the source.
+        out_que (queue.Queue | None): Output queue, None for the sink.
+        stop (threading.Event): Set when any stage of the pipeline fails.
+    """
+
+    def __init__(self, name, fn, in_que, out_que, stop):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.in_que = in_que
+        self.out_que = out_que
+        self.stop = stop
+        self.stats = StageStats(name)
+        self.error = None
+
+    def get(self):
+        start = time.perf_counter()
+        item = self.in_que.get()
+        self.stats.wait += time.perf_counter() - start
+        return item
+
+    def put(self, item):
+        start = time.perf_counter()
+        self.out_que.put(item)
+        self.stats.wait += time.perf_counter() - start
+
+    def run(self):
+        try:
+            while not (self.in_que is None and self.stop.is_set()):
+                item = None if self.in_que is None else self.get()
+                if item is Pipeline.END:
+                    break
+                if self.stop.is_set():
+                    continue  # drain
+
+                start = time.perf_counter()
+                output = self.fn() if self.in_que is None else self.fn(item)
+                self.stats.busy += time.perf_counter() - start
+                if output is None:
+                    if self.in_que is None:
+                        break
+                    continue
+                self.stats.items += 1
+                if self.out_que is not None:
+                    self.put(output)
+        except BaseException as error:
+            self.error = error
+            self.stop.set()
+            if self.in_que is not None:
+                while self.in_que.get() is not Pipeline.END:
+                    pass
+        finally:
+            if self.out_que is not None:
+                self.out_que.put(Pipeline.END)
+
+
+class Pipeline():
+    """Runs functions as a chain of threads connected by bounded queues, so that their work overlaps.
+
+    The first function produces the items, each of the following ones is called with the output of the previous one.
+    Items keep their order. The queues bound the number of items in flight (and so the memory used): a stage that is
+    ahead blocks until the next one catches up.
+
+    Args:
+        stages (list[tuple[str, callable]]): (name, fn) of each stage, see PipelineStage.
+        queue_sizes (int | list[int]): Capacity of the queue after each stage but the last. Default: 4.
+    """
+
+    END = object()
+
+    def __init__(self, stages, queue_sizes=4):
+        if isinstance(queue_sizes, int):
+            queue_sizes = [queue_sizes] * (len(stages) - 1)
+        assert len(queue_sizes) == len(stages) - 1, 'one queue size is needed between each pair of stages'
+        assert all(size > 0 for size in queue_sizes), 'queues must be bounded'
+
+        ques = [None] + [queue.Queue(size) for size in queue_sizes] + [None]
+        self.stop = threading.Event()
+        self.stages = [
+            PipelineStage(name, fn, ques[i], ques[i + 1], self.stop) for i, (name, fn) in enumerate(stages)
+        ]
+        self.duration = 0.
+
+    @property
+    def stats(self):
+        return [stage.stats for stage in self.stages]
+
+    def run(self):
+        """Runs the stages until the source is exhausted, raises the error of a failed stage if any."""
+        start = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        for stage in self.stages:
+            stage.join()
+        self.duration = time.perf_counter() - start
+
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+        return self.stats
+
+    def report(self):
+        return '\n'.join([f'pipeline: {self.duration:.2f}s'] + [f'  {stats}' for stats in self.stats])
@@ -0,0 +1,346 @@
+import contextlib
+import cv2
+import hashlib
+import json
+import numpy as np
+import os
+import socket
+import time
+import torch
+from torch.nn import functional as F
+
+
+class DuplicateFrameDetector():
+    """Finds decoded frames that repeat the last upsampled frame, so that its output can be reused.
+
+    Held frames (e.g. anime drawn on twos or threes) and static scenes are detected with a hash of the frame. With a
+    threshold, frames that differ by compression noise only are detected too: frames are compared by the means of
+    their 8x8 grayscale blocks, so that a small moving object still counts as a change. Frames are compared to the
+    reference (the last frame that was not a duplicate), not to the previous frame, so that slow fades cannot drift
+    away from the reused output one small step at a time.
+
+    Args:
+        threshold (float): Largest difference of a block mean (0-255) between duplicates. 0 only detects identical
+            frames. Default: 0.
+    """
+
+    block_size = 8
+
+    def __init__(self, threshold=0.):
+        self.threshold = threshold
+        self.digest = None
+        self.blocks = None
+        self.frames = 0
+        self.duplicates = 0
+
+    @property
+    def skip_ratio(self):
+        return self.duplicates / self.frames if self.frames > 0 else 0.
+
+    def block_means(self, img):
+        h, w = img.shape[0:2]
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+        size = (max(1, w // self.block_size), max(1, h // self.block_size))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def is_duplicate(self, img):
+        """Whether img repeats the reference frame, otherwise it becomes the new reference."""
+        self.frames += 1
+        digest = hashlib.blake2b(np.ascontiguousarray(img).data, digest_size=16).digest() + str(img.shape).encode()
+        if digest == self.digest:
+            self.duplicates += 1
+            return True
+
+        blocks = self.block_means(img) if self.threshold > 0 else None
+        if (blocks is not None and self.blocks is not None and blocks.shape == self.blocks.shape
+                and np.abs(blocks - self.blocks).max() <= self.threshold):
+            self.duplicates += 1
+            return True
+
+        self.digest = digest
+        self.blocks = blocks
+        return False
+
+
+class FrameBatcher():
+    """Reads frames into batches of consecutive frames of the same size, with duplicate frames folded in.
+
+    Called without arguments, returns (frames, repeats) or None once get_frame is exhausted. repeats[i] is the number
+    of times frames[i] occurs in a row in the stream, so the stream is rebuilt by repeating the output of each frame.
+    A batch is sent once the next non-duplicate frame is read, which starts the next batch.
+
+    Args:
+        get_frame (callable): Returns the next frame, None at the end of the stream.
+        batch_size (int): Largest number of frames of a batch.
+        detector (DuplicateFrameDetector): Detects duplicate frames. Default: None, no frame is skipped.
+    """
+
+    def __init__(self, get_frame, batch_size, detector=None):
+        self.get_frame = get_frame
+        self.batch_size = batch_size
+        self.detector = detector
+        self.pending = None
+
+    def __call__(self):
+        frames, repeats = [], []
+        if self.pending is not None:
+            frames.append(self.pending)
+            repeats.append(1)
+            self.pending = None
+
+        while True:
+            img = self.get_frame()
+            if img is None:
+                break
+            if self.detector is not None and self.detector.is_duplicate(img) and frames:
+                repeats[-1] += 1
+                continue
+            if len(frames) == self.batch_size or (frames and img.shape != frames[0].shape):
+                self.pending = img
+                break
+            frames.append(img)
+            repeats.append(1)
+        return (frames, repeats) if frames else None
+
+
+class TemporalTileCache():
+    """Output tiles of the previous frames, so that tiles whose input did not change are not upsampled again.
+
+    Set as ``tile_cache`` of a RealESRGANer with tile, it is consulted for every tile of consecutive frames (or batches
+    of frames). The output of a tile only depends on its input padded with tile_pad, so a tile whose padded input is
+    unchanged gets the cached output, and with threshold 0 the result is the same as without the cache. Tiles are
+    compared to the input of the last computed output (not of the previous frame), so that slow changes cannot drift
+    away from the reused output.
+
+    Args:
+        threshold (float): Largest difference (0-255) of an 8x8 block mean between padded input tiles whose output is
+            reused. 0 only reuses identical tiles. Default: 0.
+    """
+
+    block_size = 8
+
+    def __init__(self, threshold=0.):
+        self.threshold = threshold
+        self.tiles = {}  # tile position: (padded input, output) of the last computed frame
+        self.computed = 0
+        self.reused = 0
+
+    @property
+    def reuse_ratio(self):
+        total = self.computed + self.reused
+        return self.reused / total if total > 0 else 0.
+
+    def reset(self):
+        self.tiles.clear()
+
+    def is_unchanged(self, reference, input_tile):
+        if reference.shape != input_tile.shape:
+            return False
+        if self.threshold <= 0:
+            return torch.equal(reference, input_tile)
+        # signed block means, so that noise cancels out while a moving object does not
+        blocks = F.avg_pool2d((reference - input_tile).float().unsqueeze(0), self.block_size, ceil_mode=True)
+        # rounded, inputs are 8-bit values divided by 255
+        return round(blocks.abs().max().item() * 255, 3) <= self.threshold
+
+    def process(self, key, input_tile, upsample):
+        """Output of a (n, c, h, w) input tile at position key, upsample is only called with the changed frames."""
+        cached = self.tiles.get(key)
+        reference = None if cached is None else cached[0]
+        changed = []
+        sources = []  # per frame, index of its output in the changed frames, -1 for the cached output
+        for i in range(input_tile.shape[0]):
+            if reference is None or not self.is_unchanged(reference, input_tile[i]):
+                changed.append(i)
+                reference = input_tile[i]
+            sources.append(len(changed) - 1)
+
+        computed = upsample(input_tile[changed]) if changed else None
+        self.computed += len(changed)
+        self.reused += input_tile.shape[0] - len(changed)
+        if changed:
+            # copies, the tiles are views of the whole batch
+            self.tiles[key] = (input_tile[changed[-1]].clone(), computed[-1].clone())
+        return torch.stack([cached[1] if source < 0 else computed[source] for source in sources])
+
+
+def shard_ranges(num_frames, num_shards):
+    """Split frames 0..num_frames into num_shards consecutive [start, end) ranges whose lengths differ by one at most.
+
+    Args:
+        num_frames (int): Number of frames of the input.
+        num_shards (int): Number of workers.
+
+    Returns:
+        list[tuple[int, int]]: The frame range of each worker, in order.
+    """
+    return [(num_frames * i // num_shards, num_frames * (i + 1) // num_shards) for i in range(num_shards)]
+
+
+class SegmentManifest():
+    """Fixed-length segments of a video job, shared through a folder by the workers of one or more machines.
+
+    manifest.json describes the job and lists its segments (frame ranges) with the ones that are done, so that an
+    interrupted job resumes with the remaining segments. A worker claims a segment by creating its lock file
+    exclusively and keeps it alive with heartbeat() while it works. The lock of a worker that died is taken over: at
+    once when its process no longer runs on this machine, otherwise after stale_after seconds without heartbeat.
+
+    Args:
+        folder (str): Folder of the manifest, the locks and the segment outputs. It may be on a shared filesystem.
+        stale_after (float): Seconds without heartbeat after which a lock is taken over. Default: 600.
+    """
+
+    def __init__(self, folder, stale_after=600):
+        self.folder = folder
+        self.stale_after = stale_after
+        self.path = os.path.join(folder, 'manifest.json')
+        os.makedirs(folder, exist_ok=True)
+
+    def segment_path(self, index):
+        return os.path.join(self.folder, f'{index:05d}.mp4')
+
+    def part_path(self, index):
+        """Output of a segment while it is upsampled, per worker in case two of them end up on the same segment."""
+        return os.path.join(self.folder, f'{index:05d}.{socket.gethostname()}.{os.getpid()}.part.mp4')
+
+    def lock_path(self, index):
+        return os.path.join(self.folder, f'{index:05d}.lock')
+
+    def is_stale(self, lock_path):
+        try:
+            age = time.time() - os.path.getmtime(lock_path)
+            with open(lock_path) as f:
+                owner = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError:  # being written
+            return age > self.stale_after
+        if owner.get('host') == socket.gethostname():
+            try:
+                os.kill(owner['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return age > self.stale_after
+
+    def take_over(self, lock_path):
+        """Moves a stale lock out of the way, returns whether it did.
+
+        Several workers may find the same lock stale. The lock is renamed to a name of this worker, which only one of
+        them can do, and the renamed file is checked again since it may be the fresh lock of the worker that took it
+        over in the meantime. In that case it is put back (without replacing a newer lock).
+        """
+        moved_path = f'{lock_path}.{socket.gethostname()}.{os.getpid()}.stale'
+        try:
+            os.rename(lock_path, moved_path)
+        except FileNotFoundError:
+            return False
+        if not self.is_stale(moved_path):
+            with contextlib.suppress(FileExistsError):
+                os.link(moved_path, lock_path)
+            os.remove(moved_path)
+            return False
+        os.remove(moved_path)
+        print(f'Took over the stale lock {lock_path}')
+        return True
+
+    def try_lock(self, lock_path):
+        """Creates lock_path if it does not exist (or is stale), returns whether it did."""
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.is_stale(lock_path) or not self.take_over(lock_path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, f)
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Serializes the updates of the manifest."""
+        lock_path = os.path.join(self.folder, 'manifest.lock')
+        while not self.try_lock(lock_path):
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+
+    def load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, manifest):
+        # readers never see a partial manifest
+        tmp_path = f'{self.path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def create(self, job, num_frames, segment_frames):
+        """Writes the manifest of a new job, or checks that the existing one is for the same job.
+
+        Args:
+            job (dict): Settings that the output depends on (JSON serializable), e.g. the model and the scale.
+            num_frames (int): Number of frames of the input.
+            segment_frames (int): Number of frames of a segment.
+
+        Returns:
+            list[dict]: The segments, with their index, frame range (start, end) and whether they are done.
+        """
+        job = json.loads(json.dumps(job))
+        with self.locked():
+            if os.path.isfile(self.path):
+                manifest = self.load()
+                layout = (manifest['job'], manifest['num_frames'], manifest['segment_frames'])
+                if layout != (job, num_frames, segment_frames):
+                    raise ValueError(f'{self.folder} holds the segments of a different job or settings, '
+                                     'delete it or use another output folder')
+            else:
+                manifest = {
+                    'job': job,
+                    'num_frames': num_frames,
+                    'segment_frames': segment_frames,
+                    'segments': [{
+                        'index': index,
+                        'start': start,
+                        'end': min(start + segment_frames, num_frames),
+                        'done': False
+                    } for index, start in enumerate(range(0, num_frames, segment_frames))]
+                }
+                self.save(manifest)
+        return manifest['segments']
+
+    def remaining(self):
+        return [segment for segment in self.load()['segments'] if not segment['done']]
+
+    def claim(self):
+        """Locks the next segment that is neither done nor locked by a live worker, None when there is none left."""
+        for segment in self.remaining():
+            if not self.try_lock(self.lock_path(segment['index'])):
+                continue
+            # it may have been completed since the manifest was read
+            if self.load()['segments'][segment['index']]['done']:
+                self.release(segment['index'])
+                continue
+            return segment
+        return None
+
+    def heartbeat(self, index):
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self.lock_path(index))
+
+    def complete(self, index, **stats):
+        """Marks a segment done, once its output is in segment_path(index)."""
+        with self.locked():
+            manifest = self.load()
+            manifest['segments'][index].update(done=True, host=socket.gethostname(), completed=time.time(), **stats)
+            self.save(manifest)
+
+    def release(self, index):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.lock_path(index))
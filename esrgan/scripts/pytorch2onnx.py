@@ -1,8 +1,9 @@
 import argparse
 import torch
-import torch.onnx
 from basicsr.archs.rrdbnet_arch import RRDBNet
 
+from realesrgan.engine import export_onnx
+
 
 def main(args):
     # An instance of the model
@@ -16,12 +17,9 @@ def main(args):
     model.train(False)
     model.cpu().eval()
 
-    # An example input
-    x = torch.rand(1, 3, 64, 64)
-    # Export the model
-    with torch.no_grad():
-        torch_out = torch.onnx._export(model, x, args.output, opset_version=11, export_params=True)
-    print(torch_out.shape)
+    # Export the model, the input size is dynamic
+    export_onnx(model, args.output)
+    print(f'Exported to {args.output}. To export every model of config/params.json, run: python -m server.export')
 
 
 if __name__ == '__main__':
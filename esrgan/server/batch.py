@@ -0,0 +1,181 @@
+"""
+Batch upscaling for POST /upscale/batch.
+
+The request's files (images, or .zip/.tar archives of images) are copied to temporary files, since FastAPI closes
+uploads once the endpoint returns, and read one image at a time. At most `concurrency` images are in flight, so
+memory does not grow with the size of the batch. Images larger than ESRGAN_BATCH_MAX_IMAGE_MB (their uncompressed size
+for archive members) are not read, they are reported as errors in the manifest. Results are yielded as they complete,
+followed by manifest.json.
+"""
+from fastapi import UploadFile
+from itertools import chain
+from pathlib import PurePosixPath
+from time import perf_counter
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Iterator, List, Optional, Set, Tuple, Union
+import asyncio
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
+
+from server import schemas
+from server.pool import JobResult
+from server.zipstream import stream_zip, unique_name
+
+MANIFEST_NAME = "manifest.json"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+MAX_IMAGE_SIZE: int = int(os.environ.get("ESRGAN_BATCH_MAX_IMAGE_MB", 64)) * 2**20
+
+# Upscales one image (name, content) on the worker pool
+TUpscale = Callable[[str, bytes], Awaitable[JobResult]]
+# (name, content) of an input, or (name, error) when it could not be read
+TInput = Tuple[str, Union[bytes, ValueError]]
+
+class ImageTooLargeError(ValueError):
+    """The image is larger than the maximum size, it was not read"""
+
+def safe_name(name: str) -> str:
+    """Relative path without '..', for names taken from the request or from archives"""
+    parts = [part for part in PurePosixPath(name.replace("\\", "/")).parts if part not in ("/", ".", "..")]
+    return "/".join(parts) or "image"
+
+def is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+async def spool_uploads(files: List[UploadFile]) -> List[Tuple[str, BinaryIO]]:
+    """Copies the uploads to temporary files owned by the caller"""
+    spooled: List[Tuple[str, BinaryIO]] = []
+    for file in files:
+        temporary = tempfile.TemporaryFile()
+        await run_in_threadpool(shutil.copyfileobj, file.file, temporary)
+        temporary.seek(0)
+        spooled.append((file.filename or "image", temporary))
+    return spooled
+
+def read_input(name: str, size: int, max_size: int, read: Callable[[], bytes]) -> TInput:
+    """Only reads the input when its (uncompressed) size is within max_size"""
+    if size > max_size:
+        return name, ImageTooLargeError(f"'{name}' ({size} bytes) is larger than the maximum size ({max_size} bytes)")
+    return name, read()
+
+def read_zip(archive: zipfile.ZipFile, max_size: int) -> Iterator[TInput]:
+    for info in archive.infolist():
+        if not info.is_dir() and is_image(info.filename):
+            # reading a member stops at its declared size
+            yield read_input(safe_name(info.filename), info.file_size, max_size, lambda: archive.read(info))
+
+def read_tar(archive: tarfile.TarFile, max_size: int) -> Iterator[TInput]:
+    for member in archive:
+        if member.isfile() and is_image(member.name):
+            yield read_input(safe_name(member.name), member.size, max_size, lambda: archive.extractfile(member).read())
+
+def read_file(name: str, file: BinaryIO, max_size: int) -> Iterator[TInput]:
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    yield read_input(safe_name(name), size, max_size, file.read)
+
+def open_inputs(files: List[Tuple[str, BinaryIO]], max_size: int = MAX_IMAGE_SIZE) -> Iterator[TInput]:
+    """(name, content) of every image, archives are opened here so that invalid ones fail before streaming"""
+    inputs: List[Iterator[TInput]] = []
+    for name, file in files:
+        lower = name.lower()
+        try:
+            if lower.endswith(".zip"):
+                inputs.append(read_zip(zipfile.ZipFile(file), max_size))
+            elif lower.endswith(TAR_EXTENSIONS):
+                inputs.append(read_tar(tarfile.open(fileobj=file, mode="r:*"), max_size))
+            else:
+                inputs.append(read_file(name, file, max_size))
+        except (zipfile.BadZipFile, tarfile.TarError) as error:
+            raise ValueError(f"'{name}' is not a valid archive: {error}") from error
+    return chain.from_iterable(inputs)
+
+async def upscale_batch(
+    inputs: Iterator[TInput],
+    upscale: TUpscale,
+    concurrency: int
+) -> AsyncIterator[Tuple[str, bytes]]:
+    """Upscales up to concurrency images at a time, yields (name, image) as they complete, then the manifest"""
+    start = perf_counter()
+    used: Set[str] = {MANIFEST_NAME}
+    items: List[schemas.BatchItem] = []
+
+    async def run(
+        name: str,
+        content: Union[bytes, ValueError],
+        started_s: float
+    ) -> Tuple[schemas.BatchItem, Optional[bytes]]:
+        try:
+            if isinstance(content, ValueError):
+                raise content
+            job = await upscale(name, content)
+        except Exception as error:
+            logger.warning(f"Batch image '{name}' failed: {error}")
+            return schemas.BatchItem(
+                name=name,
+                started_s=started_s,
+                duration_s=perf_counter() - start - started_s,
+                error=str(error)
+            ), None
+        return schemas.BatchItem(
+            name=name,
+            output=unique_name(name, used),
+            started_s=started_s,
+            duration_s=perf_counter() - start - started_s,
+            job=job.stats,
+            plan=job.value.plan
+        ), job.value.image
+
+    running: Set[asyncio.Future] = set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(running) < concurrency:
+                # reads from the archives in order, outside of the event loop
+                entry: Optional[TInput] = await run_in_threadpool(next, inputs, None)
+                if entry is None:
+                    exhausted = True
+                else:
+                    running.add(asyncio.ensure_future(run(*entry, perf_counter() - start)))
+            if not running:
+                break
+
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item, image = task.result()
+                items.append(item)
+                if image is not None:
+                    yield item.output, image
+    finally:
+        for task in running:
+            task.cancel()
+
+    manifest = schemas.BatchManifest(
+        items=items,
+        succeeded=sum(item.error is None for item in items),
+        failed=sum(item.error is not None for item in items),
+        duration_s=perf_counter() - start
+    )
+    logger.info(
+        f"Batch done, succeeded='{manifest.succeeded}', failed='{manifest.failed}', "
+        f"duration='{manifest.duration_s:.1f}s'"
+    )
+    yield MANIFEST_NAME, manifest.model_dump_json(indent=2).encode()
+
+async def stream_batch(
+    files: List[Tuple[str, BinaryIO]],
+    inputs: Iterator[TInput],
+    upscale: TUpscale,
+    concurrency: int
+) -> AsyncIterator[bytes]:
+    """ZIP of the upscaled inputs and manifest.json, closes the files the inputs are read from when done"""
+    try:
+        async for chunk in stream_zip(upscale_batch(inputs, upscale, concurrency)):
+            yield chunk
+    finally:
+        for _, file in files:
+            file.close()
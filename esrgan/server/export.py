@@ -0,0 +1,47 @@
+"""
+Exports the models in config/params.json to ONNX for the "onnxruntime" engine.
+
+Graphs land in the same cache the server reads from, so exporting ahead of time spares the first request the export.
+Models with a denoise strength (DNI blended weights) are exported once per requested strength.
+
+    python -m server.export --denoise_strengths 0 0.5 1
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, List
+from loguru import logger
+
+from server.util import model_params, get_dni_weights, make_upsampler
+
+def export_model(model_name: str, denoise_strength: float = 0.5) -> str:
+    upsampler = make_upsampler(model_name, denoise_strength, engine="onnxruntime")
+    return upsampler.engine.path
+
+def export_models(model_names: List[str], denoise_strengths: List[float]) -> Dict[str, str]:
+    exported: Dict[str, str] = {}
+    for model_name in model_names:
+        if get_dni_weights(model_name, 0) is None:
+            exported[model_name] = export_model(model_name)
+        else:
+            for denoise_strength in denoise_strengths:
+                exported[f"{model_name}@{denoise_strength}"] = export_model(model_name, denoise_strength)
+    return exported
+
+def main() -> None:
+    model_names = [name for name, model in model_params.items() if model.root.type != "face-enhance"]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=model_names, choices=model_names)
+    parser.add_argument("--denoise_strengths", nargs="+", type=float, default=[0.5])
+    args = parser.parse_args()
+
+    exported = export_models(args.models, args.denoise_strengths)
+    for key, path in exported.items():
+        logger.info(f"Exported '{key}' to '{path}'")
+
+    manifest_path = Path(next(iter(exported.values()))).parent / "manifest.json"
+    with open(manifest_path, "w") as hFile:
+        json.dump(exported, hFile, indent=4)
+
+if __name__ == "__main__":
+    main()
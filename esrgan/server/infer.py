@@ -1,12 +1,34 @@
 from typing import Optional, Union
+from gfpgan import GFPGANer
 from loguru import logger
 import cv2
 import numpy as np
 
-from realesrgan import RealESRGANer
-from server.util import model_params, get_model_path, get_dni_weights, make_model, make_face_enhancement_model, omit
+from realesrgan.utils import RealESRGANer
+
+from server.util import model_params, make_upsampler, make_face_enhancement_model, omit
+from server.planner import plan_inference, prepare_input, get_output_outscale, finalize_output
 from server import schemas
 
+def upscale_image(
+    cv_image: np.ndarray,
+    plan: schemas.InferencePlan,
+    upsampler: RealESRGANer,
+    face_enhancer: Optional[GFPGANer] = None
+) -> np.ndarray:
+    """Upscales a decoded image along the plan, shared by images and video frames"""
+    input_size = cv_image.shape[0:2]
+    cv_image = prepare_input(cv_image, plan)
+
+    cv_output: Union[None | np.ndarray] = None
+    if face_enhancer is not None:
+        logger.debug(f"Upscaling using face-enhancer, outscale='{plan.outscale}'")
+        _,_, cv_output =face_enhancer.enhance(cv_image, has_aligned=False, only_center_face=False, paste_back=True)
+    else:
+        logger.debug(f"Upscaling without face-enhancer, outscale='{plan.outscale}'")
+        cv_output, _ = upsampler.enhance(cv_image, outscale=get_output_outscale(plan))
+    return finalize_output(cv_output, plan, input_size)
+
 def infer(
     image_extension: str, # includes the dot
     image_bytes: bytes,
@@ -17,46 +39,41 @@ def infer(
     tile_pad:int = 10,
     pre_pad:int = 0,
     face_enhance:bool = False,
-    fp_32: bool = True,
-    gpu_id: Optional[int] = None
-) -> bytes:
+    fp_32: bool = True, # False means precision="auto"
+    gpu_id: Optional[int] = None,
+    plan_policy: schemas.TPlanPolicy = "exact",
+    engine: schemas.TEngine = "eager",
+    precision: Optional[schemas.TPrecision] = None # takes precedence over fp_32
+) -> schemas.InferenceResult:
     logger.info(f"[Inference], params='{omit(locals(), ['image_bytes'])}'")
 
-    params = model_params[model_name].root
-    logger.info(f"Using model '{model_name}', params='{params.model_dump_json()}'")
-
-    model_path = get_model_path(model_name)
-
-    model = make_model(model_name)
-
     # Convert image to OpenCV buffer
     image_np = np.frombuffer(image_bytes, np.uint8)
     cv_image = cv2.imdecode(image_np, cv2.IMREAD_UNCHANGED)
 
+    plan = plan_inference(model_name, outscale, plan_policy, face_enhance, cv_image.shape[0:2])
+    model_name = plan.model_name
+
+    params = model_params[model_name].root
+    logger.info(f"Using model '{model_name}', params='{params.model_dump_json()}'")
+
     # restorer
-    upsampler = RealESRGANer(
-        scale=params.params.get_scale(),
-        model_path=model_path,
-        dni_weight=get_dni_weights(model_name, denoise_strength),
-        model=model,
+    upsampler = make_upsampler(
+        model_name,
+        denoise_strength,
         tile=tile,
         tile_pad=tile_pad,
         pre_pad=pre_pad,
-        half=(fp_32 == False),
-        gpu_id=gpu_id
+        precision=precision or ("fp32" if fp_32 else "auto"),
+        gpu_id=gpu_id,
+        engine=engine
     )
+    face_enhancer = make_face_enhancement_model(upsampler, outscale) if face_enhance else None
 
     # Infer
-    cv_output: Union[None | np.ndarray] = None
-    if face_enhance:
-        logger.debug(f"Upscaling using face-enhancer, outscale='{outscale}'")
-        face_enhancer = make_face_enhancement_model(upsampler, outscale)
-        _,_, cv_output =face_enhancer.enhance(cv_image, has_aligned=False, only_center_face=False, paste_back=True)
-    else:
-        logger.debug(f"Upscaling without face-enhancer, outscale='{outscale}'")
-        cv_output, _ = upsampler.enhance(cv_image, outscale=outscale)
+    cv_output = upscale_image(cv_image, plan, upsampler, face_enhancer)
 
     logger.debug(f"Decoding cv image back to bytes")
     # Convert back to bytes
     image_bytes: bytes = cv2.imencode(image_extension, cv_output)[1].tobytes()
-    return image_bytes
\ No newline at end of file
+    return schemas.InferenceResult(image=image_bytes, plan=plan)
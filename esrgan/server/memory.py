@@ -0,0 +1,63 @@
+from typing import Dict, List, Optional
+import multiprocessing
+import os
+
+from server.schemas import ProcessMemory, TProcessRole
+
+def read_smaps_rollup(pid: int) -> Dict[str, int]:
+    """Memory counters of a process in bytes, from /proc/<pid>/smaps_rollup (Linux >= 4.14)"""
+    counters: Dict[str, int] = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as hFile:
+        for line in hFile:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                counters[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return counters
+
+def get_process_memory(pid: int, role: TProcessRole) -> ProcessMemory:
+    counters = read_smaps_rollup(pid)
+    return ProcessMemory(
+        pid=pid,
+        role=role,
+        rss=counters.get("Rss", 0),
+        pss=counters.get("Pss", 0),
+        shared=counters.get("Shared_Clean", 0) + counters.get("Shared_Dirty", 0),
+        private=counters.get("Private_Clean", 0) + counters.get("Private_Dirty", 0)
+    )
+
+def read_status(pid: int) -> Dict[str, int]:
+    """Memory counters (Vm*) of a process in bytes, from /proc/<pid>/status"""
+    counters: Dict[str, int] = {}
+    with open(f"/proc/{pid}/status", "r") as hFile:
+        for line in hFile:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                counters[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return counters
+
+def reset_peak_rss() -> Optional[int]:
+    """Resets the peak RSS (VmHWM) of this process, returns the current RSS, None where unsupported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as hFile:
+            hFile.write("5")
+        return read_status(os.getpid())["VmRSS"]
+    except (OSError, KeyError):
+        return None
+
+def read_peak_rss() -> Optional[int]:
+    """Peak RSS of this process since the last reset_peak_rss()"""
+    try:
+        return read_status(os.getpid())["VmHWM"]
+    except (OSError, KeyError):
+        return None
+
+def memory_report() -> List[ProcessMemory]:
+    """Memory of this process and of its children (the inference workers)"""
+    report = [get_process_memory(os.getpid(), "server")]
+    for child in multiprocessing.active_children():
+        try:
+            report.append(get_process_memory(child.pid, "worker"))
+        except FileNotFoundError:
+            # exited in the meantime
+            pass
+    return report
@@ -0,0 +1,78 @@
+from typing import List, Optional, Tuple
+from loguru import logger
+import cv2
+import numpy as np
+
+from server.util import model_params
+from server.schemas import InferencePlan, TModelNames, TPlanPolicy
+
+# Inputs are never shrunk below this many pixels on their shortest side
+MIN_DOWNSCALED_SIZE = 16
+
+def get_family_members(model_name: TModelNames) -> List[str]:
+    family = model_params[model_name].root.family
+    if family is None:
+        return [model_name]
+
+    return [
+        name for name, model in model_params.items()
+        if model.root.type != "face-enhance" and model.root.family == family
+    ]
+
+def plan_inference(
+    model_name: TModelNames,
+    outscale: float,
+    policy: TPlanPolicy = "exact",
+    face_enhance: bool = False,
+    image_size: Optional[Tuple[int, int]] = None # (height, width)
+) -> InferencePlan:
+    native_scale: int = model_params[model_name].root.params.get_scale()
+    plan = InferencePlan(
+        policy=policy,
+        requested_model=model_name,
+        model_name=model_name,
+        model_scale=native_scale,
+        outscale=outscale
+    )
+
+    if policy == "exact" or outscale >= native_scale:
+        return plan
+
+    # Cheapest member of the family that still reaches the requested outscale natively
+    candidates = [
+        (model_params[name].root.params.get_scale(), name) for name in get_family_members(model_name)
+        if model_params[name].root.params.get_scale() >= outscale
+    ]
+    candidate_scale, candidate_name = min(candidates)
+    plan.model_name = candidate_name
+    plan.model_scale = candidate_scale
+
+    # Face enhancement needs the full resolution input to detect faces reliably
+    pre_downscale = candidate_scale / outscale
+    if pre_downscale > 1 and not face_enhance:
+        if image_size is None or min(image_size) / pre_downscale >= MIN_DOWNSCALED_SIZE:
+            plan.pre_downscale = pre_downscale
+
+    logger.info(f"Planned inference, plan='{plan.model_dump_json()}'")
+    return plan
+
+def prepare_input(image: np.ndarray, plan: InferencePlan) -> np.ndarray:
+    if plan.pre_downscale == 1:
+        return image
+
+    h, w = image.shape[0:2]
+    size = (max(1, round(w / plan.pre_downscale)), max(1, round(h / plan.pre_downscale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def get_output_outscale(plan: InferencePlan) -> float:
+    """Outscale to pass to the upsampler, relative to the (possibly downscaled) input"""
+    return plan.outscale * plan.pre_downscale
+
+def finalize_output(output: np.ndarray, plan: InferencePlan, input_size: Tuple[int, int]) -> np.ndarray:
+    """Fixes off-by-one sizes caused by rounding in prepare_input"""
+    h, w = input_size
+    target = (int(w * plan.outscale), int(h * plan.outscale))
+    if (output.shape[1], output.shape[0]) == target:
+        return output
+
+    return cv2.resize(output, target, interpolation=cv2.INTER_LANCZOS4)
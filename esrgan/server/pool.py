@@ -0,0 +1,120 @@
+"""
+Inference worker pool with per-job memory accounting and recycling of workers.
+
+Each worker is a single-process ProcessPoolExecutor that only receives a job when it is idle, jobs wait in the pool
+instead. So when a worker dies (e.g. killed by the OOM-killer) only its running job fails, the worker is re-created
+and the queued jobs are unaffected. Workers are also replaced after max_jobs_per_worker jobs, or when their RSS after a
+job exceeds max_worker_rss, to give back memory fragmented by very large images. The RSS is only checked once the job
+finished, a job that grows the worker past max_worker_rss runs to completion before the worker is replaced.
+A job cannot be cancelled once it was sent to its worker: when the caller is cancelled the job keeps running, and the
+worker only becomes idle again when it is done.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+from typing import Any, Callable, List, NamedTuple, Optional
+import asyncio
+import os
+from loguru import logger
+import torch
+
+from server.memory import read_peak_rss, read_status, reset_peak_rss
+from server.schemas import JobStats
+
+class JobResult(NamedTuple):
+    value: Any
+    stats: JobStats
+
+class WorkerCrashedError(RuntimeError):
+    """The worker running the job died, typically killed by the OOM-killer"""
+
+def run_job(fn: Callable[..., Any], *args: Any) -> JobResult:
+    """Runs in the worker, calls fn and measures it"""
+    rss_before: Optional[int] = reset_peak_rss()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    start = perf_counter()
+    value = fn(*args)
+    duration = perf_counter() - start
+
+    peak_rss: Optional[int] = read_peak_rss()
+    rss: Optional[int] = read_status(os.getpid()).get("VmRSS") if rss_before is not None else None
+    return JobResult(value, JobStats(
+        pid=os.getpid(),
+        duration_s=duration,
+        rss_before=rss_before,
+        peak_rss=peak_rss,
+        rss=rss,
+        cuda_peak_allocated=torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+    ))
+
+class Worker:
+    def __init__(self) -> None:
+        self.executor = ProcessPoolExecutor(max_workers=1)
+        self.jobs = 0
+
+    def restart(self) -> None:
+        self.executor.shutdown(wait=False)
+        self.executor = ProcessPoolExecutor(max_workers=1)
+        self.jobs = 0
+
+class WorkerPool:
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_jobs_per_worker: Optional[int] = None,
+        max_worker_rss: Optional[int] = None # bytes
+    ) -> None:
+        self.max_workers = max_workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_worker_rss = max_worker_rss
+        self.workers: List[Worker] = [Worker() for _ in range(max_workers)]
+        # created on first use, it must belong to the running event loop
+        self.idle: Optional[asyncio.Queue] = None
+
+    def should_recycle(self, worker: Worker, stats: JobStats) -> bool:
+        if self.max_jobs_per_worker is not None and worker.jobs >= self.max_jobs_per_worker:
+            logger.info(f"Recycling worker '{stats.pid}' after {worker.jobs} jobs")
+            return True
+        if self.max_worker_rss is not None and stats.rss is not None and stats.rss > self.max_worker_rss:
+            logger.warning(f"Recycling worker '{stats.pid}', rss='{stats.rss}' exceeds '{self.max_worker_rss}'")
+            return True
+        return False
+
+    def release(self, worker: Worker, future: asyncio.Future) -> None:
+        """Called when the job of the worker is done, whether or not its caller is still waiting for it"""
+        error = future.exception() if not future.cancelled() else None
+        if isinstance(error, BrokenProcessPool):
+            logger.error(f"Worker died while running a job, restarting it: {error}")
+            worker.restart()
+        elif error is None and not future.cancelled():
+            result: JobResult = future.result()
+            worker.jobs += 1
+            logger.info(f"[Job] {result.stats.model_dump_json()}")
+            if self.should_recycle(worker, result.stats):
+                worker.restart()
+        self.idle.put_nowait(worker)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> JobResult:
+        """Runs fn(*args) on the next idle worker"""
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for worker in self.workers:
+                self.idle.put_nowait(worker)
+
+        worker: Worker = await self.idle.get()
+        try:
+            future = asyncio.wrap_future(worker.executor.submit(run_job, fn, *args))
+        except BaseException:
+            self.idle.put_nowait(worker)
+            raise
+        future.add_done_callback(lambda future: self.release(worker, future))
+        try:
+            # shielded: cancelling the caller must not release the worker while its process still runs the job
+            return await asyncio.shield(future)
+        except BrokenProcessPool as error:
+            raise WorkerCrashedError("The worker running the job died, most likely out of memory") from error
+
+    def shutdown(self) -> None:
+        for worker in self.workers:
+            worker.executor.shutdown(wait=False)
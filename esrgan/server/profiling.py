@@ -0,0 +1,108 @@
+"""
+On-demand profiling of single inference requests.
+
+A request is profiled when it asks for it (admin only, see main.py) or when ESRGAN_PROFILE is set. The profile runs
+in the worker, around server.infer.infer, and is written to ESRGAN_PROFILE_DIR:
+- <id>.trace.json: torch.profiler Chrome trace (chrome://tracing or https://ui.perfetto.dev), with a range per
+  nn.Module forward and per RealESRGANer stage (tiles, numpy conversions, ...)
+- <id>.pstats: cProfile statistics (python -m pstats, snakeviz, ...)
+"""
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional, Tuple, get_args
+import cProfile
+import hmac
+import os
+import uuid
+from loguru import logger
+import torch
+from torch.profiler import ProfilerActivity, record_function
+
+from server import schemas
+from server.infer import infer
+
+PROFILE_DIR: str = os.environ.get("ESRGAN_PROFILE_DIR", f"{Path(__file__).parent.parent}/profiles")
+# Profiles every request when set to one of schemas.TProfiler
+DEFAULT_PROFILER: Optional[str] = os.environ.get("ESRGAN_PROFILE") or None
+# Requests may only ask for a profile with this token, unset disables profiling on request
+ADMIN_TOKEN: Optional[str] = os.environ.get("ESRGAN_ADMIN_TOKEN") or None
+
+if DEFAULT_PROFILER is not None and DEFAULT_PROFILER not in get_args(schemas.TProfiler):
+    raise ValueError(f"ESRGAN_PROFILE must be one of {get_args(schemas.TProfiler)}, got '{DEFAULT_PROFILER}'")
+
+def is_admin(token: Optional[str]) -> bool:
+    return ADMIN_TOKEN is not None and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def new_profile_id() -> str:
+    return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+@contextmanager
+def label_modules() -> Iterator[None]:
+    """Adds a profiler range around the forward of every nn.Module, so that ops are attributed to layers"""
+    ranges: List[record_function] = []
+
+    def enter(module: torch.nn.Module, args: Any) -> None:
+        ranges.append(record_function(f"nn.{type(module).__name__}"))
+        ranges[-1].__enter__()
+
+    def exit(module: torch.nn.Module, args: Any, output: Any) -> None:
+        ranges.pop().__exit__(None, None, None)
+
+    handles = [
+        torch.nn.modules.module.register_module_forward_pre_hook(enter),
+        torch.nn.modules.module.register_module_forward_hook(exit)
+    ]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+def profile_call(
+    profiler: schemas.TProfiler,
+    fn: Callable[..., Any],
+    *args: Any,
+    profile_dir: Optional[str] = None,
+    **kwargs: Any
+) -> Tuple[Any, str]:
+    """Runs fn under the requested profilers, returns its result and the id of the written profile"""
+    profile_dir = profile_dir or PROFILE_DIR
+    profile_id = new_profile_id()
+    os.makedirs(profile_dir, exist_ok=True)
+
+    torch_profiler: Optional[torch.profiler.profile] = None
+    cprofiler: Optional[cProfile.Profile] = None
+    with ExitStack() as stack:
+        if profiler in ("torch", "all"):
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            torch_profiler = stack.enter_context(torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                profile_memory=True,
+                with_stack=True
+            ))
+            stack.enter_context(label_modules())
+        if profiler in ("cprofile", "all"):
+            cprofiler = cProfile.Profile()
+            cprofiler.enable()
+            stack.callback(cprofiler.disable)
+        result = fn(*args, **kwargs)
+
+    if torch_profiler is not None:
+        torch_profiler.export_chrome_trace(os.path.join(profile_dir, f"{profile_id}.trace.json"))
+    if cprofiler is not None:
+        cprofiler.dump_stats(os.path.join(profile_dir, f"{profile_id}.pstats"))
+    logger.info(f"Wrote profile '{profile_id}' to '{profile_dir}'")
+    return result, profile_id
+
+def profiled_infer(profiler: Optional[schemas.TProfiler], *args: Any) -> schemas.InferenceResult:
+    """server.infer.infer, profiled when a profiler is given. Runs in the worker"""
+    if profiler is None:
+        return infer(*args)
+
+    result, profile_id = profile_call(profiler, infer, *args)
+    result.profile_id = profile_id
+    return result
@@ -1,4 +1,4 @@
-from typing import Literal, List, Union
+from typing import Literal, List, Optional, Union
 from pydantic import BaseModel, RootModel
 
 TModelNames = Literal[
@@ -14,6 +14,21 @@ TFaceEnhancementModel = Literal["GFPGANv1.3"]
 TAlphaUpsampler = Literal["realesrgan", "bicubic"]
 TImageExtension = Literal["auto", "jpg", "png"]
 
+# "exact" always runs the requested model, "fast" may pick a cheaper route when outscale < the model's scale
+TPlanPolicy = Literal["exact", "fast"]
+
+# "torchscript" runs the model channels-last through modules traced once per tile shape and cached on disk,
+# "onnxruntime" runs it through an ONNX graph exported once (see server/export.py)
+TEngine = Literal["eager", "torchscript", "onnxruntime"]
+
+# "bf16" runs the model under bfloat16 autocast (fast on CPUs with AVX512-BF16/AMX),
+# "int8" runs a statically quantized copy of the model (CPU only), calibrated on the bundled inputs/ images,
+# "auto" picks fp16 on CUDA, bf16 on CPUs with native bf16 support and fp32 otherwise
+TPrecision = Literal["fp32", "fp16", "bf16", "int8", "auto"]
+
+# "torch" writes a torch.profiler Chrome trace, "cprofile" a cProfile pstats file, "all" both (see server/profiling.py)
+TProfiler = Literal["torch", "cprofile", "all"]
+
 
 class RRDBNetParams(BaseModel):
     num_in_ch: int
@@ -47,12 +62,15 @@ class RRDBNetModel(BaseModel):
     type: Literal["rrdbnet"]
     urls: List[str]
     params: RRDBNetParams
+    # Models sharing a family are interchangeable apart from their native scale
+    family: Optional[str] = None
 
 class SRVGGNetModel(BaseModel):
     name: str
     type: Literal["srvggnet"]
     urls: List[str]
     params: SRVGGNetCompactParams
+    family: Optional[str] = None
 
 class Model(RootModel):
     root: Union[RRDBNetModel, SRVGGNetModel, FaceEnhancementModel]
@@ -60,3 +78,83 @@ class Model(RootModel):
 class ModelList(RootModel):
     root: List[Model]
 
+
+class InferencePlan(BaseModel):
+    policy: TPlanPolicy
+    requested_model: str
+    # Model actually used, differs from requested_model when a native-scale substitute was picked
+    model_name: str
+    model_scale: int
+    outscale: float
+    # Factor the input is shrunk by before inference, 1 means untouched
+    pre_downscale: float = 1
+
+class InferenceResult(BaseModel):
+    image: bytes
+    plan: InferencePlan
+    # Set when the request was profiled
+    profile_id: Optional[str] = None
+
+
+TProcessRole = Literal["server", "worker"]
+
+class ProcessMemory(BaseModel):
+    pid: int
+    role: TProcessRole
+    # All in bytes, shared counts pages mapped by other processes too (e.g. the shared model weights)
+    rss: int
+    pss: int
+    shared: int
+    private: int
+
+class JobStats(BaseModel):
+    pid: int
+    duration_s: float
+    # Memory in bytes, None where unsupported (non-Linux): RSS before the job, peak RSS during it and RSS after it
+    rss_before: Optional[int] = None
+    peak_rss: Optional[int] = None
+    rss: Optional[int] = None
+    # Peak of the memory allocated to CUDA tensors
+    cuda_peak_allocated: Optional[int] = None
+
+class BatchItem(BaseModel):
+    # Name in the request (archive members keep their path), output is its name in the returned ZIP, None on failure
+    name: str
+    output: Optional[str] = None
+    # Seconds since the start of the batch when the image was submitted, and until it was done
+    started_s: float
+    duration_s: float
+    job: Optional[JobStats] = None
+    plan: Optional[InferencePlan] = None
+    error: Optional[str] = None
+
+class BatchManifest(BaseModel):
+    items: List[BatchItem]
+    succeeded: int
+    failed: int
+    duration_s: float
+
+TVideoState = Literal["running", "done", "failed"]
+
+class VideoSegment(BaseModel):
+    index: int
+    # Frames of the segment, from start_frame on
+    start_frame: int
+    frames: int
+    duration_s: float
+    # Bytes of the encoded segment
+    size: int
+
+class VideoJobStatus(BaseModel):
+    id: str
+    name: str
+    state: TVideoState
+    frames_done: int
+    # Estimated from the container until the job is done
+    total_frames: Optional[int] = None
+    # Frames identical to the previous one, whose upscaled output was reused
+    frames_reused: int = 0
+    # Finished segments, downloadable while the next ones are encoded
+    segments: List[VideoSegment]
+    duration_s: float
+    error: Optional[str] = None
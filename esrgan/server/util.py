@@ -1,15 +1,20 @@
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Union, Any
+from typing import Dict, List, Optional, Union, Any
+import copy
+import os
 from loguru import logger
 from torch.hub import download_url_to_file
+import torch
 
 from basicsr.archs.rrdbnet_arch import RRDBNet
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact, SRVGGNetCompactInference
 from gfpgan import GFPGANer
 from realesrgan.utils import RealESRGANer
 from pathlib import Path
 
-from server.schemas import Model, ModelList, TModelNames, TFaceEnhancementModel
+from server.schemas import Model, ModelList, TModelNames, TFaceEnhancementModel, TEngine, TPrecision
+from server.weights import assign_weights, load_model_weights
 
 def omit(values : Dict[str, Any], omitted: List[str]) -> Dict[str, Any]:
     copy = values.copy()
@@ -29,11 +34,14 @@ def __load_model_params() -> Dict[str, Model]:
 
 model_params: Dict[str, Model] = __load_model_params()
 
+# Checkpoints are downloaded here on first use
+WEIGHTS_DIR: str = os.environ.get("ESRGAN_WEIGHTS_DIR", f"{Path(__file__).parent.parent}/weights")
+
 def get_model_path(name: Union[TModelNames, TFaceEnhancementModel]) -> Union[str, List[str]]:
     urls: List[str] = model_params[name].root.urls
     # Get last slug of each URL
     filenames: List[str] = [url.split("/")[-1] for url in urls]
-    filepaths: List[str] = [f"{Path(__file__).parent.parent}/weights/{filename}" for filename in filenames]
+    filepaths: List[str] = [f"{WEIGHTS_DIR}/{filename}" for filename in filenames]
 
     for url, filepath in zip(urls, filepaths):
         if not Path(filepath).is_file():
@@ -67,6 +75,44 @@ def make_model(model_name: TModelNames) -> Union[SRVGGNetCompact, RRDBNet]:
     if params.type == "rrdbnet":
         return RRDBNet(**params.params.model_dump())
     elif params.type == "srvggnet":
-        return SRVGGNetCompact(**params.params.model_dump())
+        return SRVGGNetCompactInference(**params.params.model_dump())
     else:
         raise ValueError(f"{params.type} is an unrecognized model type")
+
+@lru_cache(maxsize=None)
+def __make_meta_model(model_name: TModelNames) -> Union[SRVGGNetCompact, RRDBNet]:
+    # initializing the weights of meta tensors is still slow on some torch versions, build it once per process
+    with torch.device("meta"):
+        return make_model(model_name)
+
+def make_shared_model(model_name: TModelNames, denoise_strength: float = 0.5) -> Union[SRVGGNetCompact, RRDBNet]:
+    """A model whose parameters point to the memory-mapped weights shared by all workers, see server/weights.py"""
+    model = copy.deepcopy(__make_meta_model(model_name))
+    weights = load_model_weights(get_model_path(model_name), get_dni_weights(model_name, denoise_strength))
+    return assign_weights(model, weights)
+
+def make_upsampler(
+    model_name: TModelNames,
+    denoise_strength: float = 0.5,
+    tile: int = 0,
+    tile_pad: int = 10,
+    pre_pad: int = 0,
+    precision: TPrecision = "fp32",
+    gpu_id: Optional[int] = None,
+    engine: TEngine = "eager"
+) -> RealESRGANer:
+    params = model_params[model_name].root
+    model_path = get_model_path(model_name)
+    dni_weight = get_dni_weights(model_name, denoise_strength)
+    return RealESRGANer(
+        scale=params.params.get_scale(),
+        model_path=None,
+        model=make_shared_model(model_name, denoise_strength),
+        model_id=f"{model_path}|{dni_weight}",
+        tile=tile,
+        tile_pad=tile_pad,
+        pre_pad=pre_pad,
+        precision=precision,
+        gpu_id=gpu_id,
+        engine=engine
+    )
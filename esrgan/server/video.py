@@ -0,0 +1,388 @@
+"""
+Video upscaling for POST /upscale/video.
+
+The upload is copied to ESRGAN_VIDEO_DIR/<id> in chunks (never held in memory) and decoded to raw frames by the local
+ffmpeg. Every frame is upscaled as its own job on the worker pool, like the images of /upscale/batch, so videos share
+the workers and the memory-mapped model weights with the other requests; a frame identical to the previous one reuses
+its output. The upscaled frames are encoded by ffmpeg into MP4 segments of ESRGAN_VIDEO_SEGMENT_S seconds: a finished
+segment is a playable video that can be downloaded (with Range support) while the next ones are encoded. Once all are
+done they are concatenated, without re-encoding the video, with the audio of the input into output.mp4.
+The esrgan-video-jobs subdirectory of ESRGAN_VIDEO_DIR is owned by the jobs: it is emptied on start, and finished jobs
+are deleted after ESRGAN_VIDEO_TTL_S.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from fractions import Fraction
+from functools import lru_cache
+from pathlib import Path
+from time import monotonic
+from typing import Awaitable, BinaryIO, Callable, Deque, Dict, List, Optional, Tuple
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import uuid
+from gfpgan import GFPGANer
+from loguru import logger
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+
+from realesrgan.utils import RealESRGANer
+from realesrgan.video import DuplicateFrameDetector
+from server import schemas
+from server.infer import upscale_image
+from server.planner import plan_inference
+from server.pool import JobResult
+from server.util import make_face_enhancement_model, make_upsampler
+
+FFMPEG_BIN: str = os.environ.get("ESRGAN_FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN: str = os.environ.get("ESRGAN_FFPROBE_BIN", "ffprobe")
+CHUNK_SIZE = 2**20
+# the only part of ESRGAN_VIDEO_DIR the jobs write to and empty
+JOBS_DIR = "esrgan-video-jobs"
+
+# Upscales one frame on the worker pool
+TUpscaleFrame = Callable[[np.ndarray], Awaitable[JobResult]]
+
+@lru_cache(maxsize=1)
+def get_frame_models(
+    model_name: schemas.TModelNames,
+    denoise_strength: float,
+    outscale: int,
+    tile: int,
+    tile_pad: int,
+    pre_pad: int,
+    face_enhance: bool,
+    precision: schemas.TPrecision,
+    gpu_id: Optional[int],
+    engine: schemas.TEngine
+) -> Tuple[RealESRGANer, Optional[GFPGANer]]:
+    """The frames of a video share their parameters, so a worker keeps the models of the last frame it upscaled"""
+    upsampler = make_upsampler(
+        model_name,
+        denoise_strength,
+        tile=tile,
+        tile_pad=tile_pad,
+        pre_pad=pre_pad,
+        precision=precision,
+        gpu_id=gpu_id,
+        engine=engine
+    )
+    return upsampler, make_face_enhancement_model(upsampler, outscale) if face_enhance else None
+
+def infer_frame(
+    frame: np.ndarray, # BGR
+    model_name: schemas.TModelNames,
+    denoise_strength: float = 0.5,
+    outscale: int = 4,
+    tile: int = 0,
+    tile_pad: int = 10,
+    pre_pad: int = 0,
+    face_enhance: bool = False,
+    fp_32: bool = True,
+    gpu_id: Optional[int] = None,
+    plan_policy: schemas.TPlanPolicy = "exact",
+    engine: schemas.TEngine = "eager",
+    precision: Optional[schemas.TPrecision] = None
+) -> np.ndarray:
+    """Runs in the worker, the parameters are the ones of server.infer.infer"""
+    plan = plan_inference(model_name, outscale, plan_policy, face_enhance, frame.shape[0:2])
+    upsampler, face_enhancer = get_frame_models(
+        plan.model_name,
+        denoise_strength,
+        outscale,
+        tile,
+        tile_pad,
+        pre_pad,
+        face_enhance,
+        precision or ("fp32" if fp_32 else "auto"),
+        gpu_id,
+        engine
+    )
+    return upscale_image(frame, plan, upsampler, face_enhancer)
+
+@dataclass
+class VideoInfo:
+    width: int
+    height: int
+    fps: Fraction
+    # Estimated from the duration when the container does not store it
+    num_frames: Optional[int]
+
+def parse_rate(rate: Optional[str]) -> Optional[Fraction]:
+    num, _, den = (rate or "").partition("/")
+    try:
+        value = Fraction(int(num), int(den or 1))
+    except (ValueError, ZeroDivisionError):
+        return None
+    return value if value > 0 else None
+
+def probe(path: str) -> VideoInfo:
+    """Raises ValueError when the file has no video stream"""
+    result = subprocess.run([
+        FFPROBE_BIN, "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration:format=duration",
+        "-of", "json", path
+    ], capture_output=True, text=True)
+    streams = json.loads(result.stdout or "{}").get("streams") if result.returncode == 0 else None
+    if not streams:
+        # without the path of the job directory
+        error = result.stderr.replace(f"{path}: ", "").strip()
+        raise ValueError(f"Not a video: {error or 'no video stream'}")
+
+    stream = streams[0]
+    fps = parse_rate(stream.get("avg_frame_rate")) or parse_rate(stream.get("r_frame_rate"))
+    if fps is None:
+        raise ValueError("Not a video: unknown frame rate")
+    num_frames: Optional[int] = None
+    if str(stream.get("nb_frames", "")).isdigit():
+        num_frames = int(stream["nb_frames"])
+    else:
+        duration = stream.get("duration") or json.loads(result.stdout).get("format", {}).get("duration")
+        if duration is not None:
+            num_frames = round(float(duration) * fps)
+    return VideoInfo(int(stream["width"]), int(stream["height"]), fps, num_frames)
+
+@dataclass
+class VideoJob:
+    id: str
+    name: str
+    dir: str
+    input_path: str
+    info: VideoInfo
+    state: schemas.TVideoState = "running"
+    frames_done: int = 0
+    frames_reused: int = 0
+    segments: List[schemas.VideoSegment] = field(default_factory=list)
+    error: Optional[str] = None
+    started: float = field(default_factory=monotonic)
+    finished: Optional[float] = None
+    task: Optional[asyncio.Future] = None
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.dir, "output.mp4")
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.dir, "ffmpeg.log")
+
+    def segment_path(self, index: int) -> str:
+        return os.path.join(self.dir, f"{index:05d}.mp4")
+
+    def status(self) -> schemas.VideoJobStatus:
+        return schemas.VideoJobStatus(
+            id=self.id,
+            name=self.name,
+            state=self.state,
+            frames_done=self.frames_done,
+            total_frames=self.frames_done if self.state == "done" else self.info.num_frames,
+            frames_reused=self.frames_reused,
+            segments=list(self.segments),
+            duration_s=(self.finished or monotonic()) - self.started,
+            error=self.error
+        )
+
+def read_log(job: VideoJob) -> str:
+    with open(job.log_path, "rb") as f:
+        return f.read().decode(errors="replace").strip()[-1000:]
+
+def copy_upload(upload: BinaryIO, path: str) -> None:
+    with open(path, "wb") as f:
+        shutil.copyfileobj(upload, f, CHUNK_SIZE)
+
+def read_frame(stream: BinaryIO, width: int, height: int) -> Optional[np.ndarray]:
+    """Next raw BGR frame of the decoder, None at the end of the video"""
+    data = stream.read(width * height * 3)
+    if len(data) < width * height * 3:
+        return None
+    return np.frombuffer(data, np.uint8).reshape(height, width, 3)
+
+def pad_to_even(frame: np.ndarray) -> np.ndarray:
+    """H.264 in yuv420p needs an even width and height, an odd one gets its last row/column repeated"""
+    height, width = frame.shape[0:2]
+    if height % 2 == 0 and width % 2 == 0:
+        return frame
+    return np.pad(frame, ((0, height % 2), (0, width % 2), (0, 0)), mode="edge")
+
+def start_encoder(path: str, width: int, height: int, fps: Fraction, log: BinaryIO) -> subprocess.Popen:
+    return subprocess.Popen([
+        FFMPEG_BIN, "-v", "error",
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-framerate", str(fps), "-i", "pipe:",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart", "-f", "mp4", "-y", path
+    ], stdin=subprocess.PIPE, stderr=log)
+
+def concat_segments(job: VideoJob, log: BinaryIO) -> None:
+    list_path = os.path.join(job.dir, "segments.txt")
+    with open(list_path, "w") as f:
+        for segment in job.segments:
+            f.write(f"file '{os.path.basename(job.segment_path(segment.index))}'\n")
+    # the video is copied, the audio is re-encoded as not every codec fits in MP4
+    returncode = subprocess.call([
+        FFMPEG_BIN, "-v", "error", "-f", "concat", "-i", list_path, "-i", job.input_path,
+        "-map", "0:v", "-map", "1:a:0?", "-c:v", "copy", "-c:a", "aac", "-movflags", "+faststart",
+        "-f", "mp4", "-y", f"{job.output_path}.part"
+    ], stderr=log)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to concatenate the segments: {read_log(job)}")
+    os.replace(f"{job.output_path}.part", job.output_path)
+
+async def upscale_video(job: VideoJob, upscale: TUpscaleFrame, concurrency: int, segment_s: float) -> None:
+    """Upscales up to concurrency frames at a time, and encodes them in order into segments of segment_s seconds"""
+    info = job.info
+    segment_frames = max(1, round(info.fps * Fraction(segment_s)))
+    detector = DuplicateFrameDetector()
+    pending: Deque[asyncio.Future] = deque()
+    last: Optional[asyncio.Future] = None
+    encoder: Optional[subprocess.Popen] = None
+
+    log = open(job.log_path, "ab")
+    # decoded at the frame rate of the output, so that variable frame rate inputs keep their timing
+    decoder = subprocess.Popen([
+        FFMPEG_BIN, "-v", "error", "-i", job.input_path,
+        "-map", "0:v:0", "-r", str(info.fps), "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:"
+    ], stdout=subprocess.PIPE, stderr=log)
+
+    async def upscale_frame(frame: np.ndarray) -> np.ndarray:
+        return (await upscale(frame)).value
+
+    async def finish_segment() -> None:
+        nonlocal encoder
+        index = len(job.segments)
+        start_frame = index * segment_frames
+        encoder.stdin.close()
+        returncode = await run_in_threadpool(encoder.wait)
+        encoder = None
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to encode segment {index}: {read_log(job)}")
+
+        os.replace(f"{job.segment_path(index)}.part", job.segment_path(index))
+        frames = job.frames_done - start_frame
+        job.segments.append(schemas.VideoSegment(
+            index=index,
+            start_frame=start_frame,
+            frames=frames,
+            duration_s=float(frames / info.fps),
+            size=os.path.getsize(job.segment_path(index))
+        ))
+
+    async def write(output: np.ndarray) -> None:
+        nonlocal encoder
+        output = pad_to_even(output)
+        index = len(job.segments)
+        if encoder is None:
+            path = f"{job.segment_path(index)}.part"
+            encoder = start_encoder(path, output.shape[1], output.shape[0], info.fps, log)
+        await run_in_threadpool(encoder.stdin.write, output.tobytes())
+        job.frames_done += 1
+        if job.frames_done == (index + 1) * segment_frames:
+            await finish_segment()
+
+    try:
+        while True:
+            frame = await run_in_threadpool(read_frame, decoder.stdout, info.width, info.height)
+            if frame is None:
+                break
+            if detector.is_duplicate(frame) and last is not None:
+                job.frames_reused += 1
+            else:
+                last = asyncio.ensure_future(upscale_frame(frame))
+            pending.append(last)
+            if len(pending) >= concurrency:
+                await write(await pending.popleft())
+        while pending:
+            await write(await pending.popleft())
+
+        if await run_in_threadpool(decoder.wait) != 0:
+            raise RuntimeError(f"ffmpeg failed to decode the video: {read_log(job)}")
+        if encoder is not None:
+            await finish_segment()
+        if not job.segments:
+            raise ValueError("The video has no frame")
+        await run_in_threadpool(concat_segments, job, log)
+    finally:
+        for task in pending:
+            task.cancel()
+        for process in (decoder, encoder):
+            if process is not None and process.poll() is None:
+                process.kill()
+        log.close()
+
+async def run_job(job: VideoJob, upscale: TUpscaleFrame, concurrency: int, segment_s: float) -> None:
+    try:
+        await upscale_video(job, upscale, concurrency, segment_s)
+        job.state = "done"
+        logger.info(f"Video job '{job.id}' done, frames='{job.frames_done}', reused='{job.frames_reused}', "
+                    f"segments='{len(job.segments)}', duration='{monotonic() - job.started:.1f}s'")
+    except Exception as error:
+        logger.warning(f"Video job '{job.id}' failed: {error}")
+        job.state = "failed"
+        job.error = str(error)
+    finally:
+        job.finished = monotonic()
+
+class VideoJobs:
+    def __init__(self, root: str, segment_s: float, ttl: float) -> None:
+        self.root = os.path.join(root, JOBS_DIR)
+        self.segment_s = segment_s
+        self.ttl = ttl # seconds, after the job finished
+        self.jobs: Dict[str, VideoJob] = {}
+
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    async def start(self, name: str, upload: BinaryIO, upscale: TUpscaleFrame, concurrency: int) -> VideoJob:
+        """Copies the upload to the job directory and starts upscaling it, raises ValueError when it is not a video"""
+        self.expire()
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.root, job_id)
+        os.makedirs(job_dir)
+        # ffmpeg guesses some formats from the extension
+        input_path = os.path.join(job_dir, f"input{Path(name).suffix.lower()}")
+        try:
+            await run_in_threadpool(copy_upload, upload, input_path)
+            info = await run_in_threadpool(probe, input_path)
+        except Exception:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+
+        job = VideoJob(job_id, name, job_dir, input_path, info)
+        logger.info(f"Video job '{job_id}' started, name='{name}', size='{info.width}x{info.height}', "
+                    f"fps='{info.fps}', frames='{info.num_frames}'")
+        job.task = asyncio.ensure_future(run_job(job, upscale, concurrency, self.segment_s))
+        self.jobs[job_id] = job
+        return job
+
+    def get(self, job_id: str) -> VideoJob:
+        """Raises FileNotFoundError when the job was deleted or expired"""
+        self.expire()
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise FileNotFoundError(f"Video job '{job_id}' does not exist")
+        return job
+
+    async def delete(self, job_id: str) -> None:
+        """Stops the job if it is running and deletes its files"""
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return
+        if job.task is not None:
+            job.task.cancel()
+            await asyncio.gather(job.task, return_exceptions=True)
+        shutil.rmtree(job.dir, ignore_errors=True)
+
+    def expire(self, now: Optional[float] = None) -> None:
+        deadline = (monotonic() if now is None else now) - self.ttl
+        for job in [job for job in self.jobs.values() if job.finished is not None and job.finished < deadline]:
+            logger.info(f"Expiring video job '{job.id}'")
+            del self.jobs[job.id]
+            shutil.rmtree(job.dir, ignore_errors=True)
+
+@lru_cache(maxsize=None)
+def get_video_jobs() -> VideoJobs:
+    return VideoJobs(
+        root=os.environ.get("ESRGAN_VIDEO_DIR", f"{Path(__file__).parent.parent}/videos"),
+        segment_s=float(os.environ.get("ESRGAN_VIDEO_SEGMENT_S", 10)),
+        ttl=float(os.environ.get("ESRGAN_VIDEO_TTL_S", 24 * 3600))
+    )
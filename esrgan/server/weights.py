@@ -0,0 +1,56 @@
+"""
+Model weights shared by all inference workers.
+
+Checkpoints are flattened once into a shared/ folder next to them (only the tensors used for inference) and loaded with
+torch.load(mmap=True), the models then use the mapped tensors directly (load_state_dict(assign=True)). The pages
+live in the page cache, so every worker maps the same physical memory instead of holding a private copy.
+"""
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+import os
+from loguru import logger
+import torch
+
+def get_shared_weights_path(model_path: str, shared_dir: Optional[str] = None) -> str:
+    """Flattened copy of a checkpoint, written on first use to shared_dir (default: shared/ next to the checkpoint)"""
+    shared_dir = shared_dir or os.path.join(os.path.dirname(model_path), "shared")
+    shared_path = os.path.join(shared_dir, Path(model_path).name)
+    if os.path.isfile(shared_path):
+        return shared_path
+
+    logger.info(f"Flattening '{model_path}' to '{shared_path}'")
+    checkpoint = torch.load(model_path, map_location="cpu")
+    # prefer params_ema, like RealESRGANer
+    keyname = "params_ema" if "params_ema" in checkpoint else "params"
+    state_dict = {k: v.contiguous() for k, v in checkpoint[keyname].items()}
+
+    os.makedirs(shared_dir, exist_ok=True)
+    # other workers may be flattening or loading the same checkpoint
+    tmp_path = f"{shared_path}.{os.getpid()}.tmp"
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, shared_path)
+    return shared_path
+
+@lru_cache(maxsize=None)
+def load_shared_weights(model_path: str, shared_dir: Optional[str] = None) -> Dict[str, torch.Tensor]:
+    """Memory-mapped state dict of a checkpoint, loaded once per process"""
+    shared_path = get_shared_weights_path(model_path, shared_dir)
+    return torch.load(shared_path, map_location="cpu", mmap=True, weights_only=True)
+
+def load_model_weights(
+    model_path: Union[str, List[str]],
+    dni_weight: Optional[List[float]] = None,
+    shared_dir: Optional[str] = None
+) -> Dict[str, torch.Tensor]:
+    if isinstance(model_path, str):
+        return load_shared_weights(model_path, shared_dir)
+
+    # Deep network interpolation, the blend is private to the caller (only used by the small realesr-general-x4v3)
+    net_a, net_b = (load_shared_weights(path, shared_dir) for path in model_path)
+    return {k: dni_weight[0] * v_a + dni_weight[1] * net_b[k] for k, v_a in net_a.items()}
+
+def assign_weights(model: torch.nn.Module, state_dict: Dict[str, torch.Tensor]) -> torch.nn.Module:
+    """Makes the parameters of a model (e.g. built on the meta device) point to the given tensors, without copying"""
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    return model
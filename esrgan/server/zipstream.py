@@ -0,0 +1,62 @@
+"""
+ZIP archives streamed while they are written, without a temporary file.
+
+Entries are stored without compression (images are already compressed) and written by zipfile to an unseekable
+sink, so the sizes and CRC of each entry follow its data and every chunk can be sent as soon as it is written.
+"""
+from io import RawIOBase
+from typing import AsyncIterator, List, Set, Tuple, Union
+import os
+import zipfile
+from starlette.concurrency import run_in_threadpool
+
+CHUNK_SIZE = 2**20
+
+class ZipSink(RawIOBase):
+    """Collects what zipfile writes until it is drained, tell/seek are unsupported so zipfile streams"""
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def unique_name(name: str, used: Set[str]) -> str:
+    """name, or 'stem (n).ext' when an entry already has that name"""
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    used.add(candidate)
+    return candidate
+
+async def stream_zip(entries: AsyncIterator[Tuple[str, Union[str, bytes]]]) -> AsyncIterator[bytes]:
+    """Archive of (name, path of a file or content) entries, written in the order they arrive"""
+    sink = ZipSink()
+    used: Set[str] = set()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for name, content in entries:
+            # force_zip64, the size is not known when the header is written
+            with archive.open(unique_name(name, used), "w", force_zip64=True) as entry:
+                if isinstance(content, bytes):
+                    entry.write(content)
+                else:
+                    with open(content, "rb") as f:
+                        while True:
+                            chunk = await run_in_threadpool(f.read, CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            entry.write(chunk)
+                            yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
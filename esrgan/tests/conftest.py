@@ -0,0 +1,105 @@
+import json
+import os
+import platform
+import pytest
+import torch
+from torch import nn as nn
+
+PERF_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'perf_baselines.json')
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--update-perf-baselines',
+        action='store_true',
+        help='Record the perf tests results as the new baselines instead of comparing against them')
+    parser.addoption(
+        '--perf-time-tolerance',
+        type=float,
+        default=0.5,
+        help='Allowed relative slowdown of the perf tests. Default: 0.5')
+    parser.addoption(
+        '--perf-mem-tolerance',
+        type=float,
+        default=0.25,
+        help='Allowed relative peak memory growth of the perf tests, on top of 16 MB of slack. Default: 0.25')
+
+
+@torch.no_grad()
+def calibrate(repeat=10):
+    """Time of a fixed convolution workload, perf test times are stored relative to it to cancel out the machine."""
+    # imported here, so that only the perf tests depend on the benchmark CLI
+    from bench import measure
+
+    torch.manual_seed(0)
+    conv = nn.Conv2d(32, 32, 3, 1, 1)
+    x = torch.rand((1, 32, 64, 64), dtype=torch.float32)
+    return measure(lambda: [conv(x) for _ in range(10)], repeat)['min_s']
+
+
+@pytest.fixture(scope='session')
+def perf_threads():
+    # one thread, timings with more threads depend on the load of the machine
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    yield
+    torch.set_num_threads(num_threads)
+
+
+@pytest.fixture(scope='session')
+def perf_baselines(request, perf_threads):
+    update = request.config.getoption('--update-perf-baselines')
+    baselines = {'results': {}}
+    if os.path.isfile(PERF_BASELINES):
+        with open(PERF_BASELINES, 'r') as f:
+            baselines = json.load(f)
+    baselines['calibration_s'] = calibrate()
+    yield baselines
+
+    if update:
+        baselines['environment'] = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'torch': torch.__version__,
+        }
+        with open(PERF_BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture
+def check_perf(request, perf_baselines):
+    """Measure a workload and compare its wall time and peak memory against the stored baseline."""
+    from bench import measure
+
+    config = request.config
+
+    def check(fn, repeat=5):
+        result = measure(fn, repeat)
+        measured = {'relative_time': result['min_s'] / perf_baselines['calibration_s']}
+        if result['peak_mem_mb'] is not None:
+            measured['peak_mem_mb'] = result['peak_mem_mb']
+
+        key = request.node.name
+        if config.getoption('--update-perf-baselines'):
+            perf_baselines['results'][key] = measured
+            return
+        if key not in perf_baselines['results']:
+            pytest.fail(f'No perf baseline for {key}, record it with: pytest -m perf --update-perf-baselines')
+
+        baseline = perf_baselines['results'][key]
+        errors = []
+        time_limit = baseline['relative_time'] * (1 + config.getoption('--perf-time-tolerance'))
+        if measured['relative_time'] > time_limit:
+            errors.append(f'wall time regressed: {measured["relative_time"]:.2f} x calibration, baseline '
+                          f'{baseline["relative_time"]:.2f}, limit {time_limit:.2f}')
+        if 'peak_mem_mb' in measured and 'peak_mem_mb' in baseline:
+            mem_limit = baseline['peak_mem_mb'] * (1 + config.getoption('--perf-mem-tolerance')) + 16
+            if measured['peak_mem_mb'] > mem_limit:
+                errors.append(f'peak memory regressed: {measured["peak_mem_mb"]:.1f} MB, baseline '
+                              f'{baseline["peak_mem_mb"]:.1f} MB, limit {mem_limit:.1f} MB')
+        if errors:
+            pytest.fail(f'PERFORMANCE REGRESSION in {key} (torch {torch.__version__}, baselines recorded with '
+                        f'torch {perf_baselines.get("environment", {}).get("torch")}): ' + '; '.join(errors))
+
+    return check
@@ -0,0 +1,85 @@
+import asyncio
+import io
+import json
+import pytest
+import tarfile
+import zipfile
+
+from server.batch import MANIFEST_NAME, ImageTooLargeError, open_inputs, safe_name, upscale_batch
+from server.pool import JobResult
+from server.schemas import InferencePlan, InferenceResult, JobStats
+
+
+def test_open_inputs():
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w') as archive:
+        archive.writestr('dir/a.png', b'a')
+        archive.writestr('../escape.jpg', b'b')
+        archive.writestr('notes.txt', b'skipped')
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode='w:gz') as archive:
+        info = tarfile.TarInfo('c.png')
+        info.size = 1
+        archive.addfile(info, io.BytesIO(b'c'))
+    zip_buffer.seek(0)
+    tar_buffer.seek(0)
+
+    files = [('d.png', io.BytesIO(b'd')), ('images.zip', zip_buffer), ('images.tar.gz', tar_buffer)]
+    assert list(open_inputs(files)) == [('d.png', b'd'), ('dir/a.png', b'a'), ('escape.jpg', b'b'), ('c.png', b'c')]
+
+    # members larger than the maximum size are not read, whatever their compressed size
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('bomb.png', b'\0' * 2**20)
+        archive.writestr('small.png', b's')
+    zip_buffer.seek(0)
+    tar_buffer.seek(0)
+    files = [('large.png', io.BytesIO(b'd' * 11)), ('images.zip', zip_buffer), ('images.tar.gz', tar_buffer)]
+    inputs = list(open_inputs(files, max_size=10))
+    assert [name for name, _ in inputs] == ['large.png', 'bomb.png', 'small.png', 'c.png']
+    assert isinstance(inputs[0][1], ImageTooLargeError) and isinstance(inputs[1][1], ImageTooLargeError)
+    assert inputs[2][1] == b's' and inputs[3][1] == b'c'
+
+    with pytest.raises(ValueError):
+        open_inputs([('broken.zip', io.BytesIO(b'not a zip'))])
+    assert safe_name('/../a/./b.png') == 'a/b.png'
+
+
+def test_upscale_batch():
+    running = []
+    peak = []
+    upscaled = []
+
+    async def upscale(name, content):
+        running.append(name)
+        upscaled.append(name)
+        peak.append(len(running))
+        # the first image finishes last
+        await asyncio.sleep(0.1 if content == b'a' else 0.01)
+        running.remove(name)
+        if content == b'broken':
+            raise ValueError('cannot decode')
+        plan = InferencePlan(policy='exact', requested_model='m', model_name='m', model_scale=4, outscale=4)
+        return JobResult(InferenceResult(image=b'up:' + content, plan=plan), JobStats(pid=1, duration_s=0.01))
+
+    inputs = iter([('a.png', b'a'), ('b.png', b'b'), ('a.png', b'c'), ('bad.png', b'broken'), ('e.png', b'e'),
+                   ('large.png', ImageTooLargeError('too large'))])
+
+    async def collect():
+        return [entry async for entry in upscale_batch(inputs, upscale, concurrency=2)]
+
+    entries = asyncio.run(collect())
+    assert max(peak) == 2
+    # results are yielded and named as they complete, the manifest comes last
+    assert [name for name, _ in entries] == ['b.png', 'a.png', 'e.png', 'a (1).png', MANIFEST_NAME]
+    assert dict(entries)['a.png'] == b'up:c' and dict(entries)['a (1).png'] == b'up:a'
+
+    manifest = json.loads(entries[-1][1])
+    assert manifest['succeeded'] == 4 and manifest['failed'] == 2
+    outputs = [(item['name'], item['output']) for item in manifest['items']]
+    assert outputs[:2] == [('b.png', 'b.png'), ('a.png', 'a.png')]
+    failed = {item['name']: item for item in manifest['items'] if item['error'] is not None}
+    assert failed['bad.png']['output'] is None and 'cannot decode' in failed['bad.png']['error']
+    # inputs that could not be read are not upscaled
+    assert failed['large.png']['output'] is None and failed['large.png']['error'] == 'too large'
+    assert 'large.png' not in upscaled
@@ -0,0 +1,64 @@
+import copy
+import os
+import pytest
+import torch
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.engine import EagerEngine, OnnxRuntimeEngine, TorchScriptEngine
+
+
+def test_torchscript_engine(tmp_path):
+    net = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu').eval()
+    img = torch.rand((1, 3, 16, 16), dtype=torch.float32)
+    with torch.no_grad():
+        expected = EagerEngine(net)(img)
+
+        engine = TorchScriptEngine(net, 'test', cache_dir=str(tmp_path), shapes=[(1, 3, 16, 16)])
+        output = engine(img)
+        assert torch.allclose(output, expected, atol=1e-5)
+        assert engine.traced[((1, 3, 16, 16), torch.float32, None)] is not None
+        assert len(os.listdir(tmp_path)) == 1
+
+        # unregistered shapes run eagerly
+        output = engine(img[:, :, :8, :12])
+        assert output.shape == (1, 3, 32, 48)
+        assert engine.traced[((1, 3, 8, 12), torch.float32, None)] is None
+
+        # a new engine reuses the traced module from disk
+        engine = TorchScriptEngine(net, 'test', cache_dir=str(tmp_path), shapes=[(1, 3, 16, 16)])
+        assert torch.allclose(engine(img), expected, atol=1e-5)
+        assert len(os.listdir(tmp_path)) == 1
+
+
+def test_onnxruntime_engine(tmp_path):
+    pytest.importorskip('onnxruntime')
+    nets = [
+        SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu'),
+        RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=8, num_block=1, num_grow_ch=4, scale=4),
+        RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=8, num_block=1, num_grow_ch=4, scale=2),
+    ]
+    for idx, net in enumerate(nets):
+        net.eval()
+        engine = OnnxRuntimeEngine(net, f'test{idx}', cache_dir=str(tmp_path))
+        # spatial axes are dynamic, so any tile shape works with the same graph
+        for shape in [(1, 3, 16, 16), (1, 3, 10, 22)]:
+            img = torch.rand(shape, dtype=torch.float32)
+            with torch.no_grad():
+                expected = net(img)
+            output = engine(img)
+            assert output.shape == expected.shape
+            assert (output - expected).abs().max() < 1e-4
+    assert len(os.listdir(tmp_path)) == len(nets)
+
+
+def test_onnxruntime_engine_dtype(tmp_path):
+    pytest.importorskip('onnxruntime')
+    net = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu').eval()
+    img = torch.rand(1, 3, 16, 16)
+    engine = OnnxRuntimeEngine(net, 'test', cache_dir=str(tmp_path))
+    # the graph traced with other weight dtypes is not reused, it would reject float32 inputs
+    OnnxRuntimeEngine(copy.deepcopy(net).half(), 'test', cache_dir=str(tmp_path))
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.onnx')]) == 2
+    engine = OnnxRuntimeEngine(net, 'test', cache_dir=str(tmp_path))
+    assert engine(img).dtype == torch.float32
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import torch
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompactInference
+from realesrgan.utils import RealESRGANer
+
+pytestmark = pytest.mark.perf
+
+
+def make_upsampler(arch, tile, precision='fp32'):
+    torch.manual_seed(0)
+    if arch == 'rrdbnet':
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=16, num_block=2, num_grow_ch=8, scale=4)
+    else:
+        model = SRVGGNetCompactInference(num_in_ch=3, num_out_ch=3, num_feat=16, num_conv=4, upscale=4)
+    return RealESRGANer(
+        scale=4,
+        model_path=None,
+        model=model,
+        tile=tile,
+        tile_pad=8,
+        pre_pad=0,
+        device=torch.device('cpu'),
+        precision=precision)
+
+
+@pytest.mark.parametrize('tile', [0, 32])
+@pytest.mark.parametrize('arch', ['rrdbnet', 'srvggnet'])
+def test_enhance_perf(check_perf, arch, tile):
+    upsampler = make_upsampler(arch, tile)
+    img = np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+    check_perf(lambda: upsampler.enhance(img))
+
+
+@pytest.mark.parametrize('arch', ['rrdbnet', 'srvggnet'])
+def test_enhance_alpha_perf(check_perf, arch):
+    upsampler = make_upsampler(arch, 0)
+    img = np.random.default_rng(0).integers(0, 255, (48, 48, 4), dtype=np.uint8)
+    check_perf(lambda: upsampler.enhance(img))
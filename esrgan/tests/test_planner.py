@@ -0,0 +1,49 @@
+import numpy as np
+
+from server.planner import finalize_output, get_output_outscale, plan_inference, prepare_input
+
+
+def test_plan_inference():
+    # exact policy never changes the requested route
+    plan = plan_inference('RealESRGAN_x4plus', 2, 'exact')
+    assert plan.model_name == 'RealESRGAN_x4plus'
+    assert plan.pre_downscale == 1
+
+    # a native x2 model of the same family is preferred for 2x
+    plan = plan_inference('RealESRGAN_x4plus', 2, 'fast')
+    assert plan.model_name == 'RealESRGAN_x2plus'
+    assert plan.model_scale == 2
+    assert plan.pre_downscale == 1
+
+    # 1x uses the smallest family member and shrinks the input
+    plan = plan_inference('RealESRGAN_x4plus', 1, 'fast', image_size=(64, 64))
+    assert plan.model_name == 'RealESRGAN_x2plus'
+    assert plan.pre_downscale == 2
+
+    # models without a family fall back to pre-downscaling
+    plan = plan_inference('realesr-general-x4v3', 2, 'fast', image_size=(64, 64))
+    assert plan.model_name == 'realesr-general-x4v3'
+    assert plan.pre_downscale == 2
+
+    # face enhancement and tiny inputs are never downscaled
+    plan = plan_inference('realesr-general-x4v3', 2, 'fast', face_enhance=True)
+    assert plan.pre_downscale == 1
+    plan = plan_inference('realesr-general-x4v3', 1, 'fast', image_size=(32, 32))
+    assert plan.pre_downscale == 1
+
+    # nothing to save when upscaling at or above the native scale
+    plan = plan_inference('RealESRGAN_x2plus', 4, 'fast')
+    assert plan.model_name == 'RealESRGAN_x2plus'
+    assert plan.pre_downscale == 1
+
+
+def test_plan_io():
+    plan = plan_inference('realesr-general-x4v3', 2, 'fast', image_size=(33, 50))
+    img = np.random.randint(0, 255, (33, 50, 3), dtype=np.uint8)
+    small = prepare_input(img, plan)
+    assert small.shape == (16, 25, 3)
+    assert get_output_outscale(plan) == plan.model_scale
+
+    # emulate the upsampler output and check rounding is corrected
+    output = np.zeros((small.shape[0] * 4, small.shape[1] * 4, 3), dtype=np.uint8)
+    assert finalize_output(output, plan, img.shape[0:2]).shape == (66, 100, 3)
@@ -0,0 +1,81 @@
+import asyncio
+import numpy as np
+import os
+import pytest
+import time
+
+from server.pool import WorkerCrashedError, WorkerPool
+
+
+def allocate(num_bytes):
+    return int(np.ones(num_bytes, dtype=np.uint8).sum())
+
+
+def crash():
+    os._exit(1)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def test_worker_pool():
+
+    async def run():
+        pool = WorkerPool(max_workers=1, max_jobs_per_worker=2)
+        try:
+            result = await pool.run(allocate, 64 * 2**20)
+            assert result.value == 64 * 2**20
+            pid = result.stats.pid
+            assert pid != os.getpid()
+            if result.stats.peak_rss is not None:
+                assert result.stats.peak_rss - result.stats.rss_before >= 64 * 2**20
+
+            # recycled after max_jobs_per_worker jobs
+            assert (await pool.run(allocate, 1)).stats.pid == pid
+            assert (await pool.run(allocate, 1)).stats.pid != pid
+
+            # a dead worker only fails its own job, the queued ones run on a new worker
+            results = await asyncio.gather(pool.run(crash), pool.run(allocate, 1), return_exceptions=True)
+            assert isinstance(results[0], WorkerCrashedError)
+            assert results[1].value == 1
+        finally:
+            pool.shutdown()
+
+    asyncio.run(run())
+
+
+def test_worker_pool_rss_limit():
+
+    async def run():
+        pool = WorkerPool(max_workers=1, max_worker_rss=1)
+        try:
+            result = await pool.run(allocate, 1)
+            if result.stats.rss is None:
+                pytest.skip('RSS is only measured on Linux')
+            assert (await pool.run(allocate, 1)).stats.pid != result.stats.pid
+        finally:
+            pool.shutdown()
+
+    asyncio.run(run())
+
+
+def test_worker_pool_cancel():
+
+    async def run():
+        pool = WorkerPool(max_workers=1)
+        try:
+            start = time.time()
+            task = asyncio.ensure_future(pool.run(sleep, 0.5))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # the cancelled job still runs in the worker, which is not idle until it is done
+            assert pool.idle.empty()
+            assert (await pool.run(time.time)).value - start >= 0.5
+            assert pool.idle.qsize() == 1
+        finally:
+            pool.shutdown()
+
+    asyncio.run(run())
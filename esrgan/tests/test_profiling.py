@@ -0,0 +1,25 @@
+import json
+import os
+import pstats
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompactInference
+from realesrgan.utils import RealESRGANer
+from server.profiling import profile_call
+
+
+def test_profile_call(tmp_path):
+    model = SRVGGNetCompactInference(num_in_ch=3, num_out_ch=3, num_feat=4, num_conv=2, upscale=4, act_type='prelu')
+    upsampler = RealESRGANer(scale=4, model_path=None, model=model, tile=8, tile_pad=2, pre_pad=0)
+    img = (torch.rand((16, 16, 3)) * 255).byte().numpy()
+
+    (output, img_mode), profile_id = profile_call('all', upsampler.enhance, img, profile_dir=str(tmp_path))
+    assert output.shape == (64, 64, 3)
+    assert sorted(os.listdir(tmp_path)) == [f'{profile_id}.pstats', f'{profile_id}.trace.json']
+
+    # layers and RealESRGANer stages are visible in the trace
+    with open(tmp_path / f'{profile_id}.trace.json', 'r') as f:
+        names = {event.get('name') for event in json.load(f)['traceEvents']}
+    for name in ['nn.Conv2d', 'nn.PReLU', 'realesrgan.tile', 'realesrgan.from_numpy', 'realesrgan.to_numpy']:
+        assert name in names
+    assert pstats.Stats(str(tmp_path / f'{profile_id}.pstats')).total_calls > 0
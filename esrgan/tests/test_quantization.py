@@ -0,0 +1,34 @@
+import os
+import torch
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.quantization import QuantizedEngine, load_calibration_tiles
+
+
+def test_load_calibration_tiles():
+    tiles = load_calibration_tiles('tests/data/gt', tile_size=32, num_tiles=3)
+    assert len(tiles) == 3
+    assert tiles[0].shape == (1, 3, 32, 32)
+    assert 0 <= tiles[0].min() and tiles[0].max() <= 1
+
+
+def test_quantized_engine(tmp_path):
+    nets = [
+        SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu'),
+        RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=8, num_block=1, num_grow_ch=4, scale=2),
+    ]
+    img = load_calibration_tiles('tests/data/lq', tile_size=16, num_tiles=1)[0]
+    for idx, net in enumerate(nets):
+        net.eval()
+        engine = QuantizedEngine(net, f'test{idx}', str(tmp_path), 'tests/data/gt')
+        with torch.no_grad():
+            expected = net(img)
+            output = engine(img)
+            assert output.shape == expected.shape
+            assert (output - expected).abs().mean() < 0.05
+
+            # the quantized network is saved and reused
+            assert os.path.isfile(engine.path)
+            reloaded = QuantizedEngine(net, f'test{idx}', str(tmp_path), 'tests/data/gt')
+            assert torch.allclose(reloaded(img), output)
@@ -0,0 +1,36 @@
+import asyncio
+
+from frontend import services
+from frontend.schemas import SingleImageUpscaleRequest
+
+PARAMS = SingleImageUpscaleRequest(
+    model_name='realesr-general-x4v3', denoise_strength=0.5, outscale=4, face_enhance=False, plan_policy='exact')
+
+
+def test_upscale_image_in_process(monkeypatch):
+    calls = []
+
+    async def upscaler(file_bytes, filename, params):
+        calls.append((file_bytes, filename, params))
+        return b'upscaled'
+
+    monkeypatch.setattr(services, 'local_upscaler', upscaler)
+    monkeypatch.setattr(services, 'BACKEND_URL', None)
+    assert asyncio.run(services.upscale_image(b'image', 'a.png', 'image/png', PARAMS)) == b'upscaled'
+    assert calls == [(b'image', 'a.png', PARAMS)]
+
+    # a configured backend always goes over HTTP
+    monkeypatch.setattr(services, 'BACKEND_URL', 'http://backend:9000/')
+    assert services.get_upscaler_url('/upscale') == 'http://backend:9000/upscale'
+
+
+def test_pooled_client():
+
+    async def run():
+        client = services.get_client()
+        assert services.get_client() is client
+        await services.close_client()
+        assert services.get_client() is not client
+        await services.close_client()
+
+    asyncio.run(run())
@@ -0,0 +1,26 @@
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact, SRVGGNetCompactInference
+
+
+def test_srvggnetcompactinference():
+    """Test arch: SRVGGNetCompactInference."""
+
+    for act_type in ['prelu', 'relu', 'leakyrelu']:
+        net = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=4, num_conv=2, upscale=4, act_type=act_type).eval()
+        fused = SRVGGNetCompactInference(
+            num_in_ch=3, num_out_ch=3, num_feat=4, num_conv=2, upscale=4, act_type=act_type).eval()
+        # same checkpoints
+        fused.load_state_dict(net.state_dict())
+        img = torch.rand((1, 3, 12, 10), dtype=torch.float32)
+        with torch.no_grad():
+            expected = net(img)
+            assert torch.allclose(fused(img), expected, atol=1e-6)
+            img = img.contiguous(memory_format=torch.channels_last)
+            assert torch.allclose(fused(img), expected, atol=1e-6)
+
+        # with gradients the SRVGGNetCompact forward is used
+        output = fused(img)
+        assert output.shape == (1, 3, 48, 40)
+        output.mean().backward()
+        assert fused.body[0].weight.grad is not None
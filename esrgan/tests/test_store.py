@@ -0,0 +1,107 @@
+import io
+import os
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from time import monotonic
+
+from frontend.store import QuotaExceededError, ResultStore, download_response
+
+
+def test_result_store(tmp_path):
+    os.makedirs(tmp_path / 'esrgan-store' / 'stale')
+    os.makedirs(tmp_path / 'other')
+    store = ResultStore(str(tmp_path), quota=100, ttl=60)
+    # leftovers of a previous run are removed, the rest of the directory is not touched
+    assert not os.path.exists(tmp_path / 'esrgan-store' / 'stale')
+    assert os.path.exists(tmp_path / 'other')
+    root = tmp_path / 'esrgan-store'
+
+    first = store.put('a', b'1' * 40, 'first.png', 'image/png')
+    second = store.put('a', io.BytesIO(b'2' * 40), 'second.png', 'image/png')
+    other = store.put('b', b'3' * 90, 'other.png', 'image/png')
+    assert store.read(second) == b'2' * 40
+    assert store.get(first).name == 'first.png' and store.get(first).size == 40
+    assert store.session_usage('a') == 80 and store.session_usage('b') == 90
+
+    # the oldest files of the session are evicted to stay within its quota, other sessions are untouched
+    third = store.put('a', b'4' * 50, 'third.png', 'image/png')
+    with pytest.raises(FileNotFoundError):
+        store.get(first)
+    assert store.session_usage('a') == 90 and store.read(other) == b'3' * 90
+    assert sorted(os.listdir(root / 'a')) == sorted([second, third])
+
+    with pytest.raises(QuotaExceededError):
+        store.put('a', b'5' * 101, 'large.png', 'image/png')
+    assert sorted(os.listdir(root / 'a')) == sorted([second, third])
+
+    # the session names a directory of the store
+    for session in ('../a', '/tmp', '', 'a/b'):
+        with pytest.raises(ValueError):
+            store.put(session, b'6', 'escape.png', 'image/png')
+    assert sorted(os.listdir(root)) == ['a', 'b']
+
+    store.delete(second)
+    store.delete(second)
+    assert store.session_usage('a') == 50
+
+    # files that were not accessed within the ttl expire
+    store.get(third)
+    store.expire(now=monotonic() + 30)
+    assert store.session_usage('a') == 50
+    store.expire(now=monotonic() + 61)
+    assert store.session_usage('a') == 0 and store.session_usage('b') == 0
+    assert os.listdir(root / 'a') == [] and os.listdir(root / 'b') == []
+
+
+def test_result_store_pins(tmp_path):
+    store = ResultStore(str(tmp_path), quota=100, ttl=60)
+    queued = store.put('a', b'1' * 40, 'queued.png', 'image/png')
+    done = store.put('a', b'2' * 40, 'done.png', 'image/png')
+    # the source of a queued upscale is kept, the next oldest file is evicted instead
+    store.pin(queued)
+    store.pin(queued)
+    result = store.put('a', b'3' * 50, 'result.png', 'image/png')
+    assert store.read(queued) == b'1' * 40
+    with pytest.raises(FileNotFoundError):
+        store.get(done)
+
+    # the upload is rejected when the quota cannot be met without the pinned files, nothing is evicted
+    store.pin(result)
+    with pytest.raises(QuotaExceededError):
+        store.put('a', b'4' * 20, 'rejected.png', 'image/png')
+    assert store.session_usage('a') == 90 and len(os.listdir(tmp_path / 'esrgan-store' / 'a')) == 2
+
+    # pinned files do not expire either, pins are counted
+    store.expire(now=monotonic() + 61)
+    assert store.session_usage('a') == 90
+    store.unpin(queued)
+    store.unpin(result)
+    store.expire(now=monotonic() + 61)
+    assert store.session_usage('a') == 40
+    store.unpin(queued)
+    store.put('a', b'5' * 70, 'new.png', 'image/png')
+    with pytest.raises(FileNotFoundError):
+        store.get(queued)
+
+
+def test_download_response(tmp_path):
+    store = ResultStore(str(tmp_path), quota=2**20, ttl=60)
+    data = bytes(range(256)) * 64
+    file_id = store.put('a', data, 'result.png', 'image/png')
+
+    app = FastAPI()
+    app.get('/results/{file_id}')(lambda file_id: download_response(store, file_id))
+    client = TestClient(app)
+
+    response = client.get(f'/results/{file_id}')
+    assert response.status_code == 200 and response.content == data
+    assert response.headers['content-type'] == 'image/png'
+    assert 'result.png' in response.headers['content-disposition']
+
+    response = client.get(f'/results/{file_id}', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206 and response.content == data[100:200]
+    assert response.headers['content-range'] == f'bytes 100-199/{len(data)}'
+
+    store.delete(file_id)
+    assert client.get(f'/results/{file_id}').status_code == 404
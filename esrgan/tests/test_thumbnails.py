@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from io import BytesIO
+from PIL import Image
+
+from frontend.util import ThumbnailCache, make_thumbnail, read_aspect_ratio
+
+
+def encode(size, mode='RGB', seed=0, fmt='PNG'):
+    channels = {'RGB': 3, 'RGBA': 4}[mode]
+    array = np.random.default_rng(seed).integers(0, 255, (size[1], size[0], channels), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(array, mode).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def decode(thumbnail):
+    return thumbnail.type, Image.open(BytesIO(thumbnail.data))
+
+
+def test_make_thumbnail():
+    mime, thumbnail = decode(make_thumbnail(encode((400, 200)), 100))
+    assert mime == 'image/jpeg'
+    assert thumbnail.size == (100, 50)
+
+    # transparency is kept
+    mime, thumbnail = decode(make_thumbnail(encode((100, 300), 'RGBA'), 60))
+    assert mime == 'image/png'
+    assert thumbnail.mode == 'RGBA' and thumbnail.size == (20, 60)
+
+    # smaller images are not upscaled
+    _, thumbnail = decode(make_thumbnail(encode((40, 30), fmt='JPEG'), 100))
+    assert thumbnail.size == (40, 30)
+
+
+def test_read_aspect_ratio():
+    stream = BytesIO(encode((300, 200)))
+    assert read_aspect_ratio(stream) == 1.5 and stream.tell() == 0
+    stream = BytesIO(b'not an image')
+    assert read_aspect_ratio(stream) is None and stream.tell() == 0
+
+
+def test_thumbnail_cache():
+    # same content, so that all thumbnails have the same size
+    images = [encode((64, 64))] * 4
+    ids = [f'image{i}' for i in range(4)]
+
+    one = len(make_thumbnail(images[0], 32).data)
+    cache = ThumbnailCache(max_bytes=3 * one, max_side=32)
+    for image_id, data in zip(ids[:3], images[:3]):
+        cache.get(image_id, lambda data=data: data)
+    assert list(cache.entries) == ids[:3] and cache.size <= cache.max_bytes
+
+    # hits refresh the entry and do not load the image
+    assert cache.get(ids[0], lambda: pytest.fail('loaded on a hit')) == cache.entries[ids[0]]
+    # the least recently used entry is evicted to stay within the budget
+    cache.get(ids[3], lambda: images[3])
+    assert list(cache.entries) == [ids[2], ids[0], ids[3]]
+    assert cache.size == sum(len(thumbnail.data) for thumbnail in cache.entries.values())
+
+    cache.discard(ids[0])
+    cache.discard('unknown')
+    assert list(cache.entries) == [ids[2], ids[3]]
+    assert cache.size == sum(len(thumbnail.data) for thumbnail in cache.entries.values())
@@ -1,7 +1,15 @@
+import cv2
 import numpy as np
+import pytest
+import queue
+import threading
+import time
+import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
+from unittest import mock
 
-from realesrgan.utils import RealESRGANer
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.utils import IOConsumer, Pipeline, PrefetchReader, RealESRGANer, resolve_precision
 
 
 def test_realesrganer():
@@ -85,3 +93,180 @@ def test_realesrganer():
     result = restorer.enhance(img, outscale=2, alpha_upsampler=None)
     assert result[0].shape == (8, 8, 4)
     assert result[1] == 'RGBA'
+
+
+def test_resolve_precision():
+    cpu, cuda = torch.device('cpu'), torch.device('cuda')
+    assert resolve_precision('fp32', cuda) == 'fp32'
+    assert resolve_precision('auto', cuda) == 'fp16'
+    with mock.patch('realesrgan.utils.is_bf16_supported', return_value=True):
+        assert resolve_precision('auto', cpu) == 'bf16'
+    with mock.patch('realesrgan.utils.is_bf16_supported', return_value=False):
+        assert resolve_precision('auto', cpu) == 'fp32'
+    with pytest.raises(ValueError):
+        resolve_precision('fp8', cpu)
+
+    # fp16 only runs on CUDA
+    assert resolve_precision('fp16', cuda) == 'fp16'
+    with mock.patch('realesrgan.utils.is_bf16_supported', return_value=True):
+        assert resolve_precision('fp16', cpu) == 'bf16'
+    with mock.patch('realesrgan.utils.is_bf16_supported', return_value=False):
+        assert resolve_precision('fp16', cpu) == 'fp32'
+        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+        restorer = RealESRGANer(scale=4, model_path=None, model=model, pre_pad=0, device=cpu, precision='fp16')
+    assert restorer.precision == 'fp32' and restorer.half is False
+    assert next(restorer.model.parameters()).dtype == torch.float32
+    assert restorer.enhance(np.zeros((8, 8, 3), dtype=np.uint8))[0].shape == (32, 32, 3)
+
+
+def test_bf16_precision(tmp_path):
+    img = np.random.randint(0, 255, (32, 32, 3), dtype=np.uint8)
+    outputs = {}
+    for engine in ['eager', 'torchscript']:
+        for precision in ['fp32', 'bf16']:
+            model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+            torch.manual_seed(0)
+            model.load_state_dict({k: torch.rand_like(v) * 0.1 for k, v in model.state_dict().items()})
+            restorer = RealESRGANer(
+                scale=4,
+                model_path=None,
+                model=model,
+                tile=8,
+                tile_pad=2,
+                pre_pad=0,
+                device=torch.device('cpu'),
+                engine=engine,
+                model_id='test',
+                cache_dir=str(tmp_path),
+                precision=precision)
+            assert restorer.half is False
+            outputs[engine, precision] = restorer.enhance(img)[0].astype(np.float32)
+            if engine == 'torchscript':
+                # the interior tiles run through a module traced under autocast
+                autocast_dtype = torch.bfloat16 if precision == 'bf16' else None
+                assert restorer.engine.traced[(1, 3, 12, 12), torch.float32, autocast_dtype] is not None
+            assert outputs[engine, precision].shape == (128, 128, 3)
+    # bf16 keeps about 3 significant digits
+    assert np.abs(outputs['eager', 'bf16'] - outputs['eager', 'fp32']).max() <= 8
+    assert np.abs(outputs['torchscript', 'bf16'] - outputs['eager', 'bf16']).max() <= 1
+
+    with pytest.raises(ValueError):
+        RealESRGANer(scale=4, model_path=None, model=model, engine='onnxruntime', precision='bf16')
+
+
+def test_enhance_batch():
+    frames = [np.random.randint(0, 255, (20, 28, 3), dtype=np.uint8) for _ in range(3)]
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+    torch.manual_seed(0)
+    model.load_state_dict({k: torch.rand_like(v) * 0.1 for k, v in model.state_dict().items()})
+    for tile in [0, 8]:
+        restorer = RealESRGANer(
+            scale=4, model_path=None, model=model, tile=tile, tile_pad=2, pre_pad=1, device=torch.device('cpu'))
+        for outscale in [None, 2]:
+            outputs = restorer.enhance_batch(frames, outscale=outscale)
+            expected = [restorer.enhance(frame, outscale=outscale)[0] for frame in frames]
+            assert len(outputs) == 3
+            for output, frame in zip(outputs, expected):
+                assert output.shape == frame.shape and output.dtype == np.uint8
+                assert np.abs(output.astype(np.int16) - frame).max() <= 1
+
+    with pytest.raises(AssertionError):
+        restorer.enhance_batch([frames[0], frames[1][:10]])
+
+
+def test_estimate_batch_size():
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+    restorer = RealESRGANer(scale=4, model_path=None, model=model, pre_pad=0, device=torch.device('cpu'))
+    full = restorer.estimate_batch_size(64, 64, 2**24)
+    assert 1 < full < restorer.estimate_batch_size(64, 64, 2**26) <= 64
+    assert restorer.estimate_batch_size(64, 64, 2**40, max_batch_size=16) == 16
+    # at least one frame, even when it does not fit
+    assert restorer.estimate_batch_size(4000, 4000, 2**20) == 1
+    # only the tile goes through the network at once
+    restorer.tile_size = 16
+    assert restorer.estimate_batch_size(64, 64, 2**24) > full
+
+
+def test_pipeline():
+    frames = iter(range(20))
+    written = []
+
+    def read():
+        time.sleep(0.002)
+        return next(frames, None)
+
+    def infer(frame):
+        time.sleep(0.002)
+        return None if frame == 5 else frame * 2  # None drops the frame
+
+    pipeline = Pipeline([('decode', read), ('inference', infer), ('encode', written.append)], queue_sizes=[2, 1])
+    decode, inference, encode = pipeline.run()
+    assert written == [frame * 2 for frame in range(20) if frame != 5]
+    assert [decode.items, inference.items] == [20, 19]
+    assert decode.busy > 0 and 0 < inference.utilization <= 1
+    assert 'inference' in pipeline.report()
+
+    # stages overlap
+    assert pipeline.duration < decode.busy + inference.busy
+
+
+def test_pipeline_error():
+    frames = iter(range(1000))
+
+    def write(frame):
+        if frame == 3:
+            raise BrokenPipeError('encoder exited')
+
+    # the failure stops the source and does not leave any stage blocked on a full queue
+    pipeline = Pipeline([('decode', lambda: next(frames, None)), ('inference', lambda x: x), ('encode', write)], 1)
+    with pytest.raises(BrokenPipeError):
+        pipeline.run()
+    assert pipeline.stats[0].items < 1000
+    assert not any(stage.is_alive() for stage in pipeline.stages)
+
+
+def test_prefetch_reader_and_writers(tmp_path):
+    paths = []
+    for i in range(6):
+        paths.append(str(tmp_path / f'{i}.png'))
+        cv2.imwrite(paths[-1], np.full((4, 4, 3), i, dtype=np.uint8))
+    paths.insert(3, str(tmp_path / 'missing.png'))
+
+    reader = PrefetchReader(paths, 2)
+    reader.start()
+    images = enumerate(reader)
+    lock = threading.Lock()
+    save_que = queue.Queue(2)
+    writers = [IOConsumer(None, save_que, i) for i in range(2)]
+    for writer in writers:
+        writer.start()
+    read = {}
+
+    def consume():
+        while True:
+            with lock:
+                idx, img = next(images, (None, None))
+            if idx is None:
+                break
+            read[idx] = img
+            if img is not None:
+                save_que.put({'output': img + 1, 'save_path': str(tmp_path / f'out{idx}.png')})
+                # a failed write does not stop the writers
+                save_que.put({'output': img, 'save_path': str(tmp_path / f'out{idx}.unsupported')})
+
+    # several consumers share the reader, each of them stops once it is exhausted
+    consumers = [threading.Thread(target=consume) for _ in range(3)]
+    for consumer in consumers:
+        consumer.start()
+    for consumer in consumers:
+        consumer.join()
+    for _ in writers:
+        save_que.put('quit')
+    for writer in writers:
+        writer.join()
+
+    assert sorted(read) == list(range(7)) and read[3] is None
+    assert [cv2.imread(str(tmp_path / f'out{idx}.png'))[0, 0, 0] for idx in [0, 4, 6]] == [1, 4, 6]
+    assert reader.stats.items == 7
+    assert sum(writer.stats.items for writer in writers) == 6
+    assert sum(len(writer.errors) for writer in writers) == 6
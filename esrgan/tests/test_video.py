@@ -0,0 +1,228 @@
+import json
+import multiprocessing
+import os
+import socket
+import time
+import numpy as np
+import pytest
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.utils import RealESRGANer
+from realesrgan.video import DuplicateFrameDetector, FrameBatcher, SegmentManifest, TemporalTileCache, shard_ranges
+
+
+def test_duplicate_frame_detector():
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 200, (64, 96, 3), dtype=np.uint8)
+    noisy = np.clip(background.astype(np.int16) + rng.integers(-2, 3, background.shape), 0, 255).astype(np.uint8)
+    moved = background.copy()
+    moved[8:16, 8:16] = 255  # small moving object
+
+    detector = DuplicateFrameDetector()
+    assert [detector.is_duplicate(frame) for frame in [background, background.copy(), noisy, noisy]] == [
+        False, True, False, True
+    ]
+    assert detector.skip_ratio == 0.5
+    # a different size is never a duplicate
+    assert not detector.is_duplicate(np.zeros((32, 48, 3), np.uint8))
+
+    detector = DuplicateFrameDetector(threshold=3)
+    assert [detector.is_duplicate(frame) for frame in [background, noisy, moved, moved, background]] == [
+        False, True, False, True, False
+    ]
+    assert (detector.frames, detector.duplicates) == (5, 2)
+
+
+def test_duplicate_frame_detector_reference():
+    # frames are compared to the last upsampled frame, so that a slow fade is not skipped entirely
+    frames = [np.full((32, 32, 3), value, np.uint8) for value in range(0, 20, 2)]
+    detector = DuplicateFrameDetector(threshold=5)
+    assert [detector.is_duplicate(frame) for frame in frames] == [
+        False, True, True, False, True, True, False, True, True, False
+    ]
+
+
+def test_frame_batcher():
+    a, b, c = (np.full((8, 8, 3), value, np.uint8) for value in (0, 100, 200))
+    small = np.zeros((4, 4, 3), np.uint8)
+    frames = iter([a, a, b, c, c, c, small, small, a])
+    batcher = FrameBatcher(lambda: next(frames, None), batch_size=2, detector=DuplicateFrameDetector())
+
+    batches = []
+    while True:
+        batch = batcher()
+        if batch is None:
+            break
+        batches.append(([frame[0, 0, 0] for frame in batch[0]], batch[1]))
+    # batches are cut at batch_size and at size changes, duplicates repeat the previous frame
+    assert batches == [([0, 100], [2, 1]), ([200], [3]), ([0], [2]), ([0], [1])]
+
+    frames = iter([a, a, b])
+    batcher = FrameBatcher(lambda: next(frames, None), batch_size=8)
+    assert [len(frames) for frames in batcher()] == [3, 3]
+
+
+def make_clip(num_frames, size=(48, 64), square=8):
+    """Static random background with a square moving right by 4 pixels per frame."""
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (*size, 3), dtype=np.uint8)
+    clip = []
+    for i in range(num_frames):
+        frame = background.copy()
+        frame[20:20 + square, 4 * i:4 * i + square] = 255
+        clip.append(frame)
+    return clip
+
+
+def make_upsampler(tile_cache=None):
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+    torch.manual_seed(0)
+    model.load_state_dict({k: torch.rand_like(v) * 0.1 for k, v in model.state_dict().items()})
+    upsampler = RealESRGANer(
+        scale=4, model_path=None, model=model, tile=16, tile_pad=4, pre_pad=0, device=torch.device('cpu'))
+    upsampler.tile_cache = tile_cache
+    return upsampler
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_temporal_tile_cache(batch_size):
+    clip = make_clip(6)
+    expected = make_upsampler().enhance_batch(clip)
+
+    tile_cache = TemporalTileCache()
+    upsampler = make_upsampler(tile_cache)
+    outputs = []
+    for i in range(0, len(clip), batch_size):
+        outputs += upsampler.enhance_batch(clip[i:i + batch_size])
+    # unchanged tiles get the same output as if they were upsampled again
+    for output, frame in zip(outputs, expected):
+        assert np.abs(output.astype(np.int16) - frame).max() <= 1
+
+    # 12 tiles per frame, the square (with the tile_pad context) touches 2 to 4 tiles of a frame and of the previous
+    assert tile_cache.computed + tile_cache.reused == 6 * 12
+    assert tile_cache.computed < 12 + 5 * 6
+    assert tile_cache.reuse_ratio > 0.5
+
+
+def test_temporal_tile_cache_threshold():
+    noisy = make_clip(1)[0].astype(np.int16) + np.random.default_rng(1).integers(-2, 3, (48, 64, 3))
+    clip = make_clip(1) + [np.clip(noisy, 0, 255).astype(np.uint8)]
+
+    exact = TemporalTileCache()
+    make_upsampler(exact).enhance_batch(clip)
+    assert exact.reused == 0
+    tolerant = TemporalTileCache(threshold=2)
+    make_upsampler(tolerant).enhance_batch(clip)
+    assert tolerant.reused == 12
+
+
+def test_shard_ranges():
+    assert shard_ranges(10, 3) == [(0, 3), (3, 6), (6, 10)]
+    assert shard_ranges(2, 3) == [(0, 0), (0, 1), (1, 2)]
+    for num_frames, num_shards in [(1, 1), (100, 7), (61, 4)]:
+        ranges = shard_ranges(num_frames, num_shards)
+        # consecutive, every frame once
+        assert [frame for start, end in ranges for frame in range(start, end)] == list(range(num_frames))
+        assert max(end - start for start, end in ranges) - min(end - start for start, end in ranges) <= 1
+
+
+def test_segment_manifest(tmp_path):
+    manifest = SegmentManifest(str(tmp_path))
+    segments = manifest.create({'model_name': 'x'}, 25, 10)
+    assert [(segment['start'], segment['end']) for segment in segments] == [(0, 10), (10, 20), (20, 25)]
+
+    # a second worker of the same job claims another segment
+    other = SegmentManifest(str(tmp_path))
+    assert other.create({'model_name': 'x'}, 25, 10) == segments
+    assert manifest.claim()['index'] == 0
+    assert other.claim()['index'] == 1
+    manifest.complete(0, frames=10)
+    manifest.release(0)
+    assert [segment['index'] for segment in manifest.remaining()] == [1, 2]
+    assert manifest.claim()['index'] == 2
+    assert manifest.claim() is None
+
+    # a rerun with other settings does not mix its segments in
+    with pytest.raises(ValueError):
+        SegmentManifest(str(tmp_path)).create({'model_name': 'y'}, 25, 10)
+
+
+def test_segment_manifest_stale_lock(tmp_path):
+    manifest = SegmentManifest(str(tmp_path), stale_after=600)
+    manifest.create({}, 20, 10)
+    # lock of a worker that died on this machine
+    dead = {'host': socket.gethostname(), 'pid': 2**22 + 1, 'time': 0}
+    with open(manifest.lock_path(0), 'w') as f:
+        json.dump(dead, f)
+    # lock of a worker of another machine, alive until it stops its heartbeat
+    alive = {'host': 'elsewhere', 'pid': os.getpid(), 'time': 0}
+    with open(manifest.lock_path(1), 'w') as f:
+        json.dump(alive, f)
+
+    assert manifest.claim()['index'] == 0
+    assert manifest.claim() is None
+    os.utime(manifest.lock_path(1), (0, 0))
+    assert manifest.claim()['index'] == 1
+
+
+def test_segment_manifest_take_over(tmp_path):
+    manifest = SegmentManifest(str(tmp_path), stale_after=600)
+    manifest.create({}, 20, 10)
+    with open(manifest.lock_path(0), 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': 2**22 + 1, 'time': 0}, f)
+    assert manifest.take_over(manifest.lock_path(0))
+    assert not os.path.exists(manifest.lock_path(0))
+
+    # another worker that found the same lock stale took it over first: its fresh lock is left in place
+    other = SegmentManifest(str(tmp_path), stale_after=600)
+    assert other.claim()['index'] == 0
+    with open(manifest.lock_path(0)) as f:
+        owner = f.read()
+    assert not manifest.take_over(manifest.lock_path(0))
+    with open(manifest.lock_path(0)) as f:
+        assert f.read() == owner
+    assert sorted(os.listdir(tmp_path)) == ['00000.lock', 'manifest.json']
+    assert manifest.part_path(0).endswith(f'00000.{socket.gethostname()}.{os.getpid()}.part.mp4')
+
+
+class SlowManifest(SegmentManifest):
+    """Widens the window between the staleness check of a lock and its take over."""
+
+    def is_stale(self, lock_path):
+        stale = super().is_stale(lock_path)
+        time.sleep(0.05)
+        return stale
+
+
+def claim_stale(folder, barrier, results):
+    manifest = SlowManifest(folder, stale_after=600)
+    barrier.wait()
+    segment = manifest.claim()
+    # stay alive until every worker tried, a lock of a worker that exited may be taken over
+    barrier.wait()
+    results.put((os.getpid(), None if segment is None else segment['index']))
+
+
+def test_segment_manifest_take_over_race(tmp_path):
+    manifest = SegmentManifest(str(tmp_path), stale_after=600)
+    manifest.create({}, 10, 10)
+    ctx = multiprocessing.get_context('fork')
+    num_workers = 6
+    for _ in range(5):
+        with open(manifest.lock_path(0), 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': 2**22 + 1, 'time': 0}, f)
+        barrier, results = ctx.Barrier(num_workers), ctx.Queue()
+        workers = [ctx.Process(target=claim_stale, args=(str(tmp_path), barrier, results)) for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        claims = dict(results.get(timeout=60) for _ in workers)
+        for worker in workers:
+            worker.join()
+
+        # exactly one of the workers that found the lock stale took it over, and the lock is its own
+        winners = [pid for pid, index in claims.items() if index == 0]
+        assert len(winners) == 1
+        with open(manifest.lock_path(0)) as f:
+            assert json.load(f)['pid'] == winners[0]
+        assert sorted(os.listdir(tmp_path)) == ['00000.lock', 'manifest.json']
@@ -0,0 +1,118 @@
+import asyncio
+import cv2
+import io
+import os
+import pytest
+import shutil
+import subprocess
+
+from server.pool import JobResult
+from server.schemas import JobStats
+from server.video import VideoJobs, probe
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                reason='needs the ffmpeg and ffprobe binaries')
+
+
+def make_video(path, seconds=2, audio=True, size='32x24'):
+    """10 fps clip, the first second is a still image."""
+    cmd = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc=size={size}:rate=10:duration={seconds}']
+    if audio:
+        cmd += ['-f', 'lavfi', '-i', f'sine=duration={seconds}']
+    # lossless, so that the still frames decode to the same image. yuv444p allows odd sizes
+    cmd += ['-vf', 'loop=loop=9:size=1:start=0,setpts=N/10/TB', '-frames:v', str(seconds * 10), '-c:v', 'libx264',
+            '-qp', '0', '-pix_fmt', 'yuv444p', '-y', path]
+    subprocess.run(cmd, check=True)
+
+
+def count_frames(path):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            return frames
+        frames.append(frame)
+
+
+async def upscale(frame):
+    await asyncio.sleep(0.001)
+    output = cv2.resize(frame, None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST)
+    return JobResult(output, JobStats(pid=1, duration_s=0.001))
+
+
+def test_video_job(tmp_path):
+    make_video(str(tmp_path / 'clip.mp4'))
+    # only the subdirectory of the jobs is emptied on start
+    os.makedirs(tmp_path / 'jobs' / 'esrgan-video-jobs' / 'stale')
+    os.makedirs(tmp_path / 'jobs' / 'other')
+
+    async def run():
+        jobs = VideoJobs(str(tmp_path / 'jobs'), segment_s=0.5, ttl=3600)
+        assert os.listdir(jobs.root) == [] and os.path.exists(tmp_path / 'jobs' / 'other')
+        with open(tmp_path / 'clip.mp4', 'rb') as f:
+            job = await jobs.start('clip.mp4', f, upscale, concurrency=3)
+        assert job.status().total_frames == 20
+        await job.task
+        return job
+
+    job = asyncio.run(run())
+    status = job.status()
+    assert status.state == 'done', status.error
+    assert status.frames_done == 20 and status.total_frames == 20
+    # the still first second is upscaled once
+    assert status.frames_reused == 9
+    assert [(segment.start_frame, segment.frames) for segment in status.segments] == [(0, 5), (5, 5), (10, 5), (15, 5)]
+
+    # a finished segment is a video of its own
+    assert len(count_frames(job.segment_path(1))) == 5
+
+    info = probe(job.output_path)
+    assert (info.width, info.height, info.fps, info.num_frames) == (64, 48, 10, 20)
+    streams = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type', '-of', 'csv=p=0',
+                              job.output_path], capture_output=True, text=True).stdout.split()
+    assert streams == ['video', 'audio']
+
+
+def test_video_job_errors(tmp_path):
+    make_video(str(tmp_path / 'clip.mp4'), seconds=1, audio=False)
+
+    async def crash(frame):
+        raise RuntimeError('worker crashed')
+
+    async def run():
+        jobs = VideoJobs(str(tmp_path / 'jobs'), segment_s=10, ttl=0)
+        with pytest.raises(ValueError):
+            await jobs.start('broken.mp4', io.BytesIO(b'not a video'), upscale, concurrency=1)
+        assert os.listdir(jobs.root) == []
+
+        with open(tmp_path / 'clip.mp4', 'rb') as f:
+            job = await jobs.start('clip.mp4', f, crash, concurrency=2)
+        await job.task
+        assert job.state == 'failed' and 'worker crashed' in job.error
+        # finished jobs expire after the ttl
+        with pytest.raises(FileNotFoundError):
+            jobs.get(job.id)
+        assert not os.path.exists(job.dir)
+
+    asyncio.run(run())
+
+
+def test_video_job_odd_size(tmp_path):
+    make_video(str(tmp_path / 'clip.mp4'), seconds=1, audio=False, size='33x25')
+
+    async def identity(frame):
+        return JobResult(frame, JobStats(pid=1, duration_s=0.001))
+
+    async def run():
+        jobs = VideoJobs(str(tmp_path / 'jobs'), segment_s=10, ttl=3600)
+        with open(tmp_path / 'clip.mp4', 'rb') as f:
+            job = await jobs.start('clip.mp4', f, identity, concurrency=2)
+        await job.task
+        return job
+
+    job = asyncio.run(run())
+    assert job.state == 'done', job.error
+    # yuv420p needs even sizes, the last row and column are repeated
+    info = probe(job.output_path)
+    assert (info.width, info.height, info.num_frames) == (34, 26, 10)
@@ -0,0 +1,48 @@
+import os
+import pytest
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from server.memory import get_process_memory
+from server.weights import assign_weights, load_model_weights
+
+
+def make_checkpoint(path, seed):
+    torch.manual_seed(seed)
+    net = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=4, num_conv=2, upscale=4, act_type='prelu')
+    params = {k: torch.zeros_like(v) for k, v in net.state_dict().items()}
+    torch.save({'params': params, 'params_ema': net.state_dict()}, path)
+    return net.eval()
+
+
+def test_shared_weights(tmp_path):
+    net_a = make_checkpoint(str(tmp_path / 'a.pth'), 0)
+    net_b = make_checkpoint(str(tmp_path / 'b.pth'), 1)
+    shared_dir = str(tmp_path / 'shared')
+
+    # flattened once, then loaded from the cache
+    state_dict = load_model_weights(str(tmp_path / 'a.pth'), shared_dir=shared_dir)
+    assert sorted(os.listdir(shared_dir)) == ['a.pth']
+    assert load_model_weights(str(tmp_path / 'a.pth'), shared_dir=shared_dir) is state_dict
+
+    with torch.device('meta'):
+        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=4, num_conv=2, upscale=4, act_type='prelu')
+    assign_weights(model, state_dict).eval()
+    # no copy, the parameters are the memory-mapped tensors
+    assert model.body[0].weight.data_ptr() == state_dict['body.0.weight'].data_ptr()
+    img = torch.rand((1, 3, 8, 8), dtype=torch.float32)
+    with torch.no_grad():
+        assert torch.equal(model(img), net_a(img))
+
+    # deep network interpolation
+    blended = load_model_weights([str(tmp_path / 'a.pth'), str(tmp_path / 'b.pth')], [0.25, 0.75], shared_dir)
+    expected = 0.25 * net_a.body[0].weight + 0.75 * net_b.body[0].weight
+    assert torch.allclose(blended['body.0.weight'], expected)
+
+
+def test_process_memory():
+    if not os.path.isfile('/proc/self/smaps_rollup'):
+        pytest.skip('smaps_rollup is Linux only')
+    memory = get_process_memory(os.getpid(), 'server')
+    assert memory.rss > 0
+    assert memory.shared + memory.private == memory.rss
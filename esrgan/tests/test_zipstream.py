@@ -0,0 +1,38 @@
+import asyncio
+import io
+import os
+import zipfile
+
+from server.zipstream import CHUNK_SIZE, stream_zip, unique_name
+
+
+def test_unique_name():
+    used = set()
+    assert [unique_name(name, used) for name in ['a.png', 'a.png', 'b.png', 'a.png', 'a (1).png']] == \
+        ['a.png', 'a (1).png', 'b.png', 'a (2).png', 'a (1) (1).png']
+
+
+def test_stream_zip(tmp_path):
+    path = str(tmp_path / 'large.bin')
+    large = os.urandom(2 * CHUNK_SIZE + 5)
+    with open(path, 'wb') as f:
+        f.write(large)
+
+    async def entries():
+        yield 'large.bin', path
+        await asyncio.sleep(0)
+        yield 'small.txt', b'small'
+        yield 'small.txt', b'duplicate'
+
+    async def collect():
+        return [chunk async for chunk in stream_zip(entries())]
+
+    chunks = asyncio.run(collect())
+    # files are streamed in chunks, not buffered whole
+    assert max(len(chunk) for chunk in chunks) < CHUNK_SIZE + 1024
+
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    assert archive.testzip() is None
+    assert archive.namelist() == ['large.bin', 'small.txt', 'small (1).txt']
+    assert archive.read('large.bin') == large
+    assert archive.read('small (1).txt') == b'duplicate'